@@ -0,0 +1,1452 @@
+#!/usr/bin/env python3
+
+"""
+Formats of files written by write_results_files.py.
+
+Unlike write_results_files.py, this does not require Hail, so that results directories can be read anywhere.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import fcntl
+import functools
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+
+# Packed gene files
+#
+# With the "packed" output format, files that would be written to genes/NNN/ are instead appended to genes/NNN.pack.
+# genes/NNN.idx lists the offset and length of each file in the pack, sorted by file name without extension, so
+# that files can be found with a binary search of the memory mapped index.
+#
+# Index layout (little endian):
+#   header: magic (8 bytes), key width (uint32), number of entries (uint32)
+#   entries: key (key width bytes, NUL padded), offset (uint64), length (uint64)
+
+PACK_INDEX_MAGIC = b"ERBIDX01"
+PACK_INDEX_HEADER = struct.Struct("<8sII")
+PACK_INDEX_ENTRY_LOCATION = struct.Struct("<QQ")
+
+
+def pack_location(relative_path):
+    """
+    Return the pack (relative path without extension) and key for a file in a gene directory.
+
+    For example, genes/174/ENSG00000169174_GRCh37.json is stored in genes/174.pack with key ENSG00000169174_GRCh37.
+    """
+    pack, file_name = os.path.split(relative_path)
+    key, _ = os.path.splitext(file_name)
+    return pack, key
+
+
+def append_to_pack(pack_path, data):
+    """
+    Append data to a pack file and return the offset it was written at.
+
+    Packs are locked while appending, so that multiple processes can safely append to the same pack.
+    """
+    with open(pack_path, mode="ab") as pack_file:
+        fcntl.flock(pack_file, fcntl.LOCK_EX)
+        try:
+            offset = pack_file.seek(0, os.SEEK_END)
+            pack_file.write(data)
+            pack_file.flush()
+        finally:
+            fcntl.flock(pack_file, fcntl.LOCK_UN)
+
+    return offset
+
+
+def write_pack_index(index_path, entries):
+    """
+    Write an index for a pack from a list of (key, offset, length) tuples.
+    """
+    entries = sorted((key.encode("ascii"), offset, length) for key, offset, length in entries)
+    key_width = max((len(key) for key, _, _ in entries), default=0)
+
+    with open(index_path, mode="wb") as index_file:
+        index_file.write(PACK_INDEX_HEADER.pack(PACK_INDEX_MAGIC, key_width, len(entries)))
+        for key, offset, length in entries:
+            index_file.write(key.ljust(key_width, b"\0"))
+            index_file.write(PACK_INDEX_ENTRY_LOCATION.pack(offset, length))
+
+
+class PackReader:
+    """
+    Reads files from a pack using its memory mapped index.
+    """
+
+    def __init__(self, pack_path_prefix):
+        self.pack_path_prefix = pack_path_prefix
+
+        with open(f"{pack_path_prefix}.idx", mode="rb") as index_file:
+            self._index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._key_width, self._n_entries = PACK_INDEX_HEADER.unpack_from(self._index)
+        if magic != PACK_INDEX_MAGIC:
+            raise ValueError(f"{pack_path_prefix}.idx is not a pack index")
+
+        self._entry_size = self._key_width + PACK_INDEX_ENTRY_LOCATION.size
+        self._pack_fd = os.open(f"{pack_path_prefix}.pack", os.O_RDONLY)
+
+    def close(self):
+        self._index.close()
+        os.close(self._pack_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._n_entries
+
+    def _key(self, i):
+        start = PACK_INDEX_HEADER.size + i * self._entry_size
+        return self._index[start : start + self._key_width]
+
+    def keys(self):
+        return [self._key(i).rstrip(b"\0").decode("ascii") for i in range(self._n_entries)]
+
+    def entries(self):
+        """
+        Return a list of (key, offset, length) for each file in the pack.
+        """
+        return [
+            (
+                key,
+                *PACK_INDEX_ENTRY_LOCATION.unpack_from(
+                    self._index, PACK_INDEX_HEADER.size + i * self._entry_size + self._key_width
+                ),
+            )
+            for i, key in enumerate(self.keys())
+        ]
+
+    def location(self, key):
+        """
+        Return the (offset, length) of a file in the pack, or None if the pack does not contain it.
+        """
+        key = key.encode("ascii")
+        if len(key) > self._key_width:
+            return None
+
+        key = key.ljust(self._key_width, b"\0")
+        lo, hi = 0, self._n_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self._n_entries and self._key(lo) == key:
+            return PACK_INDEX_ENTRY_LOCATION.unpack_from(
+                self._index, PACK_INDEX_HEADER.size + lo * self._entry_size + self._key_width
+            )
+
+        return None
+
+    def get(self, key):
+        location = self.location(key)
+        if location is None:
+            return None
+
+        offset, length = location
+        return os.pread(self._pack_fd, length, offset)
+
+
+@functools.lru_cache(maxsize=64)
+def open_pack(pack_path_prefix):
+    return PackReader(pack_path_prefix)
+
+
+def read_packed_file(results_directory, relative_path):
+    """
+    Read a file from a results directory written with the packed output format.
+
+    Returns None if the file does not exist.
+    """
+    pack, key = pack_location(relative_path)
+    try:
+        reader = open_pack(f"{results_directory}/{pack}")
+    except FileNotFoundError:
+        return None
+
+    return reader.get(key)
+
+
+# Columnar variants
+#
+# With the "columns" variant format, variants files contain {"variants": {"length": N, "fields": [column, ...]}} with
+# one column for each variant field instead of an array of variant tuples. Each column is an object with:
+#   values: the column's non-null values, or
+#   fields: for columns of tuples, one column for each tuple field (covering only the non-null tuples)
+#   null_runs (optional): flat list of start index and length of each run of nulls omitted from values/fields
+#   dictionary (optional): values are indices into this list of distinct strings
+#   prefixes, prefix_indices (optional): values are suffixes following the prefix at prefixes[prefix_indices[i]]
+#
+# Variant detail files
+#
+# For datasets with core variant fields configured, each variants file (or window of a variants file) contains only
+# the core fields of each variant, and {gene}_{dataset}_variants[_w{i}]_detail.json contains the other fields of the
+# same variants in the same order. Both are {"variants": [...]} with tuples of the top level fields, then a list of
+# info fields, then a list of group result fields for each analysis group (null for groups without results). The
+# fields in each are recorded as variant_field_split in the dataset's metadata.
+#
+# Variant analysis group files
+#
+# For datasets with variant_files_by_group in their metadata, each variants file contains the variant tuples without
+# group results, and {gene}_{dataset}_variants_g{i}.json contains {"variants": [[index, group result], ...]} for the
+# variants with a result in the dataset's i-th variant result analysis group, where index is the variant's index in
+# the variants file.
+
+
+def _decode_column(column, length):
+    null_runs = column.get("null_runs", [])
+    n_values = length - sum(null_runs[1::2])
+
+    if "fields" in column:
+        fields = [_decode_column(field, n_values) for field in column["fields"]]
+        values = [list(value) for value in zip(*fields)] if fields else [[] for _ in range(n_values)]
+    else:
+        values = column["values"]
+
+    if "dictionary" in column:
+        dictionary = column["dictionary"]
+        values = [dictionary[index] for index in values]
+
+    if "prefixes" in column:
+        prefixes = column["prefixes"]
+        values = [prefixes[index] + suffix for index, suffix in zip(column["prefix_indices"], values)]
+
+    if null_runs:
+        values = list(values)
+        for start, run_length in zip(null_runs[::2], null_runs[1::2]):
+            values[start:start] = [None] * run_length
+
+    return values
+
+
+def decode_variant_columns(variants):
+    """
+    Convert variants written with the "columns" variant format to a list of variant tuples.
+    """
+    fields = [_decode_column(column, variants["length"]) for column in variants["fields"]]
+    return [list(variant) for variant in zip(*fields)]
+
+
+# Manifests
+#
+# manifest.json lists the size and content hash of every file in a results directory (except itself), as
+# {"generation_id": ..., "files": {relative path: [size, hash], ...}}. For packed output, files in packs are listed
+# by the path they would have been written to. The generation ID is derived from the hashes of all files other
+# than metadata.json and is also recorded in metadata.json.
+
+MANIFEST_FILE = "manifest.json"
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def hash_file(path):
+    file_hash = hashlib.sha256()
+    with open(path, mode="rb") as data_file:
+        for chunk in iter(lambda: data_file.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()[:32]
+
+
+def read_manifest(results_directory):
+    try:
+        with open(f"{results_directory}/{MANIFEST_FILE}", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {"generation_id": None, "files": {}}
+
+
+def generation_id(manifest_files):
+    """
+    Derive an ID for a release from its files' hashes, so that a release with the same contents has the same ID.
+    """
+    generation_hash = hashlib.sha256()
+    for relative_path, (size, file_hash) in sorted(manifest_files.items()):
+        if relative_path != "metadata.json":
+            generation_hash.update(f"{relative_path}\t{size}\t{file_hash}\n".encode("utf-8"))
+
+    return generation_hash.hexdigest()[:16]
+
+
+def _check_manifest_entry(results_directory, relative_path, entry):
+    size, expected_hash = entry
+    path = f"{results_directory}/{relative_path}"
+    if os.path.exists(path):
+        if os.path.getsize(path) != size:
+            return "size"
+
+        return None if hash_file(path) == expected_hash else "hash"
+
+    data = read_packed_file(results_directory, relative_path)
+    if data is None:
+        return "missing"
+
+    if len(data) != size:
+        return "size"
+
+    return None if content_hash(data) == expected_hash else "hash"
+
+
+def verify_results_directory(results_directory, workers=None):
+    """
+    Check every file listed in a results directory's manifest, and look for files that are not listed.
+
+    Returns a dict of relative path to the problem found: missing, size, hash, or unlisted.
+    """
+    manifest_files = read_manifest(results_directory)["files"]
+
+    with concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        problems = dict(
+            zip(
+                manifest_files,
+                executor.map(
+                    functools.partial(_check_manifest_entry, results_directory),
+                    manifest_files.keys(),
+                    manifest_files.values(),
+                    chunksize=256,
+                ),
+            )
+        )
+
+    problems = {relative_path: problem for relative_path, problem in problems.items() if problem}
+
+    for root, _, file_names in os.walk(results_directory):
+        for file_name in file_names:
+            relative_path = os.path.relpath(os.path.join(root, file_name), results_directory)
+            if relative_path == MANIFEST_FILE or file_name.endswith((".pack", ".idx")):
+                continue
+
+            if relative_path not in manifest_files:
+                problems[relative_path] = "unlisted"
+
+    return problems
+
+
+# Gene search index
+#
+# gene_search_index.bin maps gene search terms (symbols, previous symbols, and aliases, in upper case) to the IDs of
+# genes they match, so that it can be memory mapped and searched by term or prefix without building a trie. Terms
+# are sorted by their UTF-8 bytes, and each term's postings are indices into the sorted list of gene IDs.
+#
+# The index also lists the first autocomplete results for every prefix of search terms up to a maximum length, in
+# the order of the server's gene search: terms are ordered as in a trie with children sorted by character collation
+# (see collation_key), and a term matching multiple genes gives a result labelled "{term} ({gene ID})" for each
+# gene. Prefixes are sorted by their UTF-8 bytes, and each result is stored as its term index and gene index.
+#
+# Layout (little endian):
+#   header: magic (8 bytes), number of terms (uint32), number of postings (uint32), number of genes (uint32),
+#           gene ID width (uint32), maximum autocomplete prefix length (uint32), number of prefixes (uint32),
+#           number of autocomplete results (uint32)
+#   term offsets: number of terms + 1 offsets (uint32) of each term in term data
+#   postings offsets: number of terms + 1 offsets (uint32) of each term's first posting
+#   postings: gene index (uint32) for each posting
+#   prefix offsets: number of prefixes + 1 offsets (uint32) of each prefix in prefix data
+#   autocomplete offsets: number of prefixes + 1 offsets (uint32) of each prefix's first autocomplete result
+#   autocomplete results: term index (uint32) and gene index (uint32) for each result
+#   gene IDs: gene ID (gene ID width bytes, NUL padded) for each gene
+#   term data: UTF-8 encoded terms
+#   prefix data: UTF-8 encoded prefixes
+
+GENE_SEARCH_INDEX_FILE = "gene_search_index.bin"
+GENE_SEARCH_INDEX_MAGIC = b"ERBSRC02"
+GENE_SEARCH_INDEX_HEADER = struct.Struct("<8sIIIIIII")
+UINT32 = struct.Struct("<I")
+AUTOCOMPLETE_RESULT = struct.Struct("<II")
+
+# Maximum number of autocomplete results for each prefix, matching the server's gene search
+AUTOCOMPLETE_RESULTS = 5
+
+# Default maximum length of prefixes to store autocomplete results for. Longer prefixes match few enough terms to
+# search for them directly.
+AUTOCOMPLETE_PREFIX_LENGTH = 3
+
+# Order of whitespace and punctuation characters in Unicode (CLDR root) collation, which sorts these before digits
+# and digits before letters
+COLLATION_PUNCTUATION_ORDER = "\t\n\v\f\r _-,;:!?.'\"()[]{}@*/\\&#%`^+<=>|~$"
+
+
+def collation_key(char):
+    """
+    Return a sort key for a character approximating String.localeCompare, which the server uses to order search
+    results: whitespace and punctuation, then digits, then letters (lower case before upper case), then anything
+    else by code point.
+    """
+    punctuation_index = COLLATION_PUNCTUATION_ORDER.find(char)
+    if punctuation_index >= 0:
+        return (0, punctuation_index, 0)
+
+    if char.isdigit():
+        return (1, ord(char), 0)
+
+    if char.isalpha():
+        return (2, char.lower(), int(not char.islower()))
+
+    return (3, ord(char), 0)
+
+
+def autocomplete_results(terms, term_genes, max_prefix_length, n_results=AUTOCOMPLETE_RESULTS):
+    """
+    Return a map of each prefix of terms up to max_prefix_length characters to a list of its first n_results
+    autocomplete results, as (term index, gene index) tuples.
+
+    terms is a list of encoded search terms and term_genes is a list of the sorted gene indices for each term.
+    """
+    results = collections.defaultdict(list)
+    for term_index in sorted(
+        range(len(terms)), key=lambda i: [collation_key(char) for char in terms[i].decode("utf-8")]
+    ):
+        term = terms[term_index].decode("utf-8")
+        for prefix_length in range(1, min(len(term), max_prefix_length) + 1):
+            prefix_results = results[term[:prefix_length]]
+            for gene_index in term_genes[term_index][: n_results - len(prefix_results)]:
+                prefix_results.append((term_index, gene_index))
+
+    return results
+
+
+def write_gene_search_index(index_path, gene_search_terms, max_prefix_length=AUTOCOMPLETE_PREFIX_LENGTH):
+    """
+    Write a gene search index from an iterable of (gene ID, search terms) tuples, with autocomplete results for
+    prefixes of up to max_prefix_length characters.
+    """
+    term_gene_ids = collections.defaultdict(set)
+    for gene_id, search_terms in gene_search_terms:
+        for search_term in search_terms:
+            term_gene_ids[search_term.encode("utf-8")].add(gene_id)
+
+    gene_ids = sorted({gene_id for genes in term_gene_ids.values() for gene_id in genes})
+    gene_indices = {gene_id: i for i, gene_id in enumerate(gene_ids)}
+    gene_id_width = max((len(gene_id) for gene_id in gene_ids), default=0)
+
+    terms = sorted(term_gene_ids)
+    term_genes = [sorted(gene_indices[gene_id] for gene_id in term_gene_ids[term]) for term in terms]
+    term_offsets = [0]
+    postings_offsets = [0]
+    postings = []
+    for term, genes in zip(terms, term_genes):
+        term_offsets.append(term_offsets[-1] + len(term))
+        postings.extend(genes)
+        postings_offsets.append(len(postings))
+
+    prefix_results = autocomplete_results(terms, term_genes, max_prefix_length)
+    prefixes = sorted(prefix.encode("utf-8") for prefix in prefix_results)
+    prefix_offsets = [0]
+    autocomplete_offsets = [0]
+    for prefix in prefixes:
+        prefix_offsets.append(prefix_offsets[-1] + len(prefix))
+        autocomplete_offsets.append(autocomplete_offsets[-1] + len(prefix_results[prefix.decode("utf-8")]))
+
+    with open(index_path, mode="wb") as index_file:
+        index_file.write(
+            GENE_SEARCH_INDEX_HEADER.pack(
+                GENE_SEARCH_INDEX_MAGIC,
+                len(terms),
+                len(postings),
+                len(gene_ids),
+                gene_id_width,
+                max_prefix_length,
+                len(prefixes),
+                autocomplete_offsets[-1],
+            )
+        )
+        for values in [term_offsets, postings_offsets, postings, prefix_offsets, autocomplete_offsets]:
+            index_file.write(struct.pack(f"<{len(values)}I", *values))
+
+        for prefix in prefixes:
+            for result in prefix_results[prefix.decode("utf-8")]:
+                index_file.write(AUTOCOMPLETE_RESULT.pack(*result))
+
+        for gene_id in gene_ids:
+            index_file.write(gene_id.encode("ascii").ljust(gene_id_width, b"\0"))
+
+        for term in terms:
+            index_file.write(term)
+
+        for prefix in prefixes:
+            index_file.write(prefix)
+
+
+class GeneSearchIndex:
+    """
+    Searches a memory mapped gene search index.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, mode="rb") as index_file:
+            self._index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            self._n_terms,
+            n_postings,
+            n_genes,
+            self._gene_id_width,
+            self.max_prefix_length,
+            self._n_prefixes,
+            n_autocomplete_results,
+        ) = GENE_SEARCH_INDEX_HEADER.unpack_from(self._index)
+        if magic != GENE_SEARCH_INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a gene search index")
+
+        self._term_offsets_start = GENE_SEARCH_INDEX_HEADER.size
+        self._postings_offsets_start = self._term_offsets_start + (self._n_terms + 1) * UINT32.size
+        self._postings_start = self._postings_offsets_start + (self._n_terms + 1) * UINT32.size
+        self._prefix_offsets_start = self._postings_start + n_postings * UINT32.size
+        self._autocomplete_offsets_start = self._prefix_offsets_start + (self._n_prefixes + 1) * UINT32.size
+        self._autocomplete_start = self._autocomplete_offsets_start + (self._n_prefixes + 1) * UINT32.size
+        self._gene_ids_start = self._autocomplete_start + n_autocomplete_results * AUTOCOMPLETE_RESULT.size
+        self._term_data_start = self._gene_ids_start + n_genes * self._gene_id_width
+        self._prefix_data_start = self._term_data_start + self._uint32(self._term_offsets_start, self._n_terms)
+
+    def close(self):
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._n_terms
+
+    def _uint32(self, section_start, i):
+        return UINT32.unpack_from(self._index, section_start + i * UINT32.size)[0]
+
+    def _string(self, offsets_start, data_start, i):
+        start = data_start + self._uint32(offsets_start, i)
+        end = data_start + self._uint32(offsets_start, i + 1)
+        return self._index[start:end]
+
+    def _term(self, i):
+        return self._string(self._term_offsets_start, self._term_data_start, i)
+
+    def _prefix(self, i):
+        return self._string(self._prefix_offsets_start, self._prefix_data_start, i)
+
+    def _gene_id(self, gene_index):
+        start = self._gene_ids_start + gene_index * self._gene_id_width
+        return self._index[start : start + self._gene_id_width].rstrip(b"\0").decode("ascii")
+
+    def _gene_ids(self, i):
+        return [
+            self._gene_id(self._uint32(self._postings_start, posting))
+            for posting in range(
+                self._uint32(self._postings_offsets_start, i), self._uint32(self._postings_offsets_start, i + 1)
+            )
+        ]
+
+    @staticmethod
+    def _lower_bound(key, value, n):
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def get(self, term):
+        """
+        Return the IDs of genes matching a search term, or None if no genes match it.
+        """
+        term = term.encode("utf-8")
+        i = self._lower_bound(self._term, term, self._n_terms)
+        if i < self._n_terms and self._term(i) == term:
+            return self._gene_ids(i)
+
+        return None
+
+    def search(self, prefix, limit=None):
+        """
+        Return a list of (term, gene IDs) for each search term starting with prefix, in order of term.
+        """
+        prefix = prefix.encode("utf-8")
+        results = []
+        i = self._lower_bound(self._term, prefix, self._n_terms)
+        while i < self._n_terms and (limit is None or len(results) < limit):
+            term = self._term(i)
+            if not term.startswith(prefix):
+                break
+
+            results.append((term.decode("utf-8"), self._gene_ids(i)))
+            i += 1
+
+        return results
+
+    def autocomplete(self, prefix):
+        """
+        Return a list of (label, gene ID) autocomplete results for a prefix, or None if the prefix is longer than
+        the prefixes results were precomputed for.
+        """
+        if not prefix or len(prefix) > self.max_prefix_length:
+            return None
+
+        encoded_prefix = prefix.encode("utf-8")
+        i = self._lower_bound(self._prefix, encoded_prefix, self._n_prefixes)
+        if i == self._n_prefixes or self._prefix(i) != encoded_prefix:
+            return []
+
+        results = []
+        for result in range(
+            self._uint32(self._autocomplete_offsets_start, i), self._uint32(self._autocomplete_offsets_start, i + 1)
+        ):
+            term_index, gene_index = AUTOCOMPLETE_RESULT.unpack_from(
+                self._index, self._autocomplete_start + result * AUTOCOMPLETE_RESULT.size
+            )
+            term = self._term(term_index).decode("utf-8")
+            gene_id = self._gene_id(gene_index)
+            n_genes = self._uint32(self._postings_offsets_start, term_index + 1) - self._uint32(
+                self._postings_offsets_start, term_index
+            )
+            results.append((f"{term} ({gene_id})" if n_genes > 1 else term, gene_id))
+
+        return results
+
+
+# Variant index
+#
+# variant_index_{reference genome}.bin maps each variant in any dataset with that reference genome to the genes
+# whose variants files include it, and the datasets that include it for each gene, so that a variant can be found
+# without reading gene files. Records are sorted by chromosome, position, alleles (UTF-8 bytes), and gene ID, so that
+# a variant's records can be found with a binary search of the memory mapped index.
+#
+# Layout (little endian):
+#   header: magic (8 bytes), number of records (uint32), number of genes (uint32), gene ID width (uint32),
+#           dataset names length (uint32)
+#   dataset names: newline separated dataset names (UTF-8)
+#   gene IDs: gene ID (gene ID width bytes, NUL padded) for each gene, sorted
+#   records: chromosome (uint8, index in CHROMOSOMES + 1), 3 bytes padding, position (uint32), alleles offset in
+#            allele data (uint32), alleles length (uint32), gene index (uint32), datasets (uint32 bit set of dataset
+#            indices)
+#   allele data: UTF-8 encoded alleles, as "{ref}-{alt}"
+
+VARIANT_INDEX_MAGIC = b"ERBVAR01"
+VARIANT_INDEX_HEADER = struct.Struct("<8sIIII")
+VARIANT_INDEX_RECORD = struct.Struct("<BxxxIIIII")
+
+CHROMOSOMES = [str(chrom) for chrom in range(1, 23)] + ["X", "Y", "MT"]
+CHROMOSOME_CODES = {**{chrom: code for code, chrom in enumerate(CHROMOSOMES, 1)}, "M": len(CHROMOSOMES)}
+
+
+def variant_index_file(reference_genome):
+    return f"variant_index_{reference_genome}.bin"
+
+
+def parse_variant_id(variant_id):
+    """
+    Return the chromosome code, position, and alleles of a variant ID (chrom-pos-ref-alt), or None if it cannot be
+    parsed.
+    """
+    parts = variant_id.upper().removeprefix("CHR").split("-")
+    if len(parts) != 4 or parts[0] not in CHROMOSOME_CODES or not parts[1].isdigit():
+        return None
+
+    return CHROMOSOME_CODES[parts[0]], int(parts[1]), f"{parts[2]}-{parts[3]}"
+
+
+class VariantIndexWriter:
+    """
+    Writes a variant index from records added in order.
+
+    Allele data is buffered in a temporary file and appended after the records when the index is closed.
+    """
+
+    def __init__(self, index_path, gene_ids, datasets):
+        if len(datasets) > 32:
+            raise ValueError("Variant indices support at most 32 datasets")
+
+        self._gene_ids = sorted(gene_ids)
+        self._gene_indices = {gene_id: i for i, gene_id in enumerate(self._gene_ids)}
+        self._gene_id_width = max((len(gene_id) for gene_id in self._gene_ids), default=0)
+        self._dataset_names = "\n".join(datasets).encode("utf-8")
+        self.n_records = 0
+        self._last_key = None
+        self._alleles_offset = 0
+        self._alleles_length = 0
+
+        self._index_file = open(index_path, mode="wb")  # pylint: disable=consider-using-with
+        self._allele_data = tempfile.TemporaryFile()  # pylint: disable=consider-using-with
+        self._write_header()
+        self._index_file.write(self._dataset_names)
+        for gene_id in self._gene_ids:
+            self._index_file.write(gene_id.encode("ascii").ljust(self._gene_id_width, b"\0"))
+
+    def _write_header(self):
+        self._index_file.write(
+            VARIANT_INDEX_HEADER.pack(
+                VARIANT_INDEX_MAGIC,
+                self.n_records,
+                len(self._gene_ids),
+                self._gene_id_width,
+                len(self._dataset_names),
+            )
+        )
+
+    def add(self, chrom, pos, alleles, gene_id, dataset_indices):
+        """
+        Add a record for a variant (chromosome code, position, and alleles) in a gene, in the given datasets.
+        """
+        alleles = alleles.encode("utf-8")
+        key = (chrom, pos, alleles, gene_id)
+        if self._last_key is not None and key <= self._last_key:
+            raise ValueError("Variant index records must be added in order")
+
+        # Records for the same variant in different genes share allele data
+        if self._last_key is None or self._last_key[:3] != key[:3]:
+            self._alleles_offset = self._allele_data.tell()
+            self._alleles_length = len(alleles)
+            self._allele_data.write(alleles)
+
+        datasets = 0
+        for dataset_index in dataset_indices:
+            datasets |= 1 << dataset_index
+
+        self._index_file.write(
+            VARIANT_INDEX_RECORD.pack(
+                chrom, pos, self._alleles_offset, self._alleles_length, self._gene_indices[gene_id], datasets
+            )
+        )
+        self.n_records += 1
+        self._last_key = key
+
+    def close(self):
+        self._allele_data.seek(0)
+        shutil.copyfileobj(self._allele_data, self._index_file)
+        self._allele_data.close()
+
+        self._index_file.seek(0)
+        self._write_header()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class VariantIndex:
+    """
+    Looks up variants in a memory mapped variant index.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, mode="rb") as index_file:
+            self._index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._n_records, n_genes, self._gene_id_width, dataset_names_length = VARIANT_INDEX_HEADER.unpack_from(
+            self._index
+        )
+        if magic != VARIANT_INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a variant index")
+
+        dataset_names_start = VARIANT_INDEX_HEADER.size
+        self.datasets = (
+            self._index[dataset_names_start : dataset_names_start + dataset_names_length].decode("utf-8").split("\n")
+        )
+        self._gene_ids_start = dataset_names_start + dataset_names_length
+        self._records_start = self._gene_ids_start + n_genes * self._gene_id_width
+        self._allele_data_start = self._records_start + self._n_records * VARIANT_INDEX_RECORD.size
+
+    def close(self):
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._n_records
+
+    def _record(self, i):
+        return VARIANT_INDEX_RECORD.unpack_from(self._index, self._records_start + i * VARIANT_INDEX_RECORD.size)
+
+    def _key(self, i):
+        chrom, pos, alleles_offset, alleles_length, _, _ = self._record(i)
+        alleles_start = self._allele_data_start + alleles_offset
+        return chrom, pos, self._index[alleles_start : alleles_start + alleles_length]
+
+    def lookup(self, variant_id):
+        """
+        Return a list of (gene ID, dataset names) for each gene that a variant is in.
+        """
+        variant = parse_variant_id(variant_id)
+        if variant is None:
+            return []
+
+        chrom, pos, alleles = variant
+        key = (chrom, pos, alleles.encode("utf-8"))
+        lo, hi = 0, self._n_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        results = []
+        while lo < self._n_records and self._key(lo) == key:
+            *_, gene_index, datasets = self._record(lo)
+            gene_id_start = self._gene_ids_start + gene_index * self._gene_id_width
+            gene_id = self._index[gene_id_start : gene_id_start + self._gene_id_width].rstrip(b"\0").decode("ascii")
+            results.append((gene_id, [dataset for i, dataset in enumerate(self.datasets) if datasets & (1 << i)]))
+            lo += 1
+
+        return results
+
+
+# Gene interval index
+#
+# gene_intervals_{reference genome}.bin lists the interval of each gene (1-based, inclusive) on each chromosome, so
+# that genes overlapping a region can be found in O(log n + k) time from the memory mapped index. Intervals on each
+# chromosome are sorted by start and form an implicit interval tree, as in cgranges
+# (https://github.com/lh3/cgranges): the interval at index i is a node at level equal to the number of trailing 1
+# bits of i, and each interval's max stop is the largest stop of any interval in its subtree.
+#
+# Layout (little endian):
+#   header: magic (8 bytes), number of intervals (uint32), gene ID width (uint32)
+#   chromosomes: index of first interval (uint32) and number of intervals (uint32) for each chromosome in CHROMOSOMES
+#   intervals: start (uint32), stop (uint32), max stop (uint32) for each interval
+#   gene IDs: gene ID (gene ID width bytes, NUL padded) for each interval
+
+GENE_INTERVAL_INDEX_MAGIC = b"ERBGIV01"
+GENE_INTERVAL_INDEX_HEADER = struct.Struct("<8sII")
+GENE_INTERVAL_INDEX_CHROMOSOME = struct.Struct("<II")
+GENE_INTERVAL_INDEX_INTERVAL = struct.Struct("<III")
+
+
+def gene_interval_index_file(reference_genome):
+    return f"gene_intervals_{reference_genome}.bin"
+
+
+def parse_region(region):
+    """
+    Return the chromosome, start, and stop of a region (chrom:start-stop or chrom:pos), or None if it cannot be
+    parsed.
+    """
+    chrom, _, positions = region.upper().removeprefix("CHR").replace(",", "").partition(":")
+    start, _, stop = positions.partition("-")
+    stop = stop or start
+    if chrom not in CHROMOSOME_CODES or not start.isdigit() or not stop.isdigit() or int(start) > int(stop):
+        return None
+
+    return chrom, int(start), int(stop)
+
+
+def _interval_max_stops(stops):
+    """
+    Return the max stop of each node of the implicit interval tree for intervals sorted by start.
+    """
+    n = len(stops)
+    max_stops = list(stops)
+    if n == 0:
+        return max_stops
+
+    # The last node at level 0 and its max stop, used for nodes whose right subtree is beyond the end of the array
+    last_i = (n - 1) & ~1
+    last = max_stops[last_i]
+
+    k = 1
+    while 1 << k <= n:
+        x = 1 << (k - 1)
+        for i in range((x << 1) - 1, n, x << 2):
+            left = max_stops[i - x]
+            right = max_stops[i + x] if i + x < n else last
+            max_stops[i] = max(stops[i], left, right)
+
+        last_i = last_i - x if (last_i >> k) & 1 else last_i + x
+        if last_i < n and max_stops[last_i] > last:
+            last = max_stops[last_i]
+
+        k += 1
+
+    return max_stops
+
+
+def write_gene_interval_index(index_path, gene_intervals):
+    """
+    Write a gene interval index from an iterable of (gene ID, chromosome, start, stop) tuples.
+
+    Genes on chromosomes not in CHROMOSOMES are skipped.
+    """
+    intervals = sorted(
+        (CHROMOSOME_CODES[chrom.removeprefix("chr")], start, stop, gene_id)
+        for gene_id, chrom, start, stop in gene_intervals
+        if chrom is not None and chrom.removeprefix("chr") in CHROMOSOME_CODES and start is not None
+    )
+    gene_id_width = max((len(gene_id) for *_, gene_id in intervals), default=0)
+
+    chromosome_intervals = collections.defaultdict(list)
+    for chrom, start, stop, _ in intervals:
+        chromosome_intervals[chrom].append((start, stop))
+
+    with open(index_path, mode="wb") as index_file:
+        index_file.write(GENE_INTERVAL_INDEX_HEADER.pack(GENE_INTERVAL_INDEX_MAGIC, len(intervals), gene_id_width))
+
+        first_interval = 0
+        for chrom in range(1, len(CHROMOSOMES) + 1):
+            n_intervals = len(chromosome_intervals[chrom])
+            index_file.write(GENE_INTERVAL_INDEX_CHROMOSOME.pack(first_interval, n_intervals))
+            first_interval += n_intervals
+
+        for chrom in range(1, len(CHROMOSOMES) + 1):
+            starts_stops = chromosome_intervals[chrom]
+            max_stops = _interval_max_stops([stop for _, stop in starts_stops])
+            for (start, stop), max_stop in zip(starts_stops, max_stops):
+                index_file.write(GENE_INTERVAL_INDEX_INTERVAL.pack(start, stop, max_stop))
+
+        for *_, gene_id in intervals:
+            index_file.write(gene_id.encode("ascii").ljust(gene_id_width, b"\0"))
+
+
+class GeneIntervalIndex:
+    """
+    Finds genes overlapping a region using a memory mapped gene interval index.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, mode="rb") as index_file:
+            self._index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._n_intervals, self._gene_id_width = GENE_INTERVAL_INDEX_HEADER.unpack_from(self._index)
+        if magic != GENE_INTERVAL_INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a gene interval index")
+
+        self._chromosomes_start = GENE_INTERVAL_INDEX_HEADER.size
+        self._intervals_start = self._chromosomes_start + len(CHROMOSOMES) * GENE_INTERVAL_INDEX_CHROMOSOME.size
+        self._gene_ids_start = self._intervals_start + self._n_intervals * GENE_INTERVAL_INDEX_INTERVAL.size
+
+    def close(self):
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._n_intervals
+
+    def _interval(self, i):
+        return GENE_INTERVAL_INDEX_INTERVAL.unpack_from(
+            self._index, self._intervals_start + i * GENE_INTERVAL_INDEX_INTERVAL.size
+        )
+
+    def _gene_id(self, i):
+        start = self._gene_ids_start + i * self._gene_id_width
+        return self._index[start : start + self._gene_id_width].rstrip(b"\0").decode("ascii")
+
+    def overlapping(self, chrom, start, stop):
+        """
+        Return a list of (gene ID, start, stop) for each gene overlapping a region, in order of start.
+        """
+        chrom = chrom.removeprefix("chr")
+        if chrom not in CHROMOSOME_CODES:
+            return []
+
+        offset, n = GENE_INTERVAL_INDEX_CHROMOSOME.unpack_from(
+            self._index, self._chromosomes_start + (CHROMOSOME_CODES[chrom] - 1) * GENE_INTERVAL_INDEX_CHROMOSOME.size
+        )
+        if n == 0:
+            return []
+
+        def interval(i):
+            return self._interval(offset + i)
+
+        overlapping_indices = []
+        root_level = n.bit_length() - 1
+        # Stack of (level, node index, whether left subtree has been visited)
+        stack = [(root_level, (1 << root_level) - 1, False)]
+        while stack:
+            level, i, visited_left = stack.pop()
+            if level <= 3:
+                # Small subtree, so check every interval in it
+                first = i >> level << level
+                for j in range(first, min(first + (1 << (level + 1)) - 1, n)):
+                    interval_start, interval_stop, _ = interval(j)
+                    if interval_start > stop:
+                        break
+
+                    if start <= interval_stop:
+                        overlapping_indices.append(j)
+            elif not visited_left:
+                stack.append((level, i, True))
+                left = i - (1 << (level - 1))
+                # Nodes beyond the end of the array may still have children within it
+                if left >= n or interval(left)[2] >= start:
+                    stack.append((level - 1, left, False))
+            elif i < n:
+                interval_start, interval_stop, _ = interval(i)
+                if interval_start <= stop:
+                    if start <= interval_stop:
+                        overlapping_indices.append(i)
+
+                    stack.append((level - 1, i + (1 << (level - 1)), False))
+
+        results = []
+        for i in overlapping_indices:
+            interval_start, interval_stop, _ = interval(i)
+            results.append((self._gene_id(offset + i), interval_start, interval_stop))
+
+        return results
+
+
+# Gene availability
+#
+# availability.bin records which gene and variants files exist in a results directory, and the number of variants in
+# each variants file, so that they can be checked without touching the file system. Each gene has a row of bits, one
+# for each column: gene files for each reference genome, followed by variants files for each dataset.
+#
+# Layout (little endian):
+#   header: magic (8 bytes), number of genes (uint32), gene ID width (uint32), number of reference genomes (uint32),
+#           number of datasets (uint32), column names length (uint32)
+#   column names: newline separated reference genome names followed by dataset names (UTF-8)
+#   gene IDs: gene ID (gene ID width bytes, NUL padded) for each gene, sorted
+#   presence: (number of columns + 7) // 8 bytes for each gene, with bit i (least significant first) set if the file
+#             for column i exists
+#   variant counts: number of variants (uint32) for each gene and dataset, 0 if there is no variants file
+
+AVAILABILITY_FILE = "availability.bin"
+AVAILABILITY_MAGIC = b"ERBAVL01"
+AVAILABILITY_HEADER = struct.Struct("<8sIIIII")
+
+
+def write_gene_availability(path, reference_genomes, datasets, genes):
+    """
+    Write gene availability from a map of gene ID to (reference genomes with gene files, map of dataset to number
+    of variants for datasets with variants files).
+    """
+    gene_ids = sorted(genes)
+    gene_id_width = max((len(gene_id) for gene_id in gene_ids), default=0)
+    column_names = "\n".join([*reference_genomes, *datasets]).encode("utf-8")
+    presence_width = (len(reference_genomes) + len(datasets) + 7) // 8
+
+    with open(path, mode="wb") as availability_file:
+        availability_file.write(
+            AVAILABILITY_HEADER.pack(
+                AVAILABILITY_MAGIC,
+                len(gene_ids),
+                gene_id_width,
+                len(reference_genomes),
+                len(datasets),
+                len(column_names),
+            )
+        )
+        availability_file.write(column_names)
+
+        for gene_id in gene_ids:
+            availability_file.write(gene_id.encode("ascii").ljust(gene_id_width, b"\0"))
+
+        for gene_id in gene_ids:
+            gene_reference_genomes, variant_counts = genes[gene_id]
+            columns = [reference_genome in gene_reference_genomes for reference_genome in reference_genomes]
+            columns.extend(dataset in variant_counts for dataset in datasets)
+            presence = sum(1 << i for i, present in enumerate(columns) if present)
+            availability_file.write(presence.to_bytes(presence_width, "little"))
+
+        for gene_id in gene_ids:
+            _, variant_counts = genes[gene_id]
+            availability_file.write(
+                struct.pack(f"<{len(datasets)}I", *(variant_counts.get(dataset, 0) for dataset in datasets))
+            )
+
+
+class GeneAvailability:
+    """
+    Reads memory mapped gene availability.
+    """
+
+    def __init__(self, path):
+        with open(path, mode="rb") as availability_file:
+            self._data = mmap.mmap(availability_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            self._n_genes,
+            self._gene_id_width,
+            n_reference_genomes,
+            n_datasets,
+            column_names_length,
+        ) = AVAILABILITY_HEADER.unpack_from(self._data)
+        if magic != AVAILABILITY_MAGIC:
+            raise ValueError(f"{path} is not a gene availability file")
+
+        column_names_start = AVAILABILITY_HEADER.size
+        column_names = self._data[column_names_start : column_names_start + column_names_length].decode("utf-8")
+        column_names = column_names.split("\n") if column_names else []
+        self.reference_genomes = column_names[:n_reference_genomes]
+        self.datasets = column_names[n_reference_genomes : n_reference_genomes + n_datasets]
+
+        self._presence_width = (len(column_names) + 7) // 8
+        self._gene_ids_start = column_names_start + column_names_length
+        self._presence_start = self._gene_ids_start + self._n_genes * self._gene_id_width
+        self._variant_counts_start = self._presence_start + self._n_genes * self._presence_width
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._n_genes
+
+    def _gene_id(self, i):
+        start = self._gene_ids_start + i * self._gene_id_width
+        return self._data[start : start + self._gene_id_width].rstrip(b"\0").decode("ascii")
+
+    def _gene(self, i):
+        presence_start = self._presence_start + i * self._presence_width
+        presence = int.from_bytes(self._data[presence_start : presence_start + self._presence_width], "little")
+        variant_counts = struct.unpack_from(
+            f"<{len(self.datasets)}I", self._data, self._variant_counts_start + i * len(self.datasets) * 4
+        )
+
+        reference_genomes = [
+            reference_genome for j, reference_genome in enumerate(self.reference_genomes) if presence & (1 << j)
+        ]
+        dataset_variant_counts = {
+            dataset: variant_count
+            for j, (dataset, variant_count) in enumerate(zip(self.datasets, variant_counts))
+            if presence & (1 << (len(self.reference_genomes) + j))
+        }
+        return reference_genomes, dataset_variant_counts
+
+    def get(self, gene_id):
+        """
+        Return the reference genomes with gene files for a gene and a map of dataset to number of variants for
+        datasets with variants files, or None if no files exist for the gene.
+        """
+        key = gene_id.encode("ascii").ljust(self._gene_id_width, b"\0")
+        lo, hi = 0, self._n_genes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._gene_ids_start + mid * self._gene_id_width
+            if self._data[start : start + self._gene_id_width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self._n_genes and self._gene_id(lo) == gene_id:
+            return self._gene(lo)
+
+        return None
+
+    def genes(self):
+        """
+        Return a map of each gene ID to its availability, as returned by get.
+        """
+        return {self._gene_id(i): self._gene(i) for i in range(self._n_genes)}
+
+
+# Size reports
+
+PRECOMPRESSED_FILE_ENCODINGS = {".gz": "gzip", ".br": "brotli"}
+
+
+def classify_file(relative_path):
+    """
+    Return the kind of a file in a results directory, the dataset it belongs to (if any), and its encoding (None
+    if uncompressed).
+
+    Kinds are gene, variants, variant_window, variant_group, variant_detail, results, results_pages, and other.
+    """
+    path, extension = os.path.splitext(relative_path)
+    encoding = PRECOMPRESSED_FILE_ENCODINGS.get(extension)
+    if not encoding:
+        path = relative_path
+
+    directory, file_name = os.path.split(path)
+    name_parts = file_name.removesuffix(".json").split("_")
+
+    if directory == "results" and file_name.endswith(".json"):
+        return "results", name_parts[0], encoding
+
+    if directory.startswith("results/") and file_name.endswith(".json"):
+        return "results_pages", directory.split("/")[1], encoding
+
+    if directory.startswith("genes/") and file_name.endswith(".json"):
+        if len(name_parts) == 2:
+            return "gene", None, encoding
+
+        if len(name_parts) in (4, 5) and name_parts[2] == "variants" and name_parts[-1] == "detail":
+            return "variant_detail", name_parts[1], encoding
+
+        if len(name_parts) == 3 and name_parts[2] == "variants":
+            return "variants", name_parts[1], encoding
+
+        if len(name_parts) == 4 and name_parts[2] == "variants" and name_parts[3].startswith("g"):
+            return "variant_group", name_parts[1], encoding
+
+        if len(name_parts) == 4 and name_parts[2] == "variants":
+            return "variant_window", name_parts[1], encoding
+
+    return "other", None, encoding
+
+
+def size_histogram_bucket(size):
+    """
+    Return the upper bound of the power of 2 size range that a size falls in, e.g. 4096 for 2049-4096 bytes.
+    """
+    return 1 << max(size - 1, 0).bit_length()
+
+
+class SizeReport:
+    """
+    Summarizes the sizes of files in a results directory.
+    """
+
+    def __init__(self, top_n=10, block_size=4096):
+        self.top_n = top_n
+        self.block_size = block_size
+        self.kinds = collections.defaultdict(lambda: {"files": 0, "bytes": 0})
+        self.datasets = collections.defaultdict(lambda: {"files": 0, "bytes": 0})
+        self.histograms = collections.defaultdict(collections.Counter)
+        self.gene_variants_bytes = collections.defaultdict(collections.Counter)
+        self.shard_files = collections.Counter()
+        self.total_bytes = 0
+        self.allocated_bytes = 0
+
+    def add_disk_usage(self, size):
+        self.total_bytes += size
+        self.allocated_bytes += -(-size // self.block_size) * self.block_size
+
+    def add(self, relative_path, size, in_pack=False):
+        """
+        Count a file. Files in packs count towards disk usage through the size of their pack instead.
+        """
+        kind, dataset, encoding = classify_file(relative_path)
+        kind_key = f"{kind}.{encoding}" if encoding else kind
+
+        self.kinds[kind_key]["files"] += 1
+        self.kinds[kind_key]["bytes"] += size
+        self.histograms[kind_key][size_histogram_bucket(size)] += 1
+
+        if dataset and not encoding:
+            self.datasets[dataset]["files"] += 1
+            self.datasets[dataset]["bytes"] += size
+            if kind in ("variants", "variant_window", "variant_group", "variant_detail"):
+                gene_id = os.path.basename(relative_path).split("_")[0]
+                self.gene_variants_bytes[dataset][gene_id] += size
+
+        if relative_path.startswith("genes/"):
+            self.shard_files[os.path.dirname(relative_path)] += 1
+
+        if not in_pack:
+            self.add_disk_usage(size)
+
+    def report(self):
+        shard_file_counts = sorted(self.shard_files.values())
+        return {
+            "total_bytes": self.total_bytes,
+            "projected_disk_bytes": self.allocated_bytes,
+            "block_size": self.block_size,
+            "kinds": dict(sorted(self.kinds.items())),
+            "datasets": dict(sorted(self.datasets.items())),
+            "size_histograms": {
+                kind: {str(bucket): count for bucket, count in sorted(histogram.items())}
+                for kind, histogram in sorted(self.histograms.items())
+            },
+            "largest_genes": {
+                dataset: [
+                    {"gene_id": gene_id, "variants_bytes": size} for gene_id, size in sizes.most_common(self.top_n)
+                ]
+                for dataset, sizes in sorted(self.gene_variants_bytes.items())
+            },
+            "gene_shards": {
+                "shards": len(shard_file_counts),
+                "min_files": shard_file_counts[0] if shard_file_counts else 0,
+                "median_files": shard_file_counts[len(shard_file_counts) // 2] if shard_file_counts else 0,
+                "max_files": shard_file_counts[-1] if shard_file_counts else 0,
+                "files": {os.path.basename(shard): count for shard, count in sorted(self.shard_files.items())},
+            },
+        }
+
+
+def results_directory_size_report(results_directory, top_n=10, block_size=4096):
+    """
+    Summarize the sizes of files in a results directory, including files in packs.
+    """
+    report = SizeReport(top_n=top_n, block_size=block_size)
+    for root, _, file_names in os.walk(results_directory):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(path, results_directory)
+
+            if file_name.endswith(".pack"):
+                report.add_disk_usage(os.path.getsize(path))
+
+            elif file_name.endswith(".idx"):
+                report.add_disk_usage(os.path.getsize(path))
+
+                pack = relative_path.removesuffix(".idx")
+                with PackReader(f"{results_directory}/{pack}") as reader:
+                    for key, _, length in reader.entries():
+                        report.add(f"{pack}/{key}.json", length, in_pack=True)
+
+            else:
+                report.add(relative_path, os.path.getsize(path))
+
+    return report.report()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    read_parser = subparsers.add_parser("read", help="Print a file from a results directory with packed gene files")
+    read_parser.add_argument("results_directory")
+    read_parser.add_argument(
+        "path", help="Path of file relative to results directory, e.g. genes/174/ENSG..._GRCh37.json"
+    )
+
+    sizes_parser = subparsers.add_parser(
+        "sizes", help="Print a JSON report of the sizes of files in a results directory, for sizing disks"
+    )
+    sizes_parser.add_argument("results_directory")
+    sizes_parser.add_argument(
+        "--top", type=int, default=10, help="Number of genes with the largest variants files to list for each dataset"
+    )
+    sizes_parser.add_argument(
+        "--block-size", type=int, default=4096, help="File system block size used to project disk usage"
+    )
+
+    verify_parser = subparsers.add_parser(
+        "verify", help="Check the sizes and content hashes of files in a results directory against its manifest"
+    )
+    verify_parser.add_argument("results_directory")
+    verify_parser.add_argument(
+        "--workers", type=int, help="Number of files to hash in parallel (defaults to the number of CPUs)"
+    )
+
+    search_parser = subparsers.add_parser("search", help="Search a results directory's gene search index")
+    search_parser.add_argument("results_directory")
+    search_parser.add_argument("prefix", help="Search term prefix, e.g. PCSK")
+    search_parser.add_argument("--limit", type=int, default=10, help="Maximum number of search terms to print")
+    search_parser.add_argument(
+        "--autocomplete", action="store_true", help="Print precomputed autocomplete results for the prefix"
+    )
+
+    variant_parser = subparsers.add_parser("variant", help="Look up the genes and datasets containing a variant")
+    variant_parser.add_argument("results_directory")
+    variant_parser.add_argument("variant_id", help="Variant ID, e.g. 1-55516888-G-GA")
+    variant_parser.add_argument("--reference-genome", choices=["GRCh37", "GRCh38"], default="GRCh37")
+
+    genes_parser = subparsers.add_parser("genes", help="List genes overlapping a region")
+    genes_parser.add_argument("results_directory")
+    genes_parser.add_argument("region", help="Region as chrom:start-stop or chrom:pos, e.g. 16:50700000-50800000")
+    genes_parser.add_argument("--reference-genome", choices=["GRCh37", "GRCh38"], default="GRCh37")
+
+    availability_parser = subparsers.add_parser(
+        "availability", help="Print which gene and variants files exist for a gene, with numbers of variants"
+    )
+    availability_parser.add_argument("results_directory")
+    availability_parser.add_argument("gene_id")
+
+    args = parser.parse_args()
+
+    if args.command == "availability":
+        with GeneAvailability(f"{args.results_directory}/{AVAILABILITY_FILE}") as availability:
+            gene_availability = availability.get(args.gene_id)
+
+        if gene_availability is None:
+            print(f"{args.gene_id} not found", file=sys.stderr)
+            return 1
+
+        reference_genomes, variant_counts = gene_availability
+        print(json.dumps({"reference_genomes": reference_genomes, "variant_counts": variant_counts}, indent=2))
+
+    if args.command == "genes":
+        region = parse_region(args.region)
+        if region is None:
+            print(f"Invalid region {args.region}", file=sys.stderr)
+            return 1
+
+        with GeneIntervalIndex(f"{args.results_directory}/{gene_interval_index_file(args.reference_genome)}") as index:
+            for gene_id, start, stop in index.overlapping(*region):
+                print(f"{gene_id}\t{start}\t{stop}")
+
+    if args.command == "variant":
+        with VariantIndex(f"{args.results_directory}/{variant_index_file(args.reference_genome)}") as index:
+            results = index.lookup(args.variant_id)
+
+        if not results:
+            print(f"{args.variant_id} not found", file=sys.stderr)
+            return 1
+
+        for gene_id, datasets in results:
+            print(f"{gene_id}\t{','.join(datasets)}")
+
+    if args.command == "search":
+        with GeneSearchIndex(f"{args.results_directory}/{GENE_SEARCH_INDEX_FILE}") as index:
+            if args.autocomplete:
+                results = index.autocomplete(args.prefix.upper())
+                if results is None:
+                    print(
+                        f"Autocomplete results are only stored for up to {index.max_prefix_length} characters",
+                        file=sys.stderr,
+                    )
+                    return 1
+
+                for label, gene_id in results:
+                    print(f"{label}\t{gene_id}")
+            else:
+                for term, gene_ids in index.search(args.prefix.upper(), limit=args.limit):
+                    print(f"{term}\t{','.join(gene_ids)}")
+
+    if args.command == "verify":
+        problems = verify_results_directory(args.results_directory, workers=args.workers)
+        for relative_path, problem in sorted(problems.items()):
+            print(f"{relative_path}: {problem}", file=sys.stderr)
+
+        if problems:
+            print(f"{len(problems):,} files failed verification", file=sys.stderr)
+            return 1
+
+        print(f"Verified {len(read_manifest(args.results_directory)['files']):,} files")
+
+    if args.command == "sizes":
+        report = results_directory_size_report(args.results_directory, top_n=args.top, block_size=args.block_size)
+        print(json.dumps(report, indent=2))
+
+    if args.command == "read":
+        data = read_packed_file(args.results_directory, args.path)
+        if data is None:
+            print(f"{args.path} not found", file=sys.stderr)
+            return 1
+
+        sys.stdout.buffer.write(data)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
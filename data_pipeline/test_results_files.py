@@ -0,0 +1,284 @@
+import collections
+import random
+
+import pytest
+
+from results_files import (
+    GeneAvailability,
+    GeneIntervalIndex,
+    GeneSearchIndex,
+    PackReader,
+    VariantIndex,
+    VariantIndexWriter,
+    append_to_pack,
+    classify_file,
+    collation_key,
+    pack_location,
+    parse_region,
+    parse_variant_id,
+    read_packed_file,
+    results_directory_size_report,
+    size_histogram_bucket,
+    write_gene_availability,
+    write_gene_interval_index,
+    write_gene_search_index,
+    write_pack_index,
+)
+
+
+def test_pack_location():
+    assert pack_location("genes/174/ENSG00000169174_GRCh37.json") == ("genes/174", "ENSG00000169174_GRCh37")
+    assert pack_location("genes/174/ENSG00000169174_asc_variants.json") == (
+        "genes/174",
+        "ENSG00000169174_asc_variants",
+    )
+
+
+def test_packed_files(tmp_path):
+    (tmp_path / "genes").mkdir()
+
+    files = {
+        "genes/174/ENSG00000169174_GRCh37.json": b'{"gene":{"gene_id":"ENSG00000169174"}}',
+        "genes/174/ENSG00000169174_asc_variants.json": b'{"variants":[]}',
+        "genes/174/ENSG00000000174_GRCh38.json": b'{"gene":{"gene_id":"ENSG00000000174"}}',
+    }
+
+    entries = []
+    for relative_path, data in files.items():
+        pack, key = pack_location(relative_path)
+        offset = append_to_pack(f"{tmp_path}/{pack}.pack", data)
+        entries.append((key, offset, len(data)))
+
+    write_pack_index(f"{tmp_path}/genes/174.idx", entries)
+
+    for relative_path, data in files.items():
+        assert read_packed_file(str(tmp_path), relative_path) == data
+
+    assert read_packed_file(str(tmp_path), "genes/174/ENSG00000169174_GRCh38.json") is None
+    assert read_packed_file(str(tmp_path), "genes/175/ENSG00000000175_GRCh38.json") is None
+
+    with PackReader(f"{tmp_path}/genes/174") as reader:
+        assert len(reader) == 3
+        assert reader.keys() == sorted(reader.keys())
+
+
+def test_classify_file():
+    assert classify_file("genes/174/ENSG00000169174_GRCh37.json") == ("gene", None, None)
+    assert classify_file("genes/174/ENSG00000169174_asc_variants.json.gz") == ("variants", "asc", "gzip")
+    assert classify_file("genes/174/ENSG00000169174_asc_variants_w2.json") == ("variant_window", "asc", None)
+    assert classify_file("genes/174/ENSG00000169174_asc_variants_g1.json") == ("variant_group", "asc", None)
+    assert classify_file("genes/174/ENSG00000169174_asc_variants_detail.json") == ("variant_detail", "asc", None)
+    assert classify_file("genes/174/ENSG00000169174_asc_variants_w2_detail.json.gz") == (
+        "variant_detail",
+        "asc",
+        "gzip",
+    )
+    assert classify_file("results/asc.json.br") == ("results", "asc", "brotli")
+    assert classify_file("results/asc/0/12.json") == ("results_pages", "asc", None)
+    assert classify_file("results/asc/index.json") == ("results_pages", "asc", None)
+    assert classify_file("metadata.json") == ("other", None, None)
+
+
+def test_size_histogram_bucket():
+    assert [size_histogram_bucket(size) for size in [0, 1, 2, 3, 4096, 4097]] == [1, 1, 2, 4, 4096, 8192]
+
+
+def test_results_directory_size_report(tmp_path):
+    files = {
+        "metadata.json": b"{}",
+        "results/asc.json": b"x" * 100,
+        "genes/174/ENSG00000169174_GRCh37.json": b"x" * 10,
+        "genes/174/ENSG00000169174_asc_variants.json": b"x" * 5000,
+        "genes/174/ENSG00000169174_asc_variants.json.gz": b"x" * 50,
+        "genes/175/ENSG00000000175_asc_variants.json": b"x" * 20,
+        "genes/175/ENSG00000000175_ibd_variants.json": b"x" * 30,
+    }
+    for relative_path, data in files.items():
+        (tmp_path / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / relative_path).write_bytes(data)
+
+    report = results_directory_size_report(str(tmp_path), top_n=1)
+
+    assert report["total_bytes"] == sum(len(data) for data in files.values())
+    assert report["projected_disk_bytes"] == 4096 * 8
+    assert report["kinds"]["variants"] == {"files": 3, "bytes": 5050}
+    assert report["kinds"]["variants.gzip"] == {"files": 1, "bytes": 50}
+    assert report["datasets"]["asc"] == {"files": 3, "bytes": 5120}
+    assert report["size_histograms"]["variants"] == {"32": 2, "8192": 1}
+    assert report["largest_genes"] == {
+        "asc": [{"gene_id": "ENSG00000169174", "variants_bytes": 5000}],
+        "ibd": [{"gene_id": "ENSG00000000175", "variants_bytes": 30}],
+    }
+    assert report["gene_shards"] == {
+        "shards": 2,
+        "min_files": 2,
+        "median_files": 3,
+        "max_files": 3,
+        "files": {"174": 3, "175": 2},
+    }
+
+
+def test_gene_search_index(tmp_path):
+    write_gene_search_index(
+        f"{tmp_path}/gene_search_index.bin",
+        [
+            ("ENSG00000169174", ["PCSK9", "NARC1", "FH3"]),
+            ("ENSG00000134243", ["SORT1"]),
+            ("ENSG00000000003", ["PCSK9X", "FH3"]),
+            ("ENSG00000000004", []),
+        ],
+    )
+
+    with GeneSearchIndex(f"{tmp_path}/gene_search_index.bin") as index:
+        assert len(index) == 5
+        assert index.get("PCSK9") == ["ENSG00000169174"]
+        assert index.get("FH3") == ["ENSG00000000003", "ENSG00000169174"]
+        assert index.get("PCSK") is None
+        assert index.get("ZZZ") is None
+        assert index.search("PCSK") == [("PCSK9", ["ENSG00000169174"]), ("PCSK9X", ["ENSG00000000003"])]
+        assert index.search("PCSK", limit=1) == [("PCSK9", ["ENSG00000169174"])]
+        assert index.search("S") == [("SORT1", ["ENSG00000134243"])]
+        assert index.search("X") == []
+        assert [term for term, _ in index.search("")] == ["FH3", "NARC1", "PCSK9", "PCSK9X", "SORT1"]
+
+        assert index.max_prefix_length == 3
+        assert index.autocomplete("F") == [
+            ("FH3 (ENSG00000000003)", "ENSG00000000003"),
+            ("FH3 (ENSG00000169174)", "ENSG00000169174"),
+        ]
+        assert index.autocomplete("PCS") == [("PCSK9", "ENSG00000169174"), ("PCSK9X", "ENSG00000000003")]
+        assert index.autocomplete("X") == []
+        assert index.autocomplete("PCSK") is None
+
+
+def test_collation_key():
+    assert sorted("B1a-A.0b", key=collation_key) == ["-", ".", "0", "1", "a", "A", "b", "B"]
+
+
+def trie_search(gene_search_terms, query):
+    # Search results as returned by the server's PrefixTrie and /api/search
+    term_gene_ids = collections.defaultdict(list)
+    for gene_id, search_terms in gene_search_terms:
+        for search_term in search_terms:
+            term_gene_ids[search_term].append(gene_id)
+
+    results = []
+    for term in sorted(term_gene_ids, key=lambda term: [collation_key(char) for char in term]):
+        if term.startswith(query):
+            gene_ids = term_gene_ids[term]
+            if len(gene_ids) > 1:
+                results.extend((f"{term} ({gene_id})", gene_id) for gene_id in gene_ids)
+            else:
+                results.append((term, gene_ids[0]))
+
+    return results[:5]
+
+
+def test_gene_search_autocomplete(tmp_path):
+    random.seed(0)
+    gene_search_terms = [
+        (
+            f"ENSG{i:011d}",
+            sorted({"".join(random.choices("AB1-.", k=random.randint(1, 4))) for _ in range(random.randint(0, 3))}),
+        )
+        for i in range(200)
+    ]
+    write_gene_search_index(f"{tmp_path}/gene_search_index.bin", gene_search_terms, max_prefix_length=2)
+
+    with GeneSearchIndex(f"{tmp_path}/gene_search_index.bin") as index:
+        for query in ["A", "B", "1", "-", ".", "AB", "B-", "1.", "..", "AA"]:
+            assert index.autocomplete(query) == trie_search(gene_search_terms, query), query
+
+
+def test_parse_variant_id():
+    assert parse_variant_id("1-55516888-G-GA") == (1, 55516888, "G-GA")
+    assert parse_variant_id("chrX-100-A-T") == (23, 100, "A-T")
+    assert parse_variant_id("M-100-A-T") == (25, 100, "A-T")
+    assert parse_variant_id("PCSK9") is None
+    assert parse_variant_id("1-abc-A-T") is None
+
+
+def test_variant_index(tmp_path):
+    with VariantIndexWriter(
+        f"{tmp_path}/variant_index_GRCh37.bin", ["ENSG00000169174", "ENSG00000000001"], ["SCHEMA", "ASC", "Epi25"]
+    ) as writer:
+        writer.add(1, 100, "A-T", "ENSG00000169174", [0])
+        writer.add(1, 100, "A-TT", "ENSG00000000001", [1, 2])
+        writer.add(1, 100, "A-TT", "ENSG00000169174", [1])
+        writer.add(2, 50, "G-C", "ENSG00000000001", [0, 1, 2])
+
+        with pytest.raises(ValueError):
+            writer.add(1, 200, "A-T", "ENSG00000169174", [0])
+
+    with VariantIndex(f"{tmp_path}/variant_index_GRCh37.bin") as index:
+        assert len(index) == 4
+        assert index.datasets == ["SCHEMA", "ASC", "Epi25"]
+        assert index.lookup("1-100-A-T") == [("ENSG00000169174", ["SCHEMA"])]
+        assert index.lookup("1-100-A-TT") == [("ENSG00000000001", ["ASC", "Epi25"]), ("ENSG00000169174", ["ASC"])]
+        assert index.lookup("2-50-G-C") == [("ENSG00000000001", ["SCHEMA", "ASC", "Epi25"])]
+        assert index.lookup("1-100-A-G") == []
+        assert index.lookup("3-100-A-T") == []
+        assert index.lookup("not-a-variant") == []
+
+
+def test_parse_region():
+    assert parse_region("16:50700000-50800000") == ("16", 50700000, 50800000)
+    assert parse_region("chr16:50,700,000") == ("16", 50700000, 50700000)
+    assert parse_region("x:1-2") == ("X", 1, 2)
+    assert parse_region("16:2-1") is None
+    assert parse_region("PCSK9") is None
+
+
+def test_gene_interval_index(tmp_path):
+    random.seed(0)
+    gene_intervals = []
+    for i in range(500):
+        start = random.randint(1, 100_000)
+        gene_intervals.append(
+            (f"ENSG{i:011d}", random.choice(["1", "chr2", "X"]), start, start + random.choice([0, 100, 1000, 20_000]))
+        )
+    gene_intervals.append(("ENSG99999999999", None, None, None))
+
+    write_gene_interval_index(f"{tmp_path}/gene_intervals_GRCh38.bin", gene_intervals)
+
+    with GeneIntervalIndex(f"{tmp_path}/gene_intervals_GRCh38.bin") as index:
+        assert len(index) == 500
+        for _ in range(200):
+            chrom = random.choice(["1", "2", "X", "Y"])
+            start = random.randint(1, 120_000)
+            stop = start + random.choice([0, 10, 5000])
+
+            expected = sorted(
+                (gene_start, gene_stop, gene_id)
+                for gene_id, gene_chrom, gene_start, gene_stop in gene_intervals
+                if gene_chrom is not None
+                and gene_chrom.removeprefix("chr") == chrom
+                and gene_start <= stop
+                and start <= gene_stop
+            )
+            results = index.overlapping(chrom, start, stop)
+            assert sorted((gene_start, gene_stop, gene_id) for gene_id, gene_start, gene_stop in results) == expected
+            assert [gene_start for _, gene_start, _ in results] == sorted(gene_start for _, gene_start, _ in results)
+
+
+def test_gene_availability(tmp_path):
+    datasets = [f"dataset{i}" for i in range(7)]
+    genes = {
+        "ENSG00000169174": ({"GRCh37", "GRCh38"}, {"dataset0": 10, "dataset6": 0}),
+        "ENSG00000000001": ({"GRCh38"}, {}),
+        "ENSG00000000002": (set(), {"dataset3": 2**31}),
+    }
+    write_gene_availability(f"{tmp_path}/availability.bin", ["GRCh37", "GRCh38"], datasets, genes)
+
+    with GeneAvailability(f"{tmp_path}/availability.bin") as availability:
+        assert len(availability) == 3
+        assert availability.reference_genomes == ["GRCh37", "GRCh38"]
+        assert availability.datasets == datasets
+        assert availability.get("ENSG00000169174") == (["GRCh37", "GRCh38"], {"dataset0": 10, "dataset6": 0})
+        assert availability.get("ENSG00000000001") == (["GRCh38"], {})
+        assert availability.get("ENSG00000000002") == ([], {"dataset3": 2**31})
+        assert availability.get("ENSG00000000003") is None
+        assert availability.genes() == {
+            gene_id: (sorted(reference_genomes), variant_counts)
+            for gene_id, (reference_genomes, variant_counts) in genes.items()
+        }
@@ -0,0 +1,927 @@
+import collections
+import csv
+import errno
+import json
+import os
+import random
+import shutil
+import time
+
+import hail as hl
+import pytest
+
+from results_files import (
+    GeneAvailability,
+    VariantIndex,
+    decode_variant_columns,
+    read_manifest,
+    verify_results_directory,
+)
+from write_results_files import (
+    VARIANT_CONSEQUENCE_CATEGORIES,
+    FileWriter,
+    RunMetrics,
+    ResultEncoder,
+    check_metadata_options,
+    coding_span,
+    consequence_category_indices,
+    dumps_result_json,
+    encode_column,
+    finish_manifest,
+    finish_writing,
+    write_manifest,
+    is_regenerated_file,
+    link_or_copy,
+    loads_result_json,
+    merge_metadata,
+    pending_part_files_size,
+    prepare_output_directory,
+    source_file_path,
+    split_data,
+    timed_iter,
+    variant_field_split,
+    variant_split_indices,
+    write_gene_results_files,
+    write_availability_file,
+    write_part_file,
+    write_data_files,
+    write_variant_index_files,
+    weighted_partition_starts,
+)
+
+
+VALUES = [
+    0.0,
+    -0.0,
+    1.0,
+    -1.5,
+    0.1,
+    1 / 3,
+    2.5e-12,
+    0.000123456,
+    99999.5,
+    123456789.0,
+    1e16,
+    -7.123456e22,
+    1e-300,
+    5e-324,
+    float("nan"),
+    float("inf"),
+    float("-inf"),
+    0,
+    -5,
+    10**20,
+    True,
+    False,
+    None,
+    "",
+    "NaN",
+    "Infinity",
+    "1.5",
+    'quote " and backslash \\',
+    "tab\t and newline\n",
+    "non-ASCII é ñ",
+    "ENST00000302118.5:c.123A>G",
+]
+
+
+def random_value(rng, depth=0):
+    if depth < 3 and rng.random() < 0.4:
+        if rng.random() < 0.5:
+            return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+
+        return {f"field_{i}": random_value(rng, depth + 1) for i in range(rng.randint(0, 5))}
+
+    if rng.random() < 0.5:
+        return rng.uniform(-1, 1) * 10 ** rng.randint(-20, 20)
+
+    return rng.choice(VALUES)
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_dumps_result_json_matches_result_encoder(value):
+    text = json.dumps({"values": [value, [value], {"value": value}]})
+    assert dumps_result_json(loads_result_json(text)) == json.dumps(json.loads(text), cls=ResultEncoder)
+
+
+def test_dumps_result_json_matches_result_encoder_for_random_data():
+    rng = random.Random(0)
+    for _ in range(1000):
+        text = json.dumps(random_value(rng))
+        assert dumps_result_json(loads_result_json(text)) == json.dumps(json.loads(text), cls=ResultEncoder)
+
+
+def test_split_data():
+    gene = {
+        "gene_id": "ENSG00000169174",
+        "symbol": "PCSK9",
+        "gene_results": {"SCHEMA": {"group_results": [[0.123456789, 2.0, "NaN"]]}},
+        "GRCh37": {"chrom": "1", "start": 55505221, "stop": 55530525},
+        "GRCh38": None,
+    }
+    variants = [["1-55505500-G-A", 55505500, "missense_variant", None, None, [0.123456789], [[1, 2.5e-12, None]]]]
+
+    row = ["ENSG00000169174", json.dumps(gene), json.dumps(variants), json.dumps([])]
+
+    assert split_data(row, ["SCHEMA", "ClinVarGRCh38"]) == [
+        (
+            "genes/174/ENSG00000169174_GRCh37.json",
+            json.dumps(
+                {
+                    "gene": {
+                        "gene_id": "ENSG00000169174",
+                        "symbol": "PCSK9",
+                        "gene_results": {"SCHEMA": {"group_results": [[0.123456789, 2.0, "NaN"]]}},
+                        "reference_genome": "GRCh37",
+                        "chrom": "1",
+                        "start": 55505221,
+                        "stop": 55530525,
+                    }
+                },
+                cls=ResultEncoder,
+            ),
+        ),
+        ("genes/174/ENSG00000169174_schema_variants.json", json.dumps({"variants": variants}, cls=ResultEncoder)),
+        ("genes/174/ENSG00000169174_clinvargrch38_variants.json", '{"variants":[]}'),
+    ]
+
+
+def test_split_data_with_nul_characters():
+    variants = [["1-55505500-G-A", 55505500, "\0", 0.123456789]]
+    row = ["ENSG00000169174", json.dumps({"GRCh37": None, "GRCh38": None}), json.dumps(variants)]
+
+    assert split_data(row, ["SCHEMA"]) == [
+        ("genes/174/ENSG00000169174_schema_variants.json", json.dumps({"variants": variants}, cls=ResultEncoder))
+    ]
+
+
+def test_encode_column():
+    assert encode_column([1, None, None, 2, None]) == {"values": [1, 2], "null_runs": [1, 2, 4, 1]}
+    assert encode_column(["b", "a", "b", None, "b"]) == {
+        "dictionary": ["a", "b"],
+        "values": [1, 0, 1, 1],
+        "null_runs": [3, 1],
+    }
+    assert encode_column(["ENST1:c.1A>G", "ENST1:c.2A>G", "c.3A>G", "ENST1:c.4A>G"]) == {
+        "prefixes": ["", "ENST1:"],
+        "prefix_indices": [1, 1, 0, 1],
+        "values": ["c.1A>G", "c.2A>G", "c.3A>G", "c.4A>G"],
+    }
+    assert encode_column([[1, "x"], None, [2, "y"]]) == {
+        "fields": [{"values": [1, 2]}, {"values": ["x", "y"]}],
+        "null_runs": [1, 1],
+    }
+
+
+def test_split_data_with_variant_columns():
+    rng = random.Random(0)
+    consequences = ["missense_variant", "synonymous_variant", "stop_gained", None]
+    variants = [
+        [
+            f"1-{55505000 + i}-G-A",
+            55505000 + i,
+            rng.choice(consequences),
+            rng.choice([f"ENST00000302118.5:c.{i}G>A", None]),
+            None,
+            [rng.random(), rng.randint(0, 10)],
+            [rng.choice([None, [rng.randint(0, 10), rng.random(), "NaN"]]) for _ in range(3)],
+        ]
+        for i in range(100)
+    ]
+
+    row = ["ENSG00000169174", json.dumps({"GRCh37": None, "GRCh38": None}), json.dumps(variants), json.dumps([])]
+
+    rows_files = dict(split_data(row, ["SCHEMA", "ASC"]))
+    columns_files = dict(split_data(row, ["SCHEMA", "ASC"], variant_format="columns"))
+
+    assert columns_files.keys() == rows_files.keys()
+    for path, rows_json in rows_files.items():
+        assert decode_variant_columns(json.loads(columns_files[path])["variants"]) == json.loads(rows_json)["variants"]
+
+    schema_path = "genes/174/ENSG00000169174_schema_variants.json"
+    assert len(columns_files[schema_path]) < len(rows_files[schema_path])
+
+
+def test_split_data_with_variant_windows():
+    variants = [[f"1-{pos}-G-A", pos] for pos in [300, 100, 200, 500, 400]]
+    row = ["ENSG00000169174", json.dumps({"GRCh37": None, "GRCh38": None}), json.dumps(variants), json.dumps([])]
+
+    assert split_data(row, ["SCHEMA", "ASC"], variant_window_size=2) == [
+        (
+            "genes/174/ENSG00000169174_schema_variants.json",
+            json.dumps(
+                {
+                    "n_variants": 5,
+                    "windows": [
+                        {"start": 100, "stop": 200, "n_variants": 2},
+                        {"start": 300, "stop": 400, "n_variants": 2},
+                        {"start": 500, "stop": 500, "n_variants": 1},
+                    ],
+                },
+                separators=(",", ":"),
+            ),
+        ),
+        ("genes/174/ENSG00000169174_schema_variants_w0.json", '{"variants":[["1-100-G-A",100],["1-200-G-A",200]]}'),
+        ("genes/174/ENSG00000169174_schema_variants_w1.json", '{"variants":[["1-300-G-A",300],["1-400-G-A",400]]}'),
+        ("genes/174/ENSG00000169174_schema_variants_w2.json", '{"variants":[["1-500-G-A",500]]}'),
+        ("genes/174/ENSG00000169174_asc_variants.json", '{"variants":[]}'),
+    ]
+
+
+def test_split_data_with_variant_details():
+    variant_fields = ["variant_id", "pos", "consequence", "hgvsc", "hgvsp", "info", "group_results"]
+    dataset_meta = {
+        "variant_info_field_names": ["cadd", "revel"],
+        "variant_group_result_field_names": ["ac_case", "ac_ctrl", "p"],
+    }
+    field_split = variant_field_split(variant_fields, dataset_meta, {"info": ["revel"], "group_results": ["p"]})
+    assert field_split == {
+        "core": {"variant_fields": ["variant_id", "pos", "consequence"], "info": ["revel"], "group_results": ["p"]},
+        "detail": {"variant_fields": ["hgvsc", "hgvsp"], "info": ["cadd"], "group_results": ["ac_case", "ac_ctrl"]},
+    }
+
+    with pytest.raises(ValueError):
+        variant_field_split(variant_fields, dataset_meta, {"group_results": ["p_value"]})
+
+    variants = [
+        [f"1-{pos}-G-A", pos, "missense_variant", "c.1G>A", None, [20.1, 0.5], [[1, 2, 0.25], None]]
+        for pos in [300, 100, 200]
+    ]
+    row = ["ENSG00000169174", json.dumps({"GRCh37": None, "GRCh38": None}), json.dumps(variants)]
+    variant_splits = {"SCHEMA": variant_split_indices(variant_fields, dataset_meta, field_split)}
+
+    assert split_data(row, ["SCHEMA"], variant_splits=variant_splits) == [
+        (
+            "genes/174/ENSG00000169174_schema_variants.json",
+            json.dumps(
+                {
+                    "variants": [
+                        [f"1-{pos}-G-A", pos, "missense_variant", [0.5], [[0.25], None]] for pos in [300, 100, 200]
+                    ]
+                },
+                separators=(",", ":"),
+            ),
+        ),
+        (
+            "genes/174/ENSG00000169174_schema_variants_detail.json",
+            json.dumps({"variants": [["c.1G>A", None, [20.1], [[1, 2], None]]] * 3}, separators=(",", ":")),
+        ),
+    ]
+
+    window_files = dict(split_data(row, ["SCHEMA"], variant_window_size=2, variant_splits=variant_splits))
+    assert list(window_files) == [
+        "genes/174/ENSG00000169174_schema_variants.json",
+        "genes/174/ENSG00000169174_schema_variants_w0.json",
+        "genes/174/ENSG00000169174_schema_variants_w0_detail.json",
+        "genes/174/ENSG00000169174_schema_variants_w1.json",
+        "genes/174/ENSG00000169174_schema_variants_w1_detail.json",
+    ]
+    assert [variant[1] for variant in json.loads(window_files[list(window_files)[1]])["variants"]] == [100, 200]
+
+
+def test_split_data_with_variant_group_files():
+    variants = [
+        ["1-100-G-A", 100, "missense_variant", [0.5], [[1, 0.25], None, [2, 0.5]]],
+        ["1-200-G-A", 200, "synonymous_variant", [0.1], [None, [3, 0.75], [4, 1.0]]],
+    ]
+    row = ["ENSG00000169174", json.dumps({"GRCh37": None, "GRCh38": None}), json.dumps(variants), json.dumps([])]
+
+    assert split_data(
+        row,
+        ["ASC", "ClinVarGRCh37"],
+        variant_group_counts={"ASC": 3, "ClinVarGRCh37": 0},
+        variant_group_results_index=4,
+    ) == [
+        (
+            "genes/174/ENSG00000169174_asc_variants.json",
+            '{"variants":[["1-100-G-A",100,"missense_variant",[0.5]],["1-200-G-A",200,"synonymous_variant",[0.1]]]}',
+        ),
+        ("genes/174/ENSG00000169174_asc_variants_g0.json", '{"variants":[[0,[1,0.25]]]}'),
+        ("genes/174/ENSG00000169174_asc_variants_g1.json", '{"variants":[[1,[3,0.75]]]}'),
+        ("genes/174/ENSG00000169174_asc_variants_g2.json", '{"variants":[[0,[2,0.5]],[1,[4,1]]]}'),
+        ("genes/174/ENSG00000169174_clinvargrch37_variants.json", '{"variants":[]}'),
+    ]
+
+
+def test_source_file_path():
+    assert source_file_path("genes/174/ENSG00000169174_schema_variants_w12.json") == (
+        "genes/174/ENSG00000169174_schema_variants.json"
+    )
+    assert source_file_path("genes/174/ENSG00000169174_schema_variants.json") == (
+        "genes/174/ENSG00000169174_schema_variants.json"
+    )
+    assert source_file_path("genes/174/ENSG00000169174_schema_variants_w12_detail.json") == (
+        "genes/174/ENSG00000169174_schema_variants.json"
+    )
+    assert source_file_path("genes/174/ENSG00000169174_schema_variants_g2.json") == (
+        "genes/174/ENSG00000169174_schema_variants.json"
+    )
+    assert source_file_path("genes/174/ENSG00000169174_schema_variants_detail.json") == (
+        "genes/174/ENSG00000169174_schema_variants.json"
+    )
+    assert source_file_path("genes/174/ENSG00000169174_GRCh37.json") == "genes/174/ENSG00000169174_GRCh37.json"
+
+
+def test_weighted_partition_starts():
+    assert weighted_partition_starts([1] * 10, 3) == [0, 3, 6]
+    assert weighted_partition_starts([1, 1, 100, 1, 1, 1, 1], 4) == [0, 2, 3, 5]
+    assert weighted_partition_starts([5], 4) == [0]
+    assert weighted_partition_starts([], 4) == []
+
+
+def test_write_gene_results_files(tmp_path):
+    results = {
+        "SCHEMA": [
+            ["ENSG00000169174", "PCSK9", "proprotein convertase", "1", 55517873, [[0.123456789, 2.0, "NaN"]]],
+            ["ENSG00000169175", "GENE2", None, "1", 100, [None, [1e-20, 0, "Infinity"]]],
+        ],
+        "ASC": [["ENSG00000169174", "PCSK9", "proprotein convertase", "1", 55517873, [[1 / 3]]]],
+        "IBD": [],
+    }
+
+    (tmp_path / "temp_gene_results").mkdir()
+    (tmp_path / "temp_gene_results" / "part-00000").write_text(
+        f"SCHEMA\t{json.dumps(results['SCHEMA'][0])}\nASC\t{json.dumps(results['ASC'][0])}\n"
+    )
+    (tmp_path / "temp_gene_results" / "part-00001").write_text(f"SCHEMA\t{json.dumps(results['SCHEMA'][1])}\n")
+
+    write_gene_results_files(str(tmp_path), list(results))
+
+    for dataset, dataset_results in results.items():
+        assert (tmp_path / "results" / f"{dataset.lower()}.json").read_text() == json.dumps(
+            {"results": dataset_results}, cls=ResultEncoder
+        )
+
+    assert not (tmp_path / "temp_gene_results").exists()
+
+
+def test_gene_results_pages(tmp_path):
+    results = [
+        ["ENSG00000000001", "GENE1", None, "1", 100, [[0.5, 1], [0.01, 2]]],
+        ["ENSG00000000002", "GENE2", None, "1", 200, [["NaN", 3], None]],
+        ["ENSG00000000003", "GENE3", None, "2", 300, [[1e-8, 4], [None, 5]]],
+        ["ENSG00000000004", "GENE4", None, "2", 400, [[0.5, 6], [0.001, 7]]],
+    ]
+
+    (tmp_path / "temp_gene_results").mkdir()
+    (tmp_path / "temp_gene_results" / "part-00000").write_text(
+        "".join(f"SCHEMA\t{json.dumps(result)}\n" for result in results)
+    )
+
+    datasets_meta = {
+        "SCHEMA": {"gene_result_analysis_groups": ["meta", "DN"], "gene_group_result_field_names": ["P meta", "n"]},
+        "ASC": {"gene_result_analysis_groups": ["DN"], "gene_group_result_field_names": ["qval"]},
+    }
+    write_gene_results_files(str(tmp_path), ["SCHEMA"], datasets_meta, page_size=3)
+
+    assert json.loads((tmp_path / "results" / "schema" / "index.json").read_text()) == {
+        "sort_field": "P meta",
+        "page_size": 3,
+        "analysis_groups": [
+            {"analysis_group": "meta", "n_results": 4, "n_pages": 2},
+            {"analysis_group": "DN", "n_results": 4, "n_pages": 2},
+        ],
+    }
+
+    def page_gene_ids(group_index, page):
+        page_results = json.loads((tmp_path / "results" / "schema" / str(group_index) / f"{page}.json").read_text())
+        return [result[0] for result in page_results["results"]]
+
+    assert page_gene_ids(0, 0) == ["ENSG00000000003", "ENSG00000000001", "ENSG00000000004"]
+    assert page_gene_ids(0, 1) == ["ENSG00000000002"]
+    assert page_gene_ids(1, 0) == ["ENSG00000000004", "ENSG00000000001", "ENSG00000000002"]
+    assert page_gene_ids(1, 1) == ["ENSG00000000003"]
+    assert json.loads((tmp_path / "results" / "schema" / "1" / "0.json").read_text())["results"][0] == [
+        "ENSG00000000004",
+        "GENE4",
+        None,
+        "2",
+        400,
+        [0.001, 7],
+    ]
+    assert not (tmp_path / "results" / "asc").exists()
+
+
+def test_write_variant_index_files(tmp_path):
+    (tmp_path / "temp_variant_index").mkdir()
+    (tmp_path / "temp_variant_index" / "part-00000").write_text(
+        "GRCh37\t1\t100\tA-T\tENSG00000169174\t[0]\nGRCh37\t1\t100\tA-T\tENSG00000169175\t[0,1]\n"
+    )
+    (tmp_path / "temp_variant_index" / "part-00001").write_text(
+        "GRCh37\t23\t5\tC-G\tENSG00000169175\t[1]\nGRCh38\t1\t200\tA-T\tENSG00000169174\t[2]\n"
+    )
+
+    write_variant_index_files(str(tmp_path), ["ENSG00000169174", "ENSG00000169175"], ["SCHEMA", "ASC", "IBD"])
+
+    with VariantIndex(f"{tmp_path}/variant_index_GRCh37.bin") as index:
+        assert index.lookup("1-100-A-T") == [("ENSG00000169174", ["SCHEMA"]), ("ENSG00000169175", ["SCHEMA", "ASC"])]
+        assert index.lookup("X-5-C-G") == [("ENSG00000169175", ["ASC"])]
+        assert index.lookup("1-200-A-T") == []
+
+    with VariantIndex(f"{tmp_path}/variant_index_GRCh38.bin") as index:
+        assert index.lookup("1-200-A-T") == [("ENSG00000169174", ["IBD"])]
+
+    assert not (tmp_path / "temp_variant_index").exists()
+
+
+def test_write_availability_file(tmp_path):
+    (tmp_path / "metadata.json").write_text(json.dumps({"datasets": {"SCHEMA": {}, "ASC": {}}}))
+    write_manifest(
+        str(tmp_path),
+        {
+            "genes/174/ENSG00000169174_GRCh37.json": [1, "a"],
+            "genes/174/ENSG00000169174_GRCh37.json.gz": [1, "b"],
+            "genes/174/ENSG00000169174_schema_variants.json": [1, "c"],
+            "genes/174/ENSG00000169174_asc_variants.json": [1, "d"],
+            "genes/174/ENSG00000169174_asc_variants_w0.json": [1, "e"],
+            "genes/175/ENSG00000169175_GRCh38.json": [1, "f"],
+            "results/schema.json": [1, "g"],
+        },
+    )
+
+    write_availability_file(str(tmp_path), {"ENSG00000169174": {"SCHEMA": 3, "ASC": 300}})
+
+    with GeneAvailability(str(tmp_path / "availability.bin")) as availability:
+        assert availability.genes() == {
+            "ENSG00000169174": (["GRCh37"], {"SCHEMA": 3, "ASC": 300}),
+            "ENSG00000169175": (["GRCh38"], {}),
+        }
+
+    # Counts for genes and datasets not written when updating are kept from the existing file
+    write_availability_file(str(tmp_path), {"ENSG00000169174": {"SCHEMA": 4}}, update_existing=True)
+
+    with GeneAvailability(str(tmp_path / "availability.bin")) as availability:
+        assert availability.get("ENSG00000169174") == (["GRCh37"], {"SCHEMA": 4, "ASC": 300})
+
+
+def test_write_availability_file_with_unknown_dataset(tmp_path):
+    (tmp_path / "metadata.json").write_text(json.dumps({"datasets": {"SCHEMA": {}}}))
+    write_manifest(
+        str(tmp_path),
+        {
+            "genes/174/ENSG00000169174_GRCh37.json": [1, "a"],
+            "genes/174/ENSG00000169174_asc_variants.json": [1, "b"],
+        },
+    )
+
+    with pytest.raises(ValueError, match="ENSG00000169174_asc_variants.json"):
+        write_availability_file(str(tmp_path), {"ENSG00000169174": {"ASC": 3}})
+
+
+def test_is_regenerated_file():
+    options = {"datasets": ["SCHEMA", "ClinVarGRCh38"], "gene_files": False, "genes": None}
+
+    assert is_regenerated_file("genes/174/ENSG00000169174_schema_variants.json", options)
+    assert is_regenerated_file("genes/174/ENSG00000169174_schema_variants_w3.json.gz", options)
+    assert is_regenerated_file("genes/174/ENSG00000169174_clinvargrch38_variants.json.br", options)
+    assert not is_regenerated_file("genes/174/ENSG00000169174_asc_variants.json", options)
+    assert not is_regenerated_file("genes/174/ENSG00000169174_GRCh37.json", options)
+    assert is_regenerated_file("genes/174/ENSG00000169174_GRCh37.json", {**options, "gene_files": True})
+
+    options = {**options, "gene_files": True, "genes": {"ENSG00000169174"}}
+    assert is_regenerated_file("genes/174/ENSG00000169174_GRCh37.json", options)
+    assert is_regenerated_file("genes/174/ENSG00000169174_schema_variants.json", options)
+    assert not is_regenerated_file("genes/174/ENSG00000000174_GRCh37.json", options)
+    assert not is_regenerated_file("genes/174/ENSG00000000174_schema_variants.json", options)
+
+
+def test_consequence_category_indices():
+    category_indices = consequence_category_indices()
+    categories = {term: VARIANT_CONSEQUENCE_CATEGORIES[index] for term, index in category_indices.items()}
+
+    assert categories["stop_gained"] == "lof"
+    assert categories["pLoF"] == "lof"
+    assert categories["missense_variant_mpc_>=3"] == "missense"
+    assert categories["inframe_deletion"] == "missense"
+    assert categories["synonymous_variant"] == "synonymous"
+    assert "other" not in categories.values()
+    assert "intron_variant" not in category_indices
+
+
+@pytest.mark.skipif(shutil.which("java") is None, reason="evaluating Hail expressions requires Java")
+def test_coding_span():
+    exon_type = hl.tstruct(feature_type=hl.tstr, start=hl.tint32, stop=hl.tint32)
+    exons = [
+        hl.Struct(feature_type="UTR", start=100, stop=149),
+        hl.Struct(feature_type="exon", start=100, stop=300),
+        hl.Struct(feature_type="CDS", start=150, stop=300),
+        hl.Struct(feature_type="exon", start=500, stop=700),
+        hl.Struct(feature_type="CDS", start=500, stop=650),
+        hl.Struct(feature_type="UTR", start=651, stop=700),
+    ]
+    assert hl.eval(coding_span(hl.literal(exons, hl.tarray(exon_type)))) == hl.Struct(start=150, stop=650)
+
+    non_coding_exons = [exon for exon in exons if exon.feature_type == "exon"]
+    assert hl.eval(coding_span(hl.literal(non_coding_exons, hl.tarray(exon_type)))) == hl.Struct(start=100, stop=700)
+
+
+def test_check_metadata_options():
+    field_split = {"core": {"variant_fields": ["variant_id"]}, "detail": {"variant_fields": ["pos"]}}
+    existing_metadata = {
+        "datasets": {"ASC": {"variant_files_by_group": True}, "SCHEMA": {"variant_field_split": field_split}},
+        "variant_format": "rows",
+        "variant_window_size": 1000,
+        "variant_histograms": None,
+    }
+
+    check_metadata_options(existing_metadata, existing_metadata, datasets=["ASC", "SCHEMA"])
+
+    with pytest.raises(ValueError):
+        check_metadata_options(existing_metadata, {**existing_metadata, "variant_window_size": None})
+
+    metadata = {**existing_metadata, "datasets": {"ASC": {}, "SCHEMA": {"variant_field_split": field_split}}}
+    check_metadata_options(existing_metadata, metadata, datasets=["SCHEMA"])
+    with pytest.raises(ValueError):
+        check_metadata_options(existing_metadata, metadata, datasets=["ASC", "SCHEMA"])
+
+
+def test_write_data_files_with_genes_into_existing_output(tmp_path):
+    (tmp_path / "metadata.json").write_text("{}")
+
+    with pytest.raises(ValueError, match="requires skip_summary_files or datasets"):
+        write_data_files("combined.ht", str(tmp_path), ["ENSG00000169174"])
+
+
+def test_merge_metadata():
+    existing_metadata = {
+        "variant_fields": ["variant_id"],
+        "datasets": {"ASC": {"reference_genome": "GRCh37"}, "SCHEMA": {"reference_genome": "GRCh37"}},
+        "variant_format": "rows",
+        "variant_window_size": None,
+        "variant_histograms": None,
+    }
+    metadata = {
+        "variant_fields": ["variant_id", "pos"],
+        "datasets": {"SCHEMA": {"reference_genome": "GRCh38"}},
+        "variant_format": "rows",
+        "variant_window_size": None,
+        "variant_histograms": None,
+    }
+
+    assert merge_metadata(existing_metadata, metadata) == {
+        "variant_fields": ["variant_id", "pos"],
+        "datasets": {"ASC": {"reference_genome": "GRCh37"}, "SCHEMA": {"reference_genome": "GRCh38"}},
+        "variant_format": "rows",
+        "variant_window_size": None,
+        "variant_histograms": None,
+    }
+
+    with pytest.raises(ValueError):
+        merge_metadata(existing_metadata, {**metadata, "variant_format": "columns"})
+
+    with pytest.raises(ValueError):
+        merge_metadata(
+            existing_metadata,
+            {**metadata, "variant_histograms": {"n_bins": 100, "categories": VARIANT_CONSEQUENCE_CATEGORIES}},
+        )
+
+
+def test_pending_part_files_size(tmp_path):
+    batch_dir = tmp_path / "batch-00000"
+    batch_dir.mkdir()
+    (batch_dir / "part-00000").write_text("x" * 10)
+    (batch_dir / "part-00001").write_text("x" * 5)
+    (batch_dir / ".part-00000.crc").write_text("x" * 100)
+    (batch_dir / "_SUCCESS").write_text("x" * 100)
+    (tmp_path / "batch-00001").mkdir()
+    (tmp_path / "batch-00001" / "part-00000").write_text("x" * 20)
+
+    assert pending_part_files_size(str(tmp_path)) == 35
+
+    (batch_dir / "part-00000").unlink()
+    assert pending_part_files_size(str(tmp_path)) == 25
+
+
+def test_run_metrics():
+    metrics = RunMetrics()
+    metrics.workers = 2
+
+    counters = collections.Counter()
+    assert list(timed_iter(range(3), counters, "read_seconds")) == [0, 1, 2]
+    assert counters["read_seconds"] > 0
+
+    with metrics.stage("write_files"):
+        time.sleep(0.01)
+        metrics.add_counters({"files": 3, "busy_seconds": 0.01})
+        assert metrics.report()["stage_seconds"]["write_files"] >= 0.01
+
+    metrics.add_counters({"files": 2})
+
+    report = metrics.report()
+    assert report["counters"] == {"busy_seconds": 0.01, "files": 5}
+    assert 0 < report["worker_busy_ratio"] <= 0.5
+
+
+def test_manifest(tmp_path):
+    writer = FileWriter(str(tmp_path), precompress=["gzip"])
+    writer.write("genes/174/ENSG00000169174_GRCh37.json", '{"gene":{}}')
+    writer.write("genes/174/ENSG00000169174_asc_variants.json", '{"variants":[]}')
+    finish_writing(str(tmp_path), writer.results())
+
+    (tmp_path / "results").mkdir()
+    (tmp_path / "results" / "asc.json").write_text('{"results":[]}')
+    (tmp_path / "metadata.json").write_text('{"datasets":{}}')
+    finish_manifest(str(tmp_path))
+
+    manifest = read_manifest(str(tmp_path))
+    assert sorted(manifest["files"]) == [
+        "genes/174/ENSG00000169174_GRCh37.json",
+        "genes/174/ENSG00000169174_GRCh37.json.gz",
+        "genes/174/ENSG00000169174_asc_variants.json",
+        "genes/174/ENSG00000169174_asc_variants.json.gz",
+        "metadata.json",
+        "results/asc.json",
+    ]
+    assert json.loads((tmp_path / "metadata.json").read_text())["generation_id"] == manifest["generation_id"]
+    assert not verify_results_directory(str(tmp_path))
+
+    (tmp_path / "results" / "asc.json").write_text('{"results":[1]}')
+    (tmp_path / "genes" / "174" / "ENSG00000169174_GRCh37.json").unlink()
+    (tmp_path / "genes" / "174" / "extra.json").write_text("{}")
+    assert verify_results_directory(str(tmp_path)) == {
+        "results/asc.json": "size",
+        "genes/174/ENSG00000169174_GRCh37.json": "missing",
+        "genes/174/extra.json": "unlisted",
+    }
+
+
+LINKING_VARIANT_FIELDS = ["variant_id", "pos", "consequence", "hgvsc", "hgvsp", "info", "group_results"]
+
+
+def linking_options(**options):
+    dataset_meta = {"variant_info_field_names": ["cadd"], "variant_group_result_field_names": ["ac", "p"]}
+    field_split = variant_field_split(LINKING_VARIANT_FIELDS, dataset_meta, {"group_results": ["p"]})
+    return {
+        "serialize_in_hail": False,
+        "datasets": ["SCHEMA", "ASC"],
+        "previous_release_directory": None,
+        "output_format": "files",
+        "precompress": ["gzip"],
+        "variant_format": "rows",
+        "variant_window_size": 2,
+        "variant_histogram_bins": None,
+        "variant_splits": {"SCHEMA": variant_split_indices(LINKING_VARIANT_FIELDS, dataset_meta, field_split)},
+        "variant_files_by_group": False,
+        "variant_group_counts": {"ASC": 2},
+        "variant_group_results_index": 6,
+        "variant_position_index": 1,
+        "gene_files": True,
+        "update_existing": False,
+        "genes": None,
+        **options,
+    }
+
+
+def linking_row(gene_id, n_variants, p_value=0.5):
+    gene = {"gene_id": gene_id, "GRCh37": {"chrom": "1", "start": 1, "stop": 100}, "GRCh38": None}
+    variants = [
+        [f"1-{pos}-G-A", pos, "missense_variant", None, None, [20.5], [[1, p_value], None]]
+        for pos in range(1, n_variants + 1)
+    ]
+    return [gene_id, json.dumps(gene), json.dumps(variants), json.dumps(variants)]
+
+
+def write_linking_release(output_directory, rows, options):
+    """
+    Write a release from one part file, as a worker in write_part_files_in_workers does.
+    """
+    prepare_output_directory(str(output_directory), options)
+    part_file = output_directory / "part-00000"
+    with open(part_file, mode="w", encoding="utf-8", newline="") as output_file:
+        csv.writer(output_file, delimiter="\t").writerows(rows)
+
+    results = write_part_file(str(output_directory), options, str(part_file), remove_part_file=True)
+    finish_writing(str(output_directory), results)
+    return results
+
+
+def gene_output_files(output_directory, gene_id):
+    return sorted(path.name for path in output_directory.glob(f"genes/*/{gene_id}_*"))
+
+
+def test_write_part_file_links_unchanged_files(tmp_path):
+    previous_release, release = tmp_path / "previous", tmp_path / "release"
+    write_linking_release(
+        previous_release, [linking_row("ENSG00000000001", 3), linking_row("ENSG00000000002", 3)], linking_options()
+    )
+
+    unchanged_files = gene_output_files(previous_release, "ENSG00000000001")
+    assert unchanged_files == [
+        "ENSG00000000001_GRCh37.json",
+        "ENSG00000000001_GRCh37.json.gz",
+        "ENSG00000000001_asc_variants.json",
+        "ENSG00000000001_asc_variants.json.gz",
+        "ENSG00000000001_asc_variants_g0.json",
+        "ENSG00000000001_asc_variants_g0.json.gz",
+        "ENSG00000000001_asc_variants_g1.json",
+        "ENSG00000000001_asc_variants_g1.json.gz",
+        "ENSG00000000001_schema_variants.json",
+        "ENSG00000000001_schema_variants.json.gz",
+        "ENSG00000000001_schema_variants_w0.json",
+        "ENSG00000000001_schema_variants_w0.json.gz",
+        "ENSG00000000001_schema_variants_w0_detail.json",
+        "ENSG00000000001_schema_variants_w0_detail.json.gz",
+        "ENSG00000000001_schema_variants_w1.json",
+        "ENSG00000000001_schema_variants_w1.json.gz",
+        "ENSG00000000001_schema_variants_w1_detail.json",
+        "ENSG00000000001_schema_variants_w1_detail.json.gz",
+    ]
+
+    results = write_linking_release(
+        release,
+        [linking_row("ENSG00000000001", 3), linking_row("ENSG00000000002", 3, p_value=0.25)],
+        linking_options(previous_release_directory=str(previous_release)),
+    )
+
+    # Precompressed copies are linked with the file they are a copy of. The changed gene's gene file is unchanged.
+    assert results["counters"]["linked_files"] == len(unchanged_files) // 2 + 1
+    assert gene_output_files(release, "ENSG00000000001") == unchanged_files
+    for path in release.glob("genes/*/ENSG00000000001_*"):
+        assert os.stat(path).st_nlink == 2
+
+    changed_files = gene_output_files(release, "ENSG00000000002")
+    assert changed_files == gene_output_files(previous_release, "ENSG00000000002")
+    for path in release.glob("genes/*/ENSG00000000002_*"):
+        assert os.stat(path).st_nlink == (2 if "_GRCh37" in path.name else 1)
+
+    schema_variants = "genes/002/ENSG00000000002_schema_variants_w0.json"
+    assert (release / schema_variants).read_text() != (previous_release / schema_variants).read_text()
+    assert json.loads((release / schema_variants).read_text())["variants"][0][4] == [[0.25], None]
+
+    previous_source_hashes = json.loads((previous_release / "source_hashes.json").read_text())
+    source_hashes = json.loads((release / "source_hashes.json").read_text())
+    assert source_hashes.keys() == previous_source_hashes.keys()
+    for path, source_hash in source_hashes.items():
+        assert (source_hash == previous_source_hashes[path]) == ("ENSG00000000001" in path or "_GRCh37" in path)
+
+    assert sorted(read_manifest(str(release))["files"]) == sorted(read_manifest(str(previous_release))["files"])
+
+
+@pytest.mark.parametrize("changed_options", [{"variant_window_size": 3}, {"precompress": []}])
+def test_write_part_file_does_not_link_files_written_with_other_options(tmp_path, changed_options):
+    previous_release, release = tmp_path / "previous", tmp_path / "release"
+    rows = [linking_row("ENSG00000000001", 3)]
+    write_linking_release(previous_release, rows, linking_options())
+
+    results = write_linking_release(
+        release, rows, linking_options(previous_release_directory=str(previous_release), **changed_options)
+    )
+
+    assert results["counters"]["linked_files"] == 0
+    for path in release.glob("genes/*/*"):
+        assert os.stat(path).st_nlink == 1
+
+    # Windows and precompressed copies from the previous release are not carried over
+    files = gene_output_files(release, "ENSG00000000001")
+    if "variant_window_size" in changed_options:
+        assert "ENSG00000000001_schema_variants_w0.json" not in files
+        assert json.loads((release / "genes/001/ENSG00000000001_schema_variants.json").read_text())["variants"]
+    else:
+        assert not [file for file in files if file.endswith(".gz")]
+
+
+@pytest.mark.parametrize("cross_device", [False, True])
+def test_link_or_copy_replaces_existing_file(tmp_path, monkeypatch, cross_device):
+    source_path, destination_path = tmp_path / "source.json", tmp_path / "destination.json"
+    source_path.write_text("new")
+    destination_path.write_text("old")
+    if cross_device:
+
+        def link(_source_path, destination_path):
+            if os.path.lexists(destination_path):
+                raise FileExistsError(errno.EEXIST, "File exists")
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        monkeypatch.setattr(os, "link", link)
+
+    link_or_copy(str(source_path), str(destination_path))
+
+    assert destination_path.read_text() == "new"
+    assert os.stat(destination_path).st_nlink == (1 if cross_device else 2)
+    assert source_path.read_text() == "new"
+
+
+@pytest.mark.parametrize(
+    "removed_file",
+    [
+        "ENSG00000000001_schema_variants_w1.json",
+        "ENSG00000000001_schema_variants_w1_detail.json",
+        "ENSG00000000001_asc_variants_g1.json.gz",
+    ],
+)
+def test_write_part_file_does_not_link_variants_files_with_missing_dependents(tmp_path, removed_file):
+    previous_release, release = tmp_path / "previous", tmp_path / "release"
+    rows = [linking_row("ENSG00000000001", 3)]
+    write_linking_release(previous_release, rows, linking_options())
+    os.remove(previous_release / "genes/001" / removed_file)
+    previous_files = {path: path.read_bytes() for path in previous_release.glob("genes/*/*")}
+
+    write_linking_release(release, rows, linking_options(previous_release_directory=str(previous_release)))
+
+    # The dataset with a missing file is written again, while the other dataset and the gene file are linked
+    removed_dataset = "_schema_" if "_schema_" in removed_file else "_asc_"
+    assert removed_file in gene_output_files(release, "ENSG00000000001")
+    for path in release.glob("genes/*/*"):
+        assert os.stat(path).st_nlink == (1 if removed_dataset in path.name else 2)
+
+    for path, data in previous_files.items():
+        assert path.read_bytes() == data
+
+
+REQUIRES_JAVA = pytest.mark.skipif(shutil.which("java") is None, reason="running Hail requires Java")
+
+
+def write_combined_table(path, schema_positions):
+    """
+    Write a combined table with one GRCh37 gene and ASC and SCHEMA variants, with SCHEMA variants at the given
+    positions.
+    """
+    exon_type = hl.tstruct(feature_type=hl.tstr, start=hl.tint32, stop=hl.tint32)
+    gene_model_type = hl.tstruct(
+        chrom=hl.tstr,
+        start=hl.tint32,
+        stop=hl.tint32,
+        canonical_transcript=hl.tstruct(transcript_id=hl.tstr, exons=hl.tarray(exon_type)),
+    )
+    gene_result_type = hl.tstruct(group_results=hl.tarray(hl.ttuple(hl.tfloat64)))
+    variant_type = hl.ttuple(
+        hl.tstr, hl.tint32, hl.tstr, hl.tstr, hl.tstr, hl.ttuple(hl.tfloat64), hl.tarray(hl.ttuple(hl.tint32))
+    )
+    row_type = hl.tstruct(
+        gene_id=hl.tstr,
+        symbol=hl.tstr,
+        name=hl.tstr,
+        search_terms=hl.tarray(hl.tstr),
+        GRCh37=gene_model_type,
+        GRCh38=gene_model_type,
+        gene_results=hl.tstruct(ASC=gene_result_type, SCHEMA=gene_result_type),
+        variants=hl.tstruct(ASC=hl.tarray(variant_type), SCHEMA=hl.tarray(variant_type)),
+    )
+
+    def variants(positions):
+        return [(f"1-{pos}-G-A", pos, "missense_variant", None, None, (20.0,), [(1,)]) for pos in positions]
+
+    gene = {
+        "gene_id": "ENSG00000169174",
+        "symbol": "PCSK9",
+        "name": "proprotein convertase subtilisin/kexin type 9",
+        "search_terms": ["PCSK9", "ENSG00000169174"],
+        "GRCh37": hl.Struct(
+            chrom="1",
+            start=1001,
+            stop=2000,
+            canonical_transcript=hl.Struct(
+                transcript_id="ENST00000302118",
+                exons=[
+                    hl.Struct(feature_type="UTR", start=1001, stop=1100),
+                    hl.Struct(feature_type="CDS", start=1101, stop=2000),
+                ],
+            ),
+        ),
+        "GRCh38": None,
+        "gene_results": hl.Struct(ASC=hl.Struct(group_results=[(0.5,)]), SCHEMA=hl.Struct(group_results=[(0.25,)])),
+        "variants": hl.Struct(ASC=variants([1200, 1300]), SCHEMA=variants(schema_positions)),
+    }
+    dataset_meta = {
+        "reference_genome": "GRCh37",
+        "gene_result_analysis_groups": ["all"],
+        "gene_group_result_field_names": ["qval"],
+        "gene_group_result_field_types": ["float"],
+        "variant_info_field_names": ["cadd"],
+        "variant_info_field_types": ["float"],
+        "variant_result_analysis_groups": ["all"],
+        "variant_group_result_field_names": ["ac"],
+        "variant_group_result_field_types": ["int"],
+    }
+
+    ds = hl.Table.parallelize([gene], row_type, key="gene_id")
+    ds = ds.annotate_globals(
+        meta=hl.struct(
+            variant_fields=LINKING_VARIANT_FIELDS,
+            datasets=hl.struct(ASC=hl.struct(**dataset_meta), SCHEMA=hl.struct(**dataset_meta)),
+        )
+    )
+    ds.write(str(path), overwrite=True)
+
+
+@REQUIRES_JAVA
+def test_write_data_files_updates_variant_histograms_with_datasets(tmp_path):
+    output_directory = tmp_path / "results"
+    gene_file = output_directory / "genes" / "174" / "ENSG00000169174_GRCh37.json"
+
+    write_combined_table(tmp_path / "combined.ht", [1200])
+    write_data_files(str(tmp_path / "combined.ht"), str(output_directory), workers=1, variant_histogram_bins=10)
+    histograms = json.loads(gene_file.read_text())["gene"]["variant_histograms"]
+    assert histograms["SCHEMA"] == {"start": 1101, "stop": 2000, "counts": [[0, 1, 1, 1]]}
+
+    write_combined_table(tmp_path / "combined.ht", [1200, 1900])
+    write_data_files(
+        str(tmp_path / "combined.ht"),
+        str(output_directory),
+        workers=1,
+        variant_histogram_bins=10,
+        datasets=["SCHEMA"],
+    )
+    updated_histograms = json.loads(gene_file.read_text())["gene"]["variant_histograms"]
+    assert updated_histograms["SCHEMA"]["counts"] == [[0, 1, 1, 1], [0, 1, 8, 1]]
+    assert updated_histograms["ASC"] == histograms["ASC"]
@@ -1,243 +1,2414 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import functools
 import json
 from json.encoder import encode_basestring_ascii, _make_iterencode
+import math
 import multiprocessing
 import os
 import sys
 import glob
+import gzip
+import hashlib
+import importlib.util
 import shutil
+import threading
+import time
 
 import hail as hl
 from tqdm import tqdm
 
+from results_files import (
+    AVAILABILITY_FILE,
+    AUTOCOMPLETE_PREFIX_LENGTH,
+    CHROMOSOME_CODES,
+    GeneAvailability,
+    GENE_SEARCH_INDEX_FILE,
+    MANIFEST_FILE,
+    append_to_pack,
+    classify_file,
+    content_hash,
+    gene_interval_index_file,
+    generation_id,
+    hash_file,
+    VariantIndexWriter,
+    pack_location,
+    read_manifest,
+    read_packed_file,
+    variant_index_file,
+    write_gene_availability,
+    write_gene_interval_index,
+    write_gene_search_index,
+    write_pack_index,
+)
+
 INFINITY = float("inf")
 
+# Genes with more variants than this across all datasets are not written, unless variants are written in windows
+VARIANT_THRESHOLD = 200_000
+
+REFERENCE_GENOMES = ["GRCh37", "GRCh38"]
+
+# Hash of each written file's source data, used to find unchanged files when writing the next release
+SOURCE_HASHES_FILE = "source_hashes.json"
+
+# Options that change the contents of output files
+OUTPUT_FORMAT_OPTIONS = [
+    "serialize_in_hail",
+    "output_format",
+    "precompress",
+    "variant_format",
+    "variant_window_size",
+    "variant_histogram_bins",
+    "variant_splits",
+    "variant_files_by_group",
+]
+
+# Extensions of precompressed copies of output files, by encoding
+PRECOMPRESSED_FILE_EXTENSIONS = {"gzip": ".gz", "brotli": ".br"}
+
+# Number of partitions to split genes into for each CPU, so that work can be balanced between workers
+PARTITIONS_PER_CORE = 4
+
+# Directory within the output directory that gene results are exported to before writing results files
+GENE_RESULTS_TEMP_DIR = "temp_gene_results"
+
+# Directory within the output directory that variants are exported to before writing variant indices
+VARIANT_INDEX_TEMP_DIR = "temp_variant_index"
+
+# Layouts of variants files. See results_files.py for the columns format.
+VARIANT_FORMATS = ["rows", "columns"]
+
+# Top level variant fields written to variants files for datasets with core fields, if not configured
+DEFAULT_CORE_VARIANT_FIELDS = ["variant_id", "pos", "consequence"]
+
+# Gene result field that pages of each dataset's gene results are sorted by. These match the default sort
+# keys of the gene results tables in each browser.
+GENE_RESULTS_SORT_FIELDS = {
+    "ASC": "qval",
+    "BipEx": "ptv_fisher_gnom_non_psych_pval",
+    "BipEx2": "ptv_mis_p_value",
+    "Epi25": "ptv_pval",
+    "GP2": "ptv_pval",
+    "IBD": "ptv_0_001_P_meta",
+    "SCHEMA": "P meta",
+    "SCHEMA2": "schema_case_control_p_value",
+}
+
+# Number of genes in each page of sorted gene results
+GENE_RESULTS_PAGE_SIZE = 100
+
+# Categories of variant consequences in variant histograms, and the consequence terms in each category other than
+# "other". These match the categories of consequences in each browser.
+VARIANT_CONSEQUENCE_CATEGORIES = ["lof", "missense", "synonymous", "other"]
+VARIANT_CONSEQUENCE_CATEGORY_TERMS = {
+    "lof": [
+        "frameshift_variant",
+        "frameshift_variant_LC",
+        "pLoF",
+        "ptv",
+        "splice_acceptor_variant",
+        "splice_acceptor_variant_LC",
+        "splice_donor_variant",
+        "splice_donor_variant_LC",
+        "stop_gained",
+        "stop_gained_LC",
+        "transcript_ablation",
+        "transcript_ablation_LC",
+    ],
+    "missense": [
+        "damaging_missense",
+        "inframe_deletion",
+        "inframe_insertion",
+        "missense_variant",
+        "missense_variant_mpc_2-3",
+        "missense_variant_mpc_<2",
+        "missense_variant_mpc_>=3",
+        "other_missense",
+        "start_lost",
+        "stop_lost",
+    ],
+    "synonymous": ["synonymous", "synonymous_variant"],
+}
+
+
+class RunMetrics:
+    """
+    Time spent in each stage of a run, and counters from writers merged as parts are written.
+
+    Writers count bytes and files and the time workers spend reading, decoding, encoding, and writing. Counters
+    measured in seconds end with _seconds.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.workers = None
+        self.stage_seconds = collections.Counter()
+        self.counters = collections.Counter()
+        self._running_stages = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        with self._lock:
+            self._running_stages[name].append(start)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running_stages[name].remove(start)
+                self.stage_seconds[name] += time.perf_counter() - start
+
+    def _stage_seconds(self):
+        # Include time so far in stages that are still running
+        now = time.perf_counter()
+        stage_seconds = self.stage_seconds.copy()
+        for name, starts in self._running_stages.items():
+            for start in starts:
+                stage_seconds[name] += now - start
+
+        return stage_seconds
+
+    def add_counters(self, counters):
+        with self._lock:
+            self.counters.update(counters)
+
+    def report(self):
+        with self._lock:
+            stage_seconds = self._stage_seconds()
+            report = {
+                "elapsed_seconds": round(time.time() - self.started, 3),
+                "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stage_seconds.items()},
+                "counters": {
+                    name: round(value, 3) if isinstance(value, float) else value
+                    for name, value in sorted(self.counters.items())
+                },
+                "workers": self.workers,
+            }
+
+            # Fraction of the time the worker pool was open that workers spent processing parts
+            worker_pool_seconds = stage_seconds["write_files"] * (self.workers or 0)
+            if worker_pool_seconds and self.counters["busy_seconds"]:
+                report["worker_busy_ratio"] = round(self.counters["busy_seconds"] / worker_pool_seconds, 3)
+
+        return report
+
+    def write_report(self, path):
+        with open(path, mode="w", encoding="utf-8") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+    @contextlib.contextmanager
+    def reporting_periodically(self, interval):
+        """
+        Print the report as a line of JSON to stderr every interval seconds.
+        """
+        stopped = threading.Event()
+
+        def report_until_stopped():
+            while not stopped.wait(interval):
+                print(json.dumps(self.report()), file=sys.stderr, flush=True)
+
+        reporter = threading.Thread(target=report_until_stopped, daemon=True)
+        reporter.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            reporter.join()
+
+
+METRICS = RunMetrics()
+
+
+def timed(function, counters, name):
+    """
+    Wrap a function to add the time spent in it to counters[name].
+    """
+
+    @functools.wraps(function)
+    def timed_function(*function_args, **function_kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*function_args, **function_kwargs)
+        finally:
+            counters[name] += time.perf_counter() - start
+
+    return timed_function
+
+
+def timed_iter(iterable, counters, name):
+    """
+    Iterate over iterable, adding the time spent getting each item to counters[name].
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            counters[name] += time.perf_counter() - start
+
+        yield item
+
+
+class ResultEncoder(json.JSONEncoder):
+    """
+    JSON encoder that supports Hail Structs and limits precision of floats.
+    """
+
+    def default(self, o):  # pylint: disable=method-hidden
+        if isinstance(o, hl.Struct):
+            return dict(o)
+
+        return super().default(o)
+
+    def iterencode(self, o, _one_shot=False):
+        def floatstr(o, **kwargs):  # pylint: disable=unused-argument
+            if o != o:
+                return '"NaN"'
+            elif o == INFINITY:
+                return '"Infinity"'
+            elif o == -INFINITY:
+                return '"-Infinity"'
+
+            return "{:.5g}".format(o)
+
+        _iterencode = _make_iterencode(
+            {},
+            self.default,
+            encode_basestring_ascii,
+            None,  # indent,
+            floatstr,
+            ":",  # key_separator,
+            ",",  # item_separator,
+            False,  #  sort_keys,
+            False,  #  skipkeys,
+            _one_shot,
+        )
+        return _iterencode(o, 0)
+
+
+# Floats are decoded as NUL delimited strings, which the C JSON encoder escapes as \u0000. Removing the escaped
+# delimiters along with the adjacent quotes leaves the formatted number. JSON containing NUL characters (which could
+# be confused with floats) is encoded with ResultEncoder instead.
+FLOAT_TOKEN_DELIMITER = "\0"
+FORMAT_FLOAT_TOKEN = "\0{:.5g}\0".format
+ENCODED_NUL = "\\u0000"
+
+
+def loads_result_json(text):
+    """
+    Decode JSON to be encoded with dumps_result_json.
+
+    Floats are formatted with 5 significant digits as they are decoded, and NaN/Infinity are decoded as strings,
+    so that the decoded data contains no floats and can be encoded by the C JSON encoder.
+    """
+    return json.loads(text, parse_float=lambda value: FORMAT_FLOAT_TOKEN(float(value)), parse_constant=str)
+
+
+def dumps_result_json(obj):
+    """
+    Encode data decoded by loads_result_json. Output is identical to json.dumps(json.loads(text), cls=ResultEncoder).
+    """
+    encoded = json.dumps(obj, separators=(",", ":"))
+    return encoded.replace('"' + ENCODED_NUL, "").replace(ENCODED_NUL + '"', "")
+
+
+def gene_data_directory(gene_id):
+    num = int(gene_id.lstrip("ENSGR"))
+    return f"genes/{str(num % 1000).zfill(3)}"
+
+
+def gene_file_path(gene_id, reference_genome):
+    return f"{gene_data_directory(gene_id)}/{gene_id}_{reference_genome}.json"
+
+
+def variants_file_path(gene_id, dataset):
+    return f"{gene_data_directory(gene_id)}/{gene_id}_{dataset.lower()}_variants.json"
+
+
+def variant_window_file_path(gene_id, dataset, window):
+    return f"{gene_data_directory(gene_id)}/{gene_id}_{dataset.lower()}_variants_w{window}.json"
+
+
+def variant_group_file_path(gene_id, dataset, group_index):
+    return f"{gene_data_directory(gene_id)}/{gene_id}_{dataset.lower()}_variants_g{group_index}.json"
+
+
+def variant_detail_file_path(relative_path):
+    return f"{relative_path.removesuffix('.json')}_detail.json"
+
+
+def source_file_path(relative_path):
+    """
+    Return the path of the file that an output file shares source data with.
+
+    Variant window, analysis group, and detail files are generated from the same source data as their dataset's
+    variants file.
+    """
+    if relative_path.endswith("_detail.json"):
+        relative_path = relative_path.removesuffix("_detail.json") + ".json"
+
+    for infix in ["_variants_w", "_variants_g"]:
+        base, separator, index = relative_path[: -len(".json")].rpartition(infix)
+        if separator and index.isdigit():
+            return f"{base}_variants.json"
+
+    return relative_path
+
+
+def gene_file_sources(row, datasets, gene_files=True):
+    """
+    Map the path of each of a gene's output files to the exported JSON that file is generated from.
+    """
+    gene_id = row[0]
+    sources = {}
+    if gene_files:
+        sources.update({gene_file_path(gene_id, reference_genome): row[1] for reference_genome in REFERENCE_GENOMES})
+    for dataset, dataset_variants in zip(datasets, row[2:]):
+        sources[variants_file_path(gene_id, dataset)] = dataset_variants
+
+    return sources
+
+
+def _is_text(value):
+    # Floats decoded by loads_result_json are also strings
+    return isinstance(value, str) and not value.startswith(FLOAT_TOKEN_DELIMITER)
+
+
+def encode_column(values):
+    """
+    Encode a list of values as a column in the format described in results_files.py.
+    """
+    column = {}
+
+    null_runs = []
+    for i, value in enumerate(values):
+        if value is None:
+            if null_runs and null_runs[-2] + null_runs[-1] == i:
+                null_runs[-1] += 1
+            else:
+                null_runs.extend([i, 1])
+
+    if null_runs:
+        values = [value for value in values if value is not None]
+
+    if values and all(isinstance(value, list) for value in values) and len(set(map(len, values))) == 1:
+        column["fields"] = [encode_column(list(field)) for field in zip(*values)]
+
+    elif values and all(_is_text(value) for value in values):
+        distinct_values = sorted(set(values))
+        if len(distinct_values) * 2 <= len(values):
+            column["dictionary"] = distinct_values
+            indices = {value: i for i, value in enumerate(distinct_values)}
+            values = [indices[value] for value in values]
+
+        else:
+            prefixes, suffixes = [], []
+            for value in values:
+                head, separator, tail = value.partition(":")
+                if separator:
+                    prefixes.append(head + separator)
+                    suffixes.append(tail)
+                else:
+                    prefixes.append("")
+                    suffixes.append(value)
+
+            distinct_prefixes = sorted(set(prefixes))
+            if distinct_prefixes != [""] and len(distinct_prefixes) * 2 <= len(values):
+                column["prefixes"] = distinct_prefixes
+                indices = {prefix: i for i, prefix in enumerate(distinct_prefixes)}
+                column["prefix_indices"] = [indices[prefix] for prefix in prefixes]
+                values = suffixes
+
+    if "fields" not in column:
+        column["values"] = values
+
+    if null_runs:
+        column["null_runs"] = null_runs
+
+    return column
+
+
+def encode_variant_columns(variants):
+    """
+    Convert a list of variant tuples to the "columns" variant format.
+    """
+    return {
+        "length": len(variants),
+        "fields": [encode_column(list(field)) for field in zip(*variants)],
+    }
+
+
+def variant_windows(variants, window_size, position_index):
+    """
+    Sort variants by position and split them into windows of at most window_size variants.
+
+    Returns a list of windows and an index of the positions and number of variants in each window.
+    """
+    variants = sorted(variants, key=lambda variant: variant[position_index])
+    windows = [variants[start : start + window_size] for start in range(0, len(variants), window_size)]
+    index = {
+        "n_variants": len(variants),
+        "windows": [
+            {"start": window[0][position_index], "stop": window[-1][position_index], "n_variants": len(window)}
+            for window in windows
+        ],
+    }
+    return windows, index
+
+
+def variant_field_split(variant_fields, dataset_meta, core_fields):
+    """
+    Split a dataset's variant fields into core fields, written to variants files, and detail fields, written to
+    variant detail files.
+
+    core_fields may list top level "variant_fields" (defaults to DEFAULT_CORE_VARIANT_FIELDS), and "info" and
+    "group_results" fields by the names in the dataset's metadata. Returns the names of the core and detail fields of
+    each kind, in the order of the metadata.
+    """
+    available_fields = {
+        "variant_fields": [field for field in variant_fields if field not in ("info", "group_results")],
+        "info": list(dataset_meta["variant_info_field_names"]),
+        "group_results": list(dataset_meta["variant_group_result_field_names"]),
+    }
+
+    unknown_kinds = [kind for kind in core_fields if kind not in available_fields]
+    if unknown_kinds:
+        raise ValueError(f"Unknown kinds of core fields {unknown_kinds}, choose from {list(available_fields)}")
+
+    core_fields = {"variant_fields": DEFAULT_CORE_VARIANT_FIELDS, "info": [], "group_results": [], **core_fields}
+    for kind, fields in core_fields.items():
+        unknown_fields = [field for field in fields if field not in available_fields[kind]]
+        if unknown_fields:
+            raise ValueError(f"Unknown {kind} core fields {unknown_fields}, choose from {available_fields[kind]}")
+
+    return {
+        part: {
+            kind: [field for field in fields if (field in core_fields[kind]) == (part == "core")]
+            for kind, fields in available_fields.items()
+        }
+        for part in ["core", "detail"]
+    }
+
+
+def variant_split_indices(variant_fields, dataset_meta, field_split):
+    """
+    Convert the field names from variant_field_split to indices into variant tuples, for split_variant_fields.
+    """
+    field_names = {
+        "variant_fields": list(variant_fields),
+        "info": list(dataset_meta["variant_info_field_names"]),
+        "group_results": list(dataset_meta["variant_group_result_field_names"]),
+    }
+    return {
+        "info_index": field_names["variant_fields"].index("info"),
+        "group_results_index": field_names["variant_fields"].index("group_results"),
+        **{
+            part: {kind: [field_names[kind].index(field) for field in fields] for kind, fields in part_fields.items()}
+            for part, part_fields in field_split.items()
+        },
+    }
+
+
+def _select_variant_fields(variant, split, part):
+    info = variant[split["info_index"]]
+    group_results = variant[split["group_results_index"]]
+    return [
+        *(variant[index] for index in split[part]["variant_fields"]),
+        None if info is None else [info[index] for index in split[part]["info"]],
+        None
+        if group_results is None
+        else [
+            None if group_result is None else [group_result[index] for index in split[part]["group_results"]]
+            for group_result in group_results
+        ],
+    ]
+
+
+def split_variant_fields(variants, split):
+    """
+    Split variant tuples into core and detail tuples with the fields given by variant_split_indices.
+
+    Each is a list of the top level fields, then a list of info fields, then a list of group result fields for each
+    analysis group (null for groups without results), so that detail tuples are at the same index as core tuples.
+    """
+    return (
+        [_select_variant_fields(variant, split, "core") for variant in variants],
+        [_select_variant_fields(variant, split, "detail") for variant in variants],
+    )
+
+
+def variant_group_files(variants, n_groups, group_results_index):
+    """
+    Split variant tuples into annotations, the variant tuples without group results, and a list for each analysis
+    group of [annotation index, group result] for the variants with a result in that group.
+    """
+    annotations = [variant[:group_results_index] + variant[group_results_index + 1 :] for variant in variants]
+    groups = [
+        [
+            [variant_index, variant[group_results_index][group_index]]
+            for variant_index, variant in enumerate(variants)
+            if variant[group_results_index] and variant[group_results_index][group_index] is not None
+        ]
+        for group_index in range(n_groups)
+    ]
+    return annotations, groups
+
+
+def split_data(
+    row,
+    datasets,
+    skip_paths=frozenset(),
+    variant_format="rows",
+    variant_window_size=None,
+    variant_position_index=1,
+    gene_files=True,
+    variant_splits=None,
+    variant_group_counts=None,
+    variant_group_results_index=6,
+    counters=None,
+):
+    """
+    Encode a gene's output files from an exported row of gene ID, gene JSON, and each dataset's variants JSON.
+
+    If variant_window_size is set, a dataset's variants file for a gene with more variants than that instead
+    contains an index of windows, and the variants in window i are written to a separate variants_w{i} file.
+
+    For datasets in variant_splits (a map of dataset to variant_split_indices), each variants file contains only the
+    core fields of each variant, and the detail fields are written to a separate detail file in the same order.
+
+    For datasets in variant_group_counts (a map of dataset to number of analysis groups), each variants file contains
+    variant annotations without group results, and the results for analysis group i are written to a separate
+    variants_g{i} file (see variant_group_files).
+
+    Returns a list of (relative path, JSON) tuples for each file, excluding gene files if gene_files is false and
+    any paths in skip_paths. If counters is given, time spent decoding and encoding JSON is added to it.
+    """
+    if any(ENCODED_NUL in column for column in row):
+        loads, dumps = json.loads, functools.partial(json.dumps, cls=ResultEncoder)
+    else:
+        loads, dumps = loads_result_json, dumps_result_json
+
+    if counters is not None:
+        loads, dumps = timed(loads, counters, "decode_seconds"), timed(dumps, counters, "encode_seconds")
+
+    gene_id = row[0]
+    files = []
+
+    gene_paths = {reference_genome: gene_file_path(gene_id, reference_genome) for reference_genome in REFERENCE_GENOMES}
+    if gene_files and not skip_paths.issuperset(gene_paths.values()):
+        gene = loads(row[1])
+        gene_by_reference_genome = {
+            reference_genome: gene.pop(reference_genome) for reference_genome in REFERENCE_GENOMES
+        }
+
+        for reference_genome, reference_genome_gene in gene_by_reference_genome.items():
+            if reference_genome_gene and gene_paths[reference_genome] not in skip_paths:
+                reference_genome_gene = {**gene, "reference_genome": reference_genome, **reference_genome_gene}
+                files.append((gene_paths[reference_genome], dumps({"gene": reference_genome_gene})))
+
+    def encode_variants(variants):
+        if variant_format == "columns":
+            variants = encode_variant_columns(variants)
+
+        return dumps({"variants": variants})
+
+    for dataset, dataset_variants in zip(datasets, row[2:]):
+        path = variants_file_path(gene_id, dataset)
+        if path not in skip_paths:
+            variants = loads(dataset_variants)
+            if variant_group_counts and dataset in variant_group_counts:
+                annotations, groups = variant_group_files(
+                    variants, variant_group_counts[dataset], variant_group_results_index
+                )
+                files.append((path, encode_variants(annotations)))
+                for group_index, group_variants in enumerate(groups):
+                    files.append(
+                        (variant_group_file_path(gene_id, dataset, group_index), encode_variants(group_variants))
+                    )
+
+                continue
+
+            if variant_window_size and len(variants) > variant_window_size:
+                windows, index = variant_windows(variants, variant_window_size, variant_position_index)
+                files.append((path, dumps(index)))
+                window_paths = [variant_window_file_path(gene_id, dataset, i) for i in range(len(windows))]
+            else:
+                windows, window_paths = [variants], [path]
+
+            for window_path, window in zip(window_paths, windows):
+                if variant_splits and dataset in variant_splits:
+                    window, window_details = split_variant_fields(window, variant_splits[dataset])
+                    files.append((window_path, encode_variants(window)))
+                    files.append((variant_detail_file_path(window_path), encode_variants(window_details)))
+                else:
+                    files.append((window_path, encode_variants(window)))
+
+    return files
+
+
+def _contains_float(dtype):
+    if dtype in (hl.tfloat32, hl.tfloat64):
+        return True
+
+    if isinstance(dtype, (hl.tstruct, hl.ttuple)):
+        return any(_contains_float(typ) for typ in dtype.types)
+
+    if isinstance(dtype, (hl.tarray, hl.tset)):
+        return _contains_float(dtype.element_type)
+
+    if isinstance(dtype, hl.tdict):
+        return _contains_float(dtype.value_type)
+
+    return False
+
+
+def _round_float(value):
+    """
+    Round a float to 5 significant digits, matching the precision of ResultEncoder.
+
+    NaN and infinite values are left as is since Hail already exports them as "NaN"/"Infinity" strings.
+    """
+    scale = 4 - hl.int32(hl.floor(hl.log10(hl.abs(value))))
+    return hl.if_else(
+        hl.is_nan(value) | hl.is_infinite(value) | (hl.abs(value) < 1e-300),
+        value,
+        hl.if_else(
+            scale >= 0,
+            hl.floor(value * hl.float64(10) ** scale + 0.5) / hl.float64(10) ** scale,
+            hl.floor(value / hl.float64(10) ** -scale + 0.5) * hl.float64(10) ** -scale,
+        ),
+    )
+
+
+def round_floats(expr):
+    """
+    Round all floats nested in an expression to 5 significant digits.
+    """
+    dtype = expr.dtype
+    if not _contains_float(dtype):
+        return expr
+
+    if dtype in (hl.tfloat32, hl.tfloat64):
+        return _round_float(hl.float64(expr))
+
+    if isinstance(dtype, hl.tstruct):
+        return hl.or_missing(hl.is_defined(expr), hl.struct(**{field: round_floats(expr[field]) for field in dtype}))
+
+    if isinstance(dtype, hl.ttuple):
+        return hl.or_missing(hl.is_defined(expr), hl.tuple([round_floats(expr[i]) for i in range(len(dtype))]))
+
+    if isinstance(dtype, (hl.tarray, hl.tset)):
+        return expr.map(round_floats)
+
+    if isinstance(dtype, hl.tdict):
+        return expr.map_values(round_floats)
+
+    return expr
+
+
+def serialized_files_expr(ds, gene_files=True):
+    """
+    Build an array of (path, data) structs containing the final JSON for each of a gene's output files.
+    """
+    gene_dir = hl.format("genes/%03d", hl.int64(ds.gene_id.replace("^ENSGR?", "")) % 1000)
+    gene = round_floats(ds.row.drop("variants", "GRCh37", "GRCh38"))
+
+    files = []
+    for reference_genome in REFERENCE_GENOMES if gene_files else []:
+        files.append(
+            hl.struct(
+                path=gene_dir + "/" + ds.gene_id + f"_{reference_genome}.json",
+                data=hl.or_missing(
+                    hl.is_defined(ds[reference_genome]),
+                    hl.json(
+                        hl.struct(
+                            gene=gene.annotate(reference_genome=reference_genome, **round_floats(ds[reference_genome]))
+                        )
+                    ),
+                ),
+            )
+        )
+
+    for dataset in ds.variants.dtype.fields:
+        files.append(
+            hl.struct(
+                path=gene_dir + "/" + ds.gene_id + f"_{dataset.lower()}_variants.json",
+                data=hl.json(hl.struct(variants=round_floats(ds.variants[dataset]))),
+            )
+        )
+
+    return hl.array(files).filter(lambda f: hl.is_defined(f.data))
+
+
+def consequence_category_indices():
+    """
+    Return a map of consequence term to the index of its category in VARIANT_CONSEQUENCE_CATEGORIES.
+    """
+    return {
+        term: VARIANT_CONSEQUENCE_CATEGORIES.index(category)
+        for category, terms in VARIANT_CONSEQUENCE_CATEGORY_TERMS.items()
+        for term in terms
+    }
+
+
+def _variant_histogram(variants, start, stop, n_bins, field_indices, n_groups):
+    pos_index, consequence_index, group_results_index = (
+        field_indices[field] for field in ["pos", "consequence", "group_results"]
+    )
+    category_indices = hl.literal(consequence_category_indices())
+    other_category = VARIANT_CONSEQUENCE_CATEGORIES.index("other")
+
+    variants = variants.filter(lambda variant: (variant[pos_index] >= start) & (variant[pos_index] <= stop))
+    counts = variants.aggregate(
+        lambda variant: hl.agg.explode(
+            lambda group_index: hl.agg.counter(
+                hl.tuple(
+                    [
+                        group_index,
+                        category_indices.get(variant[consequence_index], other_category),
+                        hl.int32(hl.int64(variant[pos_index] - start) * n_bins // hl.int64(stop - start + 1)),
+                    ]
+                )
+            ),
+            hl.range(n_groups).filter(lambda group_index: hl.is_defined(variant[group_results_index][group_index])),
+        )
+    )
+    return hl.struct(
+        start=start,
+        stop=stop,
+        counts=hl.sorted(counts.items()).map(
+            lambda item: hl.array([item[0][0], item[0][1], item[0][2], hl.int32(item[1])])
+        ),
+    )
+
+
+def coding_span(exons):
+    """
+    Return the start and stop of a transcript's CDS features, or of all its exons if it has no CDS features.
+    """
+    coding_exons = exons.filter(lambda exon: exon.feature_type == "CDS")
+    span_exons = hl.if_else(hl.len(coding_exons) > 0, coding_exons, exons)
+    return hl.struct(
+        start=hl.min(span_exons.map(lambda exon: exon.start)), stop=hl.max(span_exons.map(lambda exon: exon.stop))
+    )
+
+
+def annotate_variant_histograms(ds, n_bins):
+    """
+    Add histograms of each dataset's variants in each analysis group, by consequence category, over the coding span
+    of the canonical transcript to the gene data for the dataset's reference genome.
+
+    Histograms are computed while the table is exported, without another pass over variants. Each has the start and
+    stop of the span and a list of [analysis group index, consequence category index, bin, count] for each
+    non-empty bin of n_bins equal width bins, with analysis groups as in the dataset's metadata and categories in
+    VARIANT_CONSEQUENCE_CATEGORIES.
+    """
+    datasets_meta = hl.eval(ds.globals.meta.datasets)
+    variant_fields = hl.eval(ds.globals.meta.variant_fields)
+    field_indices = {field: variant_fields.index(field) for field in ["pos", "consequence", "group_results"]}
+
+    annotations = {}
+    for reference_genome in REFERENCE_GENOMES:
+        span = coding_span(ds[reference_genome].canonical_transcript.exons)
+        start, stop = span.start, span.stop
+
+        histograms = {
+            dataset: _variant_histogram(
+                ds.variants[dataset],
+                start,
+                stop,
+                n_bins,
+                field_indices,
+                len(dataset_meta.variant_result_analysis_groups),
+            )
+            for dataset, dataset_meta in datasets_meta.items()
+            if dataset_meta.reference_genome == reference_genome
+        }
+        annotations[reference_genome] = ds[reference_genome].annotate(
+            variant_histograms=hl.or_missing(hl.is_defined(start), hl.struct(**histograms))
+        )
+
+    return ds.annotate(**annotations)
+
+
+def check_metadata_options(existing_metadata, metadata, datasets=()):
+    """
+    Check that options that change the format of files match those recorded in an existing output directory's
+    metadata, including the format of variants files for the given datasets.
+    """
+    for option in ["variant_format", "variant_window_size", "variant_histograms"]:
+        if existing_metadata.get(option) != metadata[option]:
+            raise ValueError(
+                f"Existing output was written with {option} {existing_metadata.get(option)}, not {metadata[option]}"
+            )
+
+    for dataset in datasets:
+        existing_dataset_metadata = existing_metadata["datasets"].get(dataset, {})
+        for option in ["variant_field_split", "variant_files_by_group"]:
+            if existing_dataset_metadata.get(option) != metadata["datasets"][dataset].get(option):
+                raise ValueError(
+                    f"Existing output was written with {dataset} {option} {existing_dataset_metadata.get(option)}, "
+                    f"not {metadata['datasets'][dataset].get(option)}"
+                )
+
+
+def merge_metadata(existing_metadata, metadata):
+    """
+    Add metadata for the datasets written when updating an existing output directory to its existing metadata.
+    """
+    check_metadata_options(existing_metadata, metadata)
+
+    return {**existing_metadata, **metadata, "datasets": {**existing_metadata["datasets"], **metadata["datasets"]}}
+
+
+def output_metadata(
+    ds,
+    variant_format="rows",
+    variant_window_size=None,
+    variant_histogram_bins=None,
+    variant_field_splits=None,
+    variant_files_by_group=False,
+):
+    """
+    Return the contents of metadata.json for writing a table's datasets with the given options.
+    """
+    variant_histograms = (
+        {"n_bins": variant_histogram_bins, "categories": VARIANT_CONSEQUENCE_CATEGORIES}
+        if variant_histogram_bins
+        else None
+    )
+    meta = hl.eval(
+        hl.json(
+            ds.globals.meta.annotate(
+                variant_format=variant_format,
+                variant_window_size=hl.literal(variant_window_size, hl.tint32),
+                variant_histograms=hl.literal(
+                    variant_histograms, hl.tstruct(n_bins=hl.tint32, categories=hl.tarray(hl.tstr))
+                ),
+            )
+        )
+    )
+    meta = json.loads(meta)
+    for dataset, field_split in (variant_field_splits or {}).items():
+        meta["datasets"][dataset]["variant_field_split"] = field_split
+
+    if variant_files_by_group:
+        for dataset in ds.variants.dtype.fields:
+            meta["datasets"][dataset]["variant_files_by_group"] = True
+
+    return meta
+
+
+def write_gene_summary_file(
+    output_directory,
+    ds,
+    variant_format="rows",
+    variant_window_size=None,
+    gene_files=True,
+    update_existing=False,
+    autocomplete_prefix_length=AUTOCOMPLETE_PREFIX_LENGTH,
+    variant_histogram_bins=None,
+    variant_field_splits=None,
+    variant_files_by_group=False,
+):
+    os.makedirs(output_directory, exist_ok=True)
+
+    meta = output_metadata(
+        ds,
+        variant_format=variant_format,
+        variant_window_size=variant_window_size,
+        variant_histogram_bins=variant_histogram_bins,
+        variant_field_splits=variant_field_splits,
+        variant_files_by_group=variant_files_by_group,
+    )
+
+    if update_existing and os.path.exists(f"{output_directory}/metadata.json"):
+        # Keep the existing metadata of datasets whose files are not rewritten
+        meta["datasets"] = {
+            dataset: dataset_meta
+            for dataset, dataset_meta in meta["datasets"].items()
+            if dataset in ds.variants.dtype.fields
+        }
+
+        with open(f"{output_directory}/metadata.json", encoding="utf-8") as metadata_file:
+            meta = merge_metadata(json.load(metadata_file), meta)
+
+    with open(f"{output_directory}/metadata.json", mode="w", encoding="utf-8") as output_file:
+        json.dump(meta, output_file, separators=(",", ":"))
+
+    if gene_files:
+        gene_search_terms = ds.select(data=hl.json(hl.tuple([ds.gene_id, ds.search_terms])))
+        gene_search_terms.key_by().select("data").export(f"{output_directory}/gene_search_terms.json.txt", header=False)
+        os.remove(f"{output_directory}/.gene_search_terms.json.txt.crc")
+
+        with open(f"{output_directory}/gene_search_terms.json.txt", encoding="utf-8") as gene_search_terms_file:
+            write_gene_search_index(
+                f"{output_directory}/{GENE_SEARCH_INDEX_FILE}",
+                (json.loads(line) for line in gene_search_terms_file),
+                max_prefix_length=autocomplete_prefix_length,
+            )
+
+        gene_intervals = ds.select(
+            **{
+                reference_genome: hl.tuple(
+                    [ds[reference_genome].chrom, ds[reference_genome].start, ds[reference_genome].stop]
+                )
+                for reference_genome in REFERENCE_GENOMES
+            }
+        ).collect()
+        for reference_genome in REFERENCE_GENOMES:
+            write_gene_interval_index(
+                f"{output_directory}/{gene_interval_index_file(reference_genome)}",
+                ((row.gene_id, *row[reference_genome]) for row in gene_intervals),
+            )
+
+    export_gene_results(ds, f"{output_directory}/{GENE_RESULTS_TEMP_DIR}")
+
+
+def export_gene_results(ds, directory):
+    """
+    Export the gene results for all datasets in one pass over the table, as lines of dataset and result JSON.
+
+    Results for each dataset are in order of gene ID.
+    """
+    results = []
+    for dataset in ds.globals.meta.datasets.dtype.fields:
+        reference_genome = "GRCh38" if dataset in ["bipex", "ibd"] else "GRCh37"
+        result = hl.tuple(
+            [
+                ds.gene_id,
+                ds.symbol,
+                ds.name,
+                ds[reference_genome].chrom,
+                (ds[reference_genome].start + ds[reference_genome].stop) // 2,
+                ds.gene_results[dataset].group_results,
+            ]
+        )
+        results.append(hl.or_missing(hl.is_defined(ds.gene_results[dataset]), hl.tuple([dataset, hl.json(result)])))
+
+    ds = ds.select(results=hl.array(results).filter(hl.is_defined))
+    ds = ds.explode("results")
+    ds = ds.key_by().select(dataset=ds.results[0], result=ds.results[1])
+    ds.export(directory, header=False, parallel="separate_header")
+
+
+def decode_result_json(text):
+    """
+    Decode exported JSON and return it with a function to encode it (or parts of it) as the final output.
+    """
+    if ENCODED_NUL in text:
+        return json.loads(text), functools.partial(json.dumps, cls=ResultEncoder)
+
+    return loads_result_json(text), dumps_result_json
+
+
+def reencode_result_json(text):
+    data, encode = decode_result_json(text)
+    return encode(data)
+
+
+def result_sort_value(value):
+    """
+    Return a value to sort gene results by p-value, with missing and non-numeric values last.
+    """
+    if isinstance(value, str):
+        try:
+            value = float(value.strip(FLOAT_TOKEN_DELIMITER))
+        except ValueError:
+            return INFINITY
+
+    if value is None or value != value:  # pylint: disable=comparison-with-itself
+        return INFINITY
+
+    return value
+
+
+class GeneResultsPages:
+    """
+    Gene results for each of a dataset's analysis groups, written as pages sorted by the dataset's sort field.
+
+    Pages are written to results/{dataset}/{analysis group index}/{page}.json, each containing up to page_size
+    results of [gene ID, symbol, name, chrom, position, group result]. results/{dataset}/index.json lists the
+    analysis groups in order with their number of results and pages. Results with the same sort value (or none)
+    are in order of gene ID.
+    """
+
+    def __init__(self, dataset, dataset_meta, page_size=GENE_RESULTS_PAGE_SIZE):
+        self.dataset = dataset
+        self.analysis_groups = dataset_meta["gene_result_analysis_groups"]
+        self.page_size = page_size
+        self.sort_field = GENE_RESULTS_SORT_FIELDS.get(dataset)
+        if self.sort_field not in dataset_meta["gene_group_result_field_names"]:
+            self.sort_field = None
+
+        self.sort_field_index = (
+            dataset_meta["gene_group_result_field_names"].index(self.sort_field) if self.sort_field else None
+        )
+        self.group_results = [[] for _ in self.analysis_groups]
+
+    def add(self, result, encode):
+        *gene, group_results = result
+        for group_index, group_result in enumerate(group_results):
+            sort_value = (
+                result_sort_value(group_result[self.sort_field_index])
+                if group_result is not None and self.sort_field_index is not None
+                else INFINITY
+            )
+            self.group_results[group_index].append((sort_value, encode([*gene, group_result])))
+
+    def write(self, output_directory):
+        dataset_directory = f"{output_directory}/results/{self.dataset.lower()}"
+        if os.path.exists(dataset_directory):
+            shutil.rmtree(dataset_directory)
+
+        index = {"sort_field": self.sort_field, "page_size": self.page_size, "analysis_groups": []}
+        for group_index, (analysis_group, group_results) in enumerate(zip(self.analysis_groups, self.group_results)):
+            os.makedirs(f"{dataset_directory}/{group_index}")
+            group_results.sort(key=lambda group_result: group_result[0])
+
+            n_pages = math.ceil(len(group_results) / self.page_size)
+            for page in range(n_pages):
+                page_results = group_results[page * self.page_size : (page + 1) * self.page_size]
+                with open(f"{dataset_directory}/{group_index}/{page}.json", mode="w", encoding="utf-8") as page_file:
+                    page_file.write('{"results":[' + ",".join(encoded for _, encoded in page_results) + "]}")
+
+            index["analysis_groups"].append(
+                {"analysis_group": analysis_group, "n_results": len(group_results), "n_pages": n_pages}
+            )
+
+        os.makedirs(dataset_directory, exist_ok=True)
+        with open(f"{dataset_directory}/index.json", mode="w", encoding="utf-8") as index_file:
+            json.dump(index, index_file, separators=(",", ":"))
+
+
+def write_gene_results_files(output_directory, datasets, datasets_meta=None, page_size=GENE_RESULTS_PAGE_SIZE):
+    """
+    Write results/{dataset}.json files from gene results exported by export_gene_results.
+
+    Results are streamed from the exported part files to each dataset's file without collecting them in memory.
+    For datasets in datasets_meta (metadata for each dataset, as in metadata.json), sorted pages of results for
+    each analysis group are also written (see GeneResultsPages).
+    """
+    with METRICS.stage("write_gene_results"):
+        _write_gene_results_files(output_directory, datasets, datasets_meta or {}, page_size)
+
+
+def _write_gene_results_files(output_directory, datasets, datasets_meta, page_size):
+    temp_dir = f"{output_directory}/{GENE_RESULTS_TEMP_DIR}"
+    os.makedirs(f"{output_directory}/results", exist_ok=True)
+
+    pages = {
+        dataset: GeneResultsPages(dataset, dataset_meta, page_size=page_size)
+        for dataset, dataset_meta in datasets_meta.items()
+        if dataset in datasets
+    }
+
+    output_files = {
+        dataset: open(  # pylint: disable=consider-using-with
+            f"{output_directory}/results/{dataset.lower()}.json", mode="w", encoding="utf-8"
+        )
+        for dataset in datasets
+    }
+    try:
+        n_results = collections.Counter()
+        for output_file in output_files.values():
+            output_file.write('{"results":[')
+
+        for part_file in sorted(list_part_files(temp_dir)):
+            for dataset, result in iter_serialized_part_file(part_file):
+                if n_results[dataset]:
+                    output_files[dataset].write(",")
+
+                result, encode = decode_result_json(result)
+                output_files[dataset].write(encode(result))
+                n_results[dataset] += 1
+
+                if dataset in pages:
+                    pages[dataset].add(result, encode)
+
+        for output_file in output_files.values():
+            output_file.write("]}")
+    finally:
+        for output_file in output_files.values():
+            output_file.close()
+
+    for dataset_pages in pages.values():
+        dataset_pages.write(output_directory)
+
+    shutil.rmtree(temp_dir)
+
+
+def _dataset_variant_ids(variants, variant_id_index, dataset_index):
+    return variants.map(lambda variant: hl.struct(variant_id=variant[variant_id_index], dataset=dataset_index))
+
+
+def export_variant_index(ds, directory):
+    """
+    Export each variant in any dataset, as lines of reference genome, chromosome code, position, alleles, gene ID,
+    and a JSON array of indices of the datasets containing it in that gene.
+
+    Lines are sorted by the variant and then gene ID, so that part files can be read in order to write indices.
+    """
+    datasets = list(ds.globals.meta.datasets.dtype.fields)
+    datasets_meta = hl.eval(ds.globals.meta.datasets)
+    variant_id_index = hl.eval(ds.globals.meta.variant_fields).index("variant_id")
+
+    ds = ds.select(
+        variants=hl.flatten(
+            hl.array(
+                [
+                    _dataset_variant_ids(ds.variants[dataset], variant_id_index, dataset_index)
+                    for dataset_index, dataset in enumerate(datasets)
+                ]
+            )
+        )
+    )
+    ds = ds.explode("variants")
+
+    variant_id_parts = ds.variants.variant_id.split("-")
+    ds = ds.key_by().select(
+        reference_genome=hl.literal([datasets_meta[dataset].reference_genome for dataset in datasets])[
+            ds.variants.dataset
+        ],
+        chrom=hl.literal(CHROMOSOME_CODES).get(variant_id_parts[0]),
+        pos=hl.int(variant_id_parts[1]),
+        alleles=variant_id_parts[2] + "-" + variant_id_parts[3],
+        gene_id=ds.gene_id,
+        dataset=ds.variants.dataset,
+    )
+    ds = ds.filter(hl.is_defined(ds.chrom))
+
+    ds = ds.group_by("reference_genome", "chrom", "pos", "alleles", "gene_id").aggregate(
+        datasets=hl.json(hl.sorted(hl.array(hl.agg.collect_as_set(ds.dataset))))
+    )
+    ds.export(directory, header=False, parallel="separate_header")
+
+
+def write_variant_index_files(output_directory, gene_ids, datasets):
+    """
+    Write a variant index (see results_files.py) for each reference genome from variants exported by
+    export_variant_index.
+    """
+    temp_dir = f"{output_directory}/{VARIANT_INDEX_TEMP_DIR}"
+    writers = {}
+    try:
+        for part_file in sorted(list_part_files(temp_dir)):
+            for row in iter_part_file_rows(part_file):
+                reference_genome, chrom, pos, alleles, gene_id, dataset_indices = row
+                if reference_genome not in writers:
+                    writers[reference_genome] = VariantIndexWriter(
+                        f"{output_directory}/{variant_index_file(reference_genome)}", gene_ids, datasets
+                    )
+
+                writers[reference_genome].add(int(chrom), int(pos), alleles, gene_id, json.loads(dataset_indices))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for reference_genome, writer in writers.items():
+        print(f"Wrote variant index for {reference_genome} ({writer.n_records:,} records)")
+
+    shutil.rmtree(temp_dir)
+
+
+def compress(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+
+    if encoding == "brotli":
+        import brotli  # pylint: disable=import-outside-toplevel
+
+        return brotli.compress(data, quality=11)
+
+    raise ValueError(f"Unknown encoding '{encoding}'")
+
+
+def precompress_file(output_directory, encodings, relative_path):
+    with open(f"{output_directory}/{relative_path}", mode="rb") as input_file:
+        data = input_file.read()
+
+    for encoding in encodings:
+        with open(
+            f"{output_directory}/{relative_path}{PRECOMPRESSED_FILE_EXTENSIONS[encoding]}", mode="wb"
+        ) as out_file:
+            out_file.write(compress(data, encoding))
+
+
+def precompress_files(output_directory, relative_paths, encodings, workers=None):
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        pool.map(functools.partial(precompress_file, output_directory, encodings), relative_paths)
+
+
+def link_or_copy(source_path, destination_path):
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)
+
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        # Hard links are not possible across file systems
+        shutil.copyfile(source_path, destination_path)
+
+
+def read_source_hashes(directory):
+    try:
+        with open(f"{directory}/{SOURCE_HASHES_FILE}", encoding="utf-8") as source_hashes_file:
+            return json.load(source_hashes_file)
+    except FileNotFoundError:
+        return {}
+
+
+@functools.lru_cache(maxsize=None)
+def load_source_hashes(directory):
+    return read_source_hashes(directory)
+
+
+@functools.lru_cache(maxsize=None)
+def load_manifest(directory):
+    return read_manifest(directory)["files"]
+
+
+class FileWriter:
+    """
+    Writes output files relative to an output directory and counts what was written. The size and content hash of
+    each file are recorded for the manifest.
+
+    If previous_release_directory is given, files whose source hash matches the hash recorded for the same
+    path in the previous release are linked (or copied) from there instead of being encoded again.
+    """
+
+    def __init__(self, output_directory, previous_release_directory=None, hash_salt="", precompress=()):
+        self.output_directory = output_directory
+        self.previous_release_directory = previous_release_directory
+        self.hash_salt = hash_salt.encode("utf-8")
+        self.precompress = precompress
+        self.created_directories = set()
+        self.counters = collections.Counter()
+        self.source_hashes = {}
+        self.manifest = {}
+
+    def _make_directory(self, relative_path):
+        file_dir = os.path.dirname(relative_path)
+        if file_dir not in self.created_directories:
+            os.makedirs(f"{self.output_directory}/{file_dir}", exist_ok=True)
+            self.created_directories.add(file_dir)
+
+    def source_hash(self, source):
+        return hashlib.sha256(self.hash_salt + source.encode("utf-8")).hexdigest()[:32]
+
+    def _is_unchanged(self, relative_path, source_hash):
+        if not self.previous_release_directory:
+            return False
+
+        previous_source_hashes = load_source_hashes(self.previous_release_directory)
+        return previous_source_hashes.get(relative_path) == source_hash
+
+    def _previous_release_paths(self, relative_path):
+        return [relative_path] + [
+            relative_path + PRECOMPRESSED_FILE_EXTENSIONS[encoding] for encoding in self.precompress
+        ]
+
+    def can_link(self, relative_path, source_hash):
+        """
+        Check if a file is unchanged and it (and its precompressed copies) can be linked from the previous release.
+        """
+        return self._is_unchanged(relative_path, source_hash) and all(
+            os.path.exists(f"{self.previous_release_directory}/{path}")
+            for path in self._previous_release_paths(relative_path)
+        )
+
+    def link_unchanged(self, relative_path, source_hash):
+        if not self.can_link(relative_path, source_hash):
+            return False
+
+        relative_paths = self._previous_release_paths(relative_path)
+        self._make_directory(relative_path)
+        previous_manifest = load_manifest(self.previous_release_directory)
+        for path in relative_paths:
+            link_or_copy(f"{self.previous_release_directory}/{path}", f"{self.output_directory}/{path}")
+            self.manifest[path] = previous_manifest.get(path) or [
+                os.path.getsize(f"{self.output_directory}/{path}"),
+                hash_file(f"{self.output_directory}/{path}"),
+            ]
+
+        self.source_hashes[relative_path] = source_hash
+        self.counters["linked_files"] += 1
+        return True
+
+    def _write_bytes(self, relative_path, data):
+        self._make_directory(relative_path)
+        with open(f"{self.output_directory}/{relative_path}", mode="wb") as out_file:
+            out_file.write(data)
+
+        self.manifest[relative_path] = [len(data), content_hash(data)]
+
+        for encoding in self.precompress:
+            start = time.perf_counter()
+            compressed_data = compress(data, encoding)
+            compressed_path = relative_path + PRECOMPRESSED_FILE_EXTENSIONS[encoding]
+            with open(f"{self.output_directory}/{compressed_path}", mode="wb") as out_file:
+                out_file.write(compressed_data)
+
+            self.manifest[compressed_path] = [len(compressed_data), content_hash(compressed_data)]
+
+            self.counters[f"{encoding}_bytes"] += len(compressed_data)
+            self.counters["compress_seconds"] += time.perf_counter() - start
+
+    def write(self, relative_path, data, source_hash=None):
+        start = time.perf_counter()
+        data = data.encode("utf-8")
+        self._write_bytes(relative_path, data)
+        self.counters["write_seconds"] += time.perf_counter() - start
+
+        if source_hash:
+            self.source_hashes[relative_path] = source_hash
+
+        self.counters["files"] += 1
+        self.counters["bytes"] += len(data)
+
+    def results(self):
+        return {
+            "counters": self.counters,
+            "source_hashes": self.source_hashes,
+            "pack_entries": [],
+            "manifest": self.manifest,
+        }
+
+
+class PackWriter(FileWriter):
+    """
+    Appends files in gene directories to one pack file per directory instead of writing them as separate files.
+
+    The location of each file in its pack is recorded in pack_entries, from which pack indexes are written once
+    all files have been written. See results_files.py for the format.
+    """
+
+    def __init__(self, output_directory, previous_release_directory=None, hash_salt="", precompress=()):
+        if precompress:
+            raise ValueError("Precompressed files are not supported with packed output")
+
+        super().__init__(output_directory, previous_release_directory, hash_salt)
+        self.pack_entries = []
+
+    def _write_bytes(self, relative_path, data):
+        if not relative_path.startswith("genes/"):
+            super()._write_bytes(relative_path, data)
+            return
+
+        pack, key = pack_location(relative_path)
+        offset = append_to_pack(f"{self.output_directory}/{pack}.pack", data)
+        self.pack_entries.append((pack, key, offset, len(data)))
+        self.manifest[relative_path] = [len(data), content_hash(data)]
+
+    def can_link(self, relative_path, source_hash):
+        return (
+            self._is_unchanged(relative_path, source_hash)
+            and read_packed_file(self.previous_release_directory, relative_path) is not None
+        )
+
+    def link_unchanged(self, relative_path, source_hash):
+        if not self._is_unchanged(relative_path, source_hash):
+            return False
+
+        data = read_packed_file(self.previous_release_directory, relative_path)
+        if data is None:
+            return False
+
+        self._write_bytes(relative_path, data)
+
+        self.source_hashes[relative_path] = source_hash
+        self.counters["linked_files"] += 1
+        return True
+
+    def results(self):
+        return {**super().results(), "pack_entries": self.pack_entries}
+
+
+def create_writer(output_directory, options, track_source_hashes=False):
+    writer_class = PackWriter if options["output_format"] == "packed" else FileWriter
+    if track_source_hashes:
+        return writer_class(
+            output_directory,
+            options["previous_release_directory"],
+            output_format_key(options),
+            precompress=options["precompress"],
+        )
+
+    return writer_class(output_directory, precompress=options["precompress"])
+
+
+def is_regenerated_file(relative_path, options):
+    """
+    Check if a file in an existing output directory is replaced when updating it with the given options.
+    """
+    file_name = os.path.basename(relative_path)
+    for extension in PRECOMPRESSED_FILE_EXTENSIONS.values():
+        file_name = file_name.removesuffix(extension)
+
+    name_parts = file_name.removesuffix(".json").split("_")
+    if options["genes"] is not None and name_parts[0] not in options["genes"]:
+        return False
+
+    if len(name_parts) == 2:
+        return options["gene_files"] and name_parts[1] in REFERENCE_GENOMES
+
+    return (
+        len(name_parts) >= 3
+        and name_parts[2].startswith("variants")
+        and name_parts[1] in {dataset.lower() for dataset in options["datasets"]}
+    )
+
+
+def remove_regenerated_files(output_directory, options):
+    """
+    Remove files (and their source hashes and manifest entries) that are replaced when updating an existing output directory.
+
+    Files are removed instead of overwritten in case they are hard links to files in a previous release.
+    """
+    if options["genes"] is not None:
+        # Only list the directories of the selected genes, instead of every file in the output directory
+        paths = [
+            path
+            for gene_id in options["genes"]
+            for path in glob.glob(f"{output_directory}/{gene_data_directory(gene_id)}/{gene_id}_*")
+        ]
+    else:
+        paths = glob.glob(f"{output_directory}/genes/*/*")
+
+    for path in paths:
+        if is_regenerated_file(path, options):
+            os.remove(path)
+
+    source_hashes = read_source_hashes(output_directory)
+    if source_hashes:
+        with open(f"{output_directory}/{SOURCE_HASHES_FILE}", mode="w", encoding="utf-8") as output_file:
+            json.dump(
+                {
+                    path: source_hash
+                    for path, source_hash in source_hashes.items()
+                    if not is_regenerated_file(path, options)
+                },
+                output_file,
+                separators=(",", ":"),
+            )
+
+    manifest_files = read_manifest(output_directory)["files"]
+    write_manifest(
+        output_directory,
+        {path: entry for path, entry in manifest_files.items() if not is_regenerated_file(path, options)},
+    )
+
+
+def prepare_output_directory(output_directory, options):
+    os.makedirs(f"{output_directory}/genes", exist_ok=True)
+
+    if options["update_existing"]:
+        remove_regenerated_files(output_directory, options)
+
+    if options["output_format"] == "packed":
+        # Files are appended to packs, so remove any packs left from a previous run.
+        for path in glob.glob(f"{output_directory}/genes/*.pack") + glob.glob(f"{output_directory}/genes/*.idx"):
+            os.remove(path)
+
+
+def empty_write_results():
+    return {"counters": collections.Counter(), "source_hashes": {}, "pack_entries": [], "manifest": {}}
+
+
+def merge_write_results(results, part_results):
+    METRICS.add_counters(part_results["counters"])
+    results["counters"].update(part_results["counters"])
+    results["source_hashes"].update(part_results["source_hashes"])
+    results["pack_entries"].extend(part_results["pack_entries"])
+    results["manifest"].update(part_results["manifest"])
+
+
+def finish_writing(output_directory, results, update_existing=False):
+    counters = results["counters"]
+    print(f"Wrote {counters['files']:,} files ({counters['bytes']:,} bytes)")
+    for encoding in PRECOMPRESSED_FILE_EXTENSIONS:
+        if counters[f"{encoding}_bytes"]:
+            print(f"Wrote {encoding} compressed copies ({counters[f'{encoding}_bytes']:,} bytes)")
+    if counters["linked_files"]:
+        print(f"Linked {counters['linked_files']:,} unchanged files from previous release")
+
+    source_hashes = results["source_hashes"]
+    if update_existing:
+        source_hashes = {**read_source_hashes(output_directory), **source_hashes}
+
+    if source_hashes:
+        with open(f"{output_directory}/{SOURCE_HASHES_FILE}", mode="w", encoding="utf-8") as output_file:
+            json.dump(dict(sorted(source_hashes.items())), output_file, separators=(",", ":"))
+
+    pack_entries = collections.defaultdict(list)
+    for pack, key, offset, length in results["pack_entries"]:
+        pack_entries[pack].append((key, offset, length))
+
+    for pack, entries in pack_entries.items():
+        write_pack_index(f"{output_directory}/{pack}.idx", entries)
+
+    manifest_files = results["manifest"]
+    if update_existing:
+        manifest_files = {**read_manifest(output_directory)["files"], **manifest_files}
+
+    write_manifest(output_directory, manifest_files)
+
+
+def write_manifest(output_directory, manifest_files, release_generation_id=None):
+    with open(f"{output_directory}/{MANIFEST_FILE}", mode="w", encoding="utf-8") as output_file:
+        json.dump(
+            {"generation_id": release_generation_id, "files": dict(sorted(manifest_files.items()))},
+            output_file,
+            separators=(",", ":"),
+        )
+
+
+def write_availability_file(output_directory, variant_counts, update_existing=False):
+    """
+    Write availability.bin (see results_files.py) for the gene and variants files listed in the manifest.
+
+    variant_counts maps gene ID to the number of variants in each dataset for genes written in this run. When
+    updating an existing output directory, counts for other genes and datasets are kept from its availability file.
+    """
+    with open(f"{output_directory}/metadata.json", encoding="utf-8") as metadata_file:
+        datasets = list(json.load(metadata_file)["datasets"])
+
+    dataset_names = {dataset.lower(): dataset for dataset in datasets}
+
+    all_variant_counts = {}
+    if update_existing and os.path.exists(f"{output_directory}/{AVAILABILITY_FILE}"):
+        with GeneAvailability(f"{output_directory}/{AVAILABILITY_FILE}") as availability:
+            all_variant_counts = {
+                gene_id: gene_variant_counts for gene_id, (_, gene_variant_counts) in availability.genes().items()
+            }
+
+    for gene_id, gene_variant_counts in variant_counts.items():
+        all_variant_counts.setdefault(gene_id, {}).update(gene_variant_counts)
+
+    genes = collections.defaultdict(lambda: (set(), {}))
+    for relative_path in read_manifest(output_directory)["files"]:
+        kind, dataset, encoding = classify_file(relative_path)
+        if kind not in ("gene", "variants") or encoding:
+            continue
+
+        gene_id, name_part = os.path.basename(relative_path).removesuffix(".json").split("_")[:2]
+        if kind == "gene":
+            genes[gene_id][0].add(name_part)
+        else:
+            if dataset not in dataset_names:
+                raise ValueError(f"{relative_path} in the manifest is for a dataset not in metadata.json")
+
+            dataset = dataset_names[dataset]
+            genes[gene_id][1][dataset] = all_variant_counts.get(gene_id, {}).get(dataset, 0)
+
+    write_gene_availability(f"{output_directory}/{AVAILABILITY_FILE}", REFERENCE_GENOMES, datasets, genes)
+
+
+def finish_manifest(output_directory):
+    """
+    Add files outside of gene directories (written separately from gene and variants files) to the manifest, and
+    record the release's generation ID in the manifest and metadata.json.
+    """
+    manifest_files = {
+        relative_path: entry
+        for relative_path, entry in read_manifest(output_directory)["files"].items()
+        if relative_path.startswith("genes/")
+    }
+
+    for root, directories, file_names in os.walk(output_directory):
+        if root == output_directory and "genes" in directories:
+            directories.remove("genes")
+
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(path, output_directory)
+            if relative_path not in (MANIFEST_FILE, "metadata.json"):
+                manifest_files[relative_path] = [os.path.getsize(path), hash_file(path)]
+
+    release_generation_id = generation_id(manifest_files)
+
+    with open(f"{output_directory}/metadata.json", encoding="utf-8") as metadata_file:
+        metadata = json.load(metadata_file)
+
+    metadata["generation_id"] = release_generation_id
+    with open(f"{output_directory}/metadata.json", mode="w", encoding="utf-8") as metadata_file:
+        json.dump(metadata, metadata_file, separators=(",", ":"))
+
+    manifest_files["metadata.json"] = [
+        os.path.getsize(f"{output_directory}/metadata.json"),
+        hash_file(f"{output_directory}/metadata.json"),
+    ]
+    write_manifest(output_directory, manifest_files, release_generation_id)
+
+    print(f"Wrote manifest for {len(manifest_files):,} files, generation {release_generation_id}")
+
 
-class ResultEncoder(json.JSONEncoder):
+def iter_part_file_rows(part_file):
+    csv.field_size_limit(sys.maxsize)
+    with open(part_file, encoding="utf-8") as data_file:
+        reader = csv.reader(data_file, delimiter="\t")
+        for row in reader:
+            yield row
+
+
+def iter_serialized_part_file(part_file):
+    with open(part_file, encoding="utf-8") as data_file:
+        for line in data_file:
+            yield line.rstrip("\n").split("\t", 1)
+
+
+def list_part_files(directory):
+    return glob.glob(f"{directory}/part-*")
+
+
+def write_json_files(output_directory, tsv_dirname, n_rows, options, workers=None):
+    prepare_output_directory(output_directory, options)
+
+    def iter_part_files(directory):
+        for part_file in list_part_files(directory):
+            yield from iter_part_file_rows(part_file)
+
+    writer = create_writer(output_directory, options)
+    writer.counters["read_bytes"] = directory_size(f"{output_directory}/{tsv_dirname}")
+    METRICS.workers = workers or os.cpu_count()
+    with METRICS.stage("write_files"), multiprocessing.get_context("spawn").Pool(workers) as pool:
+        row_generator = timed_iter(
+            iter_part_files(f"{output_directory}/{tsv_dirname}"), writer.counters, "read_seconds"
+        )
+        for gene_files in tqdm(
+            pool.imap(
+                functools.partial(
+                    split_data,
+                    datasets=options["datasets"],
+                    variant_format=options["variant_format"],
+                    variant_window_size=options["variant_window_size"],
+                    variant_position_index=options["variant_position_index"],
+                    gene_files=options["gene_files"],
+                    variant_splits=options["variant_splits"],
+                    variant_group_counts=options["variant_group_counts"],
+                    variant_group_results_index=options["variant_group_results_index"],
+                ),
+                row_generator,
+            ),
+            total=n_rows,
+        ):
+            for relative_path, data in gene_files:
+                writer.write(relative_path, data)
+
+    results = empty_write_results()
+    merge_write_results(results, writer.results())
+    finish_writing(output_directory, results, update_existing=options["update_existing"])
+
+    shutil.rmtree(f"{output_directory}/{tsv_dirname}")
+
+
+def write_serialized_files(output_directory, tsv_dirname, options):
     """
-    JSON encoder that supports Hail Structs and limits precision of floats.
+    Write files from a table exported with serialize_in_hail, where each row is a relative path and that file's JSON.
     """
+    prepare_output_directory(output_directory, options)
 
-    def default(self, o):  # pylint: disable=method-hidden
-        if isinstance(o, hl.Struct):
-            return dict(o)
+    def iter_part_files(directory):
+        for part_file in list_part_files(directory):
+            yield from iter_serialized_part_file(part_file)
 
-        return super().default(o)
+    writer = create_writer(output_directory, options)
+    writer.counters["read_bytes"] = directory_size(f"{output_directory}/{tsv_dirname}")
+    with METRICS.stage("write_files"):
+        files = timed_iter(iter_part_files(f"{output_directory}/{tsv_dirname}"), writer.counters, "read_seconds")
+        for relative_path, data in tqdm(files, unit="files"):
+            writer.write(relative_path, data)
 
-    def iterencode(self, o, _one_shot=False):
-        def floatstr(o, **kwargs):  # pylint: disable=unused-argument
-            if o != o:
-                return '"NaN"'
-            elif o == INFINITY:
-                return '"Infinity"'
-            elif o == -INFINITY:
-                return '"-Infinity"'
+    results = empty_write_results()
+    merge_write_results(results, writer.results())
+    finish_writing(output_directory, results, update_existing=options["update_existing"])
 
-            return "{:.5g}".format(o)
+    shutil.rmtree(f"{output_directory}/{tsv_dirname}")
 
-        _iterencode = _make_iterencode(
-            {},
-            self.default,
-            encode_basestring_ascii,
-            None,  # indent,
-            floatstr,
-            ":",  # key_separator,
-            ",",  # item_separator,
-            False,  #  sort_keys,
-            False,  #  skipkeys,
-            _one_shot,
+
+def output_format_key(options):
+    """
+    Identify the options that affect the contents of output files, so that changing them invalidates source hashes.
+    """
+    return json.dumps({option: options[option] for option in OUTPUT_FORMAT_OPTIONS}, sort_keys=True)
+
+
+def variants_file_dependents(gene_id, dataset, options, previous_source_hashes):
+    """
+    Return the paths of the other files written from a dataset's variants for a gene: windows (as listed in the
+    previous release's source hashes), detail files, and analysis group files.
+    """
+    windows = []
+    while variant_window_file_path(gene_id, dataset, len(windows)) in previous_source_hashes:
+        windows.append(variant_window_file_path(gene_id, dataset, len(windows)))
+
+    details = []
+    if dataset in options["variant_splits"]:
+        details = [variant_detail_file_path(path) for path in windows or [variants_file_path(gene_id, dataset)]]
+
+    groups = [
+        variant_group_file_path(gene_id, dataset, group_index)
+        for group_index in range(options["variant_group_counts"].get(dataset, 0))
+    ]
+    return windows + details + groups
+
+
+def write_part_file(output_directory, options, part_file, remove_part_file=False):
+    """
+    Read, split, and write all files for one part file. Used by workers in write_part_files_in_workers.
+
+    Returns counters, the source hash of each file written, and the location of files appended to packs.
+    """
+    start = time.perf_counter()
+    writer = create_writer(output_directory, options, track_source_hashes=True)
+    writer.counters["read_bytes"] += os.path.getsize(part_file)
+    previous_source_hashes = (
+        load_source_hashes(options["previous_release_directory"]) if options["previous_release_directory"] else {}
+    )
+
+    if options["serialize_in_hail"]:
+        for relative_path, data in timed_iter(iter_serialized_part_file(part_file), writer.counters, "read_seconds"):
+            source_hash = writer.source_hash(data)
+            if not writer.link_unchanged(relative_path, source_hash):
+                writer.write(relative_path, data, source_hash=source_hash)
+    else:
+        for row in timed_iter(iter_part_file_rows(part_file), writer.counters, "read_seconds"):
+            source_hashes = {
+                path: writer.source_hash(source)
+                for path, source in gene_file_sources(
+                    row, options["datasets"], gene_files=options["gene_files"]
+                ).items()
+            }
+            # Windows, detail, and group files are recorded with the same source hash as their variants file. A
+            # variants file is only linked if all of them can be linked too, otherwise the dataset is written again.
+            dependent_paths = {
+                variants_file_path(row[0], dataset): variants_file_dependents(
+                    row[0], dataset, options, previous_source_hashes
+                )
+                for dataset in options["datasets"]
+            }
+            linked_paths = set()
+            for path, source_hash in source_hashes.items():
+                paths = [path, *dependent_paths.get(path, [])]
+                if all(writer.can_link(linked_path, source_hash) for linked_path in paths):
+                    for linked_path in paths:
+                        writer.link_unchanged(linked_path, source_hash)
+
+                    linked_paths.add(path)
+
+            for relative_path, data in split_data(
+                row,
+                options["datasets"],
+                skip_paths=linked_paths,
+                variant_format=options["variant_format"],
+                variant_window_size=options["variant_window_size"],
+                variant_position_index=options["variant_position_index"],
+                gene_files=options["gene_files"],
+                variant_splits=options["variant_splits"],
+                variant_group_counts=options["variant_group_counts"],
+                variant_group_results_index=options["variant_group_results_index"],
+                counters=writer.counters,
+            ):
+                writer.write(relative_path, data, source_hash=source_hashes[source_file_path(relative_path)])
+
+            writer.counters["genes"] += 1
+
+    if remove_part_file:
+        os.remove(part_file)
+
+    writer.counters["busy_seconds"] += time.perf_counter() - start
+    return writer.results()
+
+
+def write_part_files_in_workers(output_directory, tsv_dirname, options, workers=None):
+    """
+    Write files with each worker processing whole part files, so that only counters are sent between processes.
+
+    Part files are scheduled largest first so that the largest parts do not end up running last.
+    """
+    prepare_output_directory(output_directory, options)
+
+    part_files = sorted(list_part_files(f"{output_directory}/{tsv_dirname}"), key=os.path.getsize, reverse=True)
+
+    results = empty_write_results()
+    METRICS.workers = workers or os.cpu_count()
+    with METRICS.stage("write_files"), multiprocessing.get_context("spawn").Pool(workers) as pool:
+        for part_results in tqdm(
+            pool.imap_unordered(functools.partial(write_part_file, output_directory, options), part_files),
+            total=len(part_files),
+            unit="parts",
+        ):
+            merge_write_results(results, part_results)
+
+    finish_writing(output_directory, results, update_existing=options["update_existing"])
+
+    shutil.rmtree(f"{output_directory}/{tsv_dirname}")
+
+
+def export_part_files(ds, directory, serialize_in_hail=False, gene_files=True):
+    if serialize_in_hail:
+        ds = ds.select(files=serialized_files_expr(ds, gene_files=gene_files))
+        ds = ds.explode("files")
+        ds = ds.key_by().select(path=ds.files.path, data=ds.files.data)
+        ds.export(directory, header=False, parallel="separate_header")
+    else:
+        # Export the gene and each dataset's variants separately so that each output file's source can be hashed
+        ds.select(
+            gene=hl.json(ds.row.drop("variants")),
+            **{dataset: hl.json(ds.variants[dataset]) for dataset in ds.variants.dtype.fields},
+        ).export(
+            directory,
+            header=False,
+            parallel="separate_header",
         )
-        return _iterencode(o, 0)
 
 
-def split_data(row):
-    gene_id = row[0]
-    gene = json.loads(row[1])
-    all_variants = gene.pop("variants")
-    gene_grch37 = gene.pop("GRCh37")
-    gene_grch38 = gene.pop("GRCh38")
+def export_and_write_files(ds, output_directory, n_rows, options, partition_parallel=False, workers=None):
+    temp_dir_name = "temp_parts"
 
-    if gene_grch37:
-        gene_grch37 = {**gene, "reference_genome": "GRCh37", **gene_grch37}
-        gene_grch37 = json.dumps({"gene": gene_grch37}, cls=ResultEncoder)
+    with METRICS.stage("export_parts"):
+        export_part_files(
+            ds,
+            f"{output_directory}/{temp_dir_name}",
+            serialize_in_hail=options["serialize_in_hail"],
+            gene_files=options["gene_files"],
+        )
 
-    if gene_grch38:
-        gene_grch38 = {**gene, "reference_genome": "GRCh38", **gene_grch38}
-        gene_grch38 = json.dumps({"gene": gene_grch38}, cls=ResultEncoder)
+    if partition_parallel:
+        write_part_files_in_workers(output_directory, temp_dir_name, options, workers=workers)
+    elif options["serialize_in_hail"]:
+        write_serialized_files(output_directory, temp_dir_name, options)
+    else:
+        write_json_files(output_directory, temp_dir_name, n_rows, options, workers=workers)
 
-    all_variants = {k: json.dumps({"variants": v}, cls=ResultEncoder) for k, v in all_variants.items()}
 
-    return gene_id, gene_grch37, gene_grch38, all_variants
+def directory_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass  # Removed by a worker since listing the directory
 
+    return size
 
-def write_gene_summary_file(output_directory, ds):
-    os.makedirs(output_directory, exist_ok=True)
 
-    with open(f"{output_directory}/metadata.json", mode="w", encoding="utf-8") as output_file:
-        output_file.write(hl.eval(hl.json(ds.globals.meta)))
+def pending_part_files_size(directory):
+    """
+    Return the total size of the part files in batch directories under a directory that have not yet been written
+    out and removed. Other files that Hail exports with part files (e.g. checksums) are left until the end.
+    """
+    size = 0
+    for part_file in glob.glob(f"{directory}/*/part-*"):
+        try:
+            size += os.path.getsize(part_file)
+        except FileNotFoundError:
+            pass  # Removed by a worker since listing the directory
 
-    gene_search_terms = ds.select(data=hl.json(hl.tuple([ds.gene_id, ds.search_terms])))
-    gene_search_terms.key_by().select("data").export(f"{output_directory}/gene_search_terms.json.txt", header=False)
-    os.remove(f"{output_directory}/.gene_search_terms.json.txt.crc")
+    return size
 
-    ds = ds.drop("previous_symbols", "alias_symbols", "search_terms")
 
-    os.makedirs(f"{output_directory}/results", exist_ok=True)
-    for dataset in ds.globals.meta.datasets.dtype.fields:
-        reference_genome = "GRCh38" if dataset in ["bipex", "ibd"] else "GRCh37"
-        gene_results = ds.filter(hl.is_defined(ds.gene_results[dataset]))
-        gene_results = gene_results.select(
-            result=hl.tuple(
-                [
-                    gene_results.gene_id,
-                    gene_results.symbol,
-                    gene_results.name,
-                    gene_results[reference_genome].chrom,
-                    (gene_results[reference_genome].start + gene_results[reference_genome].stop) // 2,
-                    gene_results.gene_results[dataset].group_results,
-                ]
+def stream_export_and_write_files(ds, output_directory, options, workers=None, max_temp_disk_gb=None):
+    """
+    Export batches of partitions and write files from each batch's part files while the next batch is exported.
+
+    Workers remove each part file once it has been written out. If max_temp_disk_gb is set, exporting the next
+    batch waits until the exported part files remaining on disk take up less than that. Since a whole batch is
+    exported at once, temporary data on disk may exceed the limit by up to one batch.
+    """
+    temp_dir = f"{output_directory}/temp_parts"
+    prepare_output_directory(output_directory, options)
+
+    workers = workers or os.cpu_count()
+    max_temp_disk_bytes = max_temp_disk_gb * 1024**3 if max_temp_disk_gb else None
+
+    n_partitions = ds.n_partitions()
+    batch_starts = range(0, n_partitions, workers)
+
+    results = empty_write_results()
+    METRICS.workers = workers
+    with METRICS.stage("write_files"), multiprocessing.get_context("spawn").Pool(workers) as pool, tqdm(
+        total=n_partitions, unit="parts"
+    ) as pbar:
+        pending = []
+
+        def collect_part_result(result):
+            merge_write_results(results, result.get())
+            pbar.update(1)
+
+        def collect_finished_parts():
+            nonlocal pending
+            still_pending = []
+            for result in pending:
+                if result.ready():
+                    collect_part_result(result)
+                else:
+                    still_pending.append(result)
+
+            pending = still_pending
+
+        for batch_number, batch_start in enumerate(batch_starts):
+            collect_finished_parts()
+            with METRICS.stage("wait_for_disk"):
+                while max_temp_disk_bytes and pending and pending_part_files_size(temp_dir) > max_temp_disk_bytes:
+                    time.sleep(1)
+                    collect_finished_parts()
+
+            batch_dir = f"{temp_dir}/batch-{batch_number:05d}"
+            batch = ds._filter_partitions(  # pylint: disable=protected-access
+                range(batch_start, min(batch_start + workers, n_partitions))
             )
+            with METRICS.stage("export_parts"):
+                export_part_files(
+                    batch, batch_dir, serialize_in_hail=options["serialize_in_hail"], gene_files=options["gene_files"]
+                )
+
+            for part_file in sorted(list_part_files(batch_dir), key=os.path.getsize, reverse=True):
+                pending.append(
+                    pool.apply_async(
+                        write_part_file,
+                        (output_directory, options, part_file),
+                        {"remove_part_file": True},
+                    )
+                )
+
+        for result in pending:
+            collect_part_result(result)
+
+    finish_writing(output_directory, results, update_existing=options["update_existing"])
+
+    shutil.rmtree(temp_dir)
+
+
+def annotate_variant_counts(ds):
+    expected_datasets = [
+        "ASC",
+        "BipEx",
+        "BipEx2",
+        "Epi25",
+        "GP2",
+        "IBD",
+        "SCHEMA",
+        "SCHEMA2",
+        "ClinVarGRCh38",
+    ]
+
+    counts_expr = {}
+    for name in expected_datasets:
+        if name in ds.variants:
+            counts_expr[name] = hl.or_else(hl.len(ds.variants[name]), 0)
+        else:
+            counts_expr[name] = 0
+
+    ds = ds.annotate(variant_counts=hl.struct(**counts_expr))
+
+    ds = ds.annotate(
+        total_variants=(
+            ds.variant_counts.ASC
+            + ds.variant_counts.BipEx
+            + ds.variant_counts.BipEx2
+            + ds.variant_counts.Epi25
+            + ds.variant_counts.GP2
+            + ds.variant_counts.IBD
+            + ds.variant_counts.SCHEMA
+            + ds.variant_counts.SCHEMA2
+            + ds.variant_counts.ClinVarGRCh38
         )
-        gene_results = gene_results.collect()
+    )
 
-        gene_results = [r.result for r in gene_results]
+    return ds
 
-        with open(
-            f"{output_directory}/results/{dataset.lower()}.json",
-            mode="w",
-            encoding="utf-8",
-        ) as output_file:
-            output_file.write(json.dumps({"results": gene_results}, cls=ResultEncoder))
 
+def remove_large_genes(ds):
+    ds = annotate_variant_counts(ds)
+    ds = ds.filter(ds.total_variants <= VARIANT_THRESHOLD)
+    return ds.drop("variant_counts", "total_variants")
 
-def write_json_files(output_directory, tsv_dirname, n_rows):
-    csv.field_size_limit(sys.maxsize)
-    os.makedirs(f"{output_directory}/genes", exist_ok=True)
 
-    def iter_part_files(directory):
-        for part_file in glob.glob(f"{directory}/part-*"):
-            with open(part_file, encoding="utf-8") as data_file:
-                reader = csv.reader(data_file, delimiter="\t")
-                for row in reader:
-                    yield row
-
-    with multiprocessing.get_context("spawn").Pool() as pool:
-        row_generator = iter_part_files(f"{output_directory}/{tsv_dirname}")
-        for gene_id, gene_grch37, gene_grch38, all_variants in tqdm(pool.imap(split_data, row_generator), total=n_rows):
-            num = int(gene_id.lstrip("ENSGR"))
-            gene_dir = f"{output_directory}/genes/{str(num % 1000).zfill(3)}"
-            os.makedirs(gene_dir, exist_ok=True)
-
-            if gene_grch37:
-                with open(f"{gene_dir}/{gene_id}_GRCh37.json", mode="w", encoding="utf-8") as out_file:
-                    out_file.write(gene_grch37)
-
-            if gene_grch38:
-                with open(f"{gene_dir}/{gene_id}_GRCh38.json", mode="w", encoding="utf-8") as out_file:
-                    out_file.write(gene_grch38)
-
-            for dataset, dataset_variants in all_variants.items():
-                if dataset_variants:
-                    with open(
-                        f"{gene_dir}/{gene_id}_{dataset.lower()}_variants.json",
-                        mode="w",
-                        encoding="utf-8",
-                    ) as out_file:
-                        out_file.write(dataset_variants)
+def weighted_partition_starts(weights, n_partitions):
+    """
+    Split a sequence of rows into at most n_partitions contiguous partitions of roughly equal total weight.
 
-    shutil.rmtree(f"{output_directory}/{tsv_dirname}")
+    Partitions are filled in order up to the average weight of the remaining rows per remaining partition. A row
+    heavier than that takes up a partition of its own.
+
+    Returns the index of the first row of each partition.
+    """
+    starts = []
+    remaining_weight = sum(weights)
+    remaining_partitions = n_partitions
+    partition_weight = 0
+    for i, weight in enumerate(weights):
+        if not starts:
+            starts.append(i)
+        elif (
+            partition_weight
+            and remaining_partitions > 1
+            and partition_weight + weight / 2 >= remaining_weight / remaining_partitions
+        ):
+            starts.append(i)
+            remaining_weight -= partition_weight
+            remaining_partitions -= 1
+            partition_weight = 0
+
+        partition_weight += weight
+
+    return starts
 
 
-def write_data_files(table_path, output_directory, genes=None):
+def weighted_partition_intervals(ds, n_partitions):
+    """
+    Split a table annotated with variant counts into key intervals with roughly equal numbers of variants.
+
+    Writing a gene's files takes time roughly proportional to its number of variants, so partitioning by number
+    of rows leaves a few partitions containing the largest genes taking much longer than the rest.
+
+    Returns a list of intervals for hl.read_table, the total weight of each interval, and the number of variants in
+    each dataset for each gene (collected in the same pass, see collect_variant_counts).
+    """
+    datasets = list(ds.variants.dtype.fields)
+    # Include a fixed weight per gene for its gene files
+    rows = ds.select(weight=ds.total_variants + 1, variant_counts=ds.variant_counts.select(*datasets)).collect()
+    weights = [row.weight for row in rows]
+    keys = [row.drop("weight", "variant_counts") for row in rows]
+    variant_counts = {row.gene_id: dict(row.variant_counts) for row in rows}
+
+    starts = weighted_partition_starts(weights, n_partitions)
+    ends = starts[1:] + [len(rows)]
+    intervals = [
+        hl.Interval(keys[start], keys[end - 1], includes_start=True, includes_end=True)
+        for start, end in zip(starts, ends)
+    ]
+    partition_weights = [sum(weights[start:end]) for start, end in zip(starts, ends)]
+    return intervals, partition_weights, variant_counts
+
+
+def collect_variant_counts(ds):
+    """
+    Return a map of gene ID to the number of variants in each dataset.
+    """
+    datasets = list(ds.variants.dtype.fields)
+    ds = annotate_variant_counts(ds)
+    rows = ds.select(variant_counts=ds.variant_counts.select(*datasets)).collect()
+    return {row.gene_id: dict(row.variant_counts) for row in rows}
+
+
+def print_partition_weights(partition_weights):
+    partition_weights = sorted(partition_weights)
+    mean_weight = sum(partition_weights) / len(partition_weights)
+    print(
+        f"Split genes into {len(partition_weights):,} partitions weighted by number of variants: "
+        f"min {partition_weights[0]:,}, median {partition_weights[len(partition_weights) // 2]:,}, "
+        f"max {partition_weights[-1]:,} ({partition_weights[-1] / mean_weight:.2f}x mean)"
+    )
+
+
+def select_genes(ds, genes):
+    """
+    Select rows for a list of gene IDs by the table's gene_id key, so that only partitions containing those genes
+    are read instead of filtering every row of the table.
+    """
+    intervals = [
+        hl.Interval(hl.Struct(gene_id=gene_id), hl.Struct(gene_id=gene_id), includes_end=True, point_type=ds.key.dtype)
+        for gene_id in sorted(genes)
+    ]
+    return hl.filter_intervals(ds, intervals)
+
+
+def read_gene_list(path):
+    """
+    Read gene IDs from a file with one gene ID per line.
+    """
+    with open(path, encoding="utf-8") as gene_list_file:
+        return [line.strip() for line in gene_list_file if line.strip()]
+
+
+def select_datasets(ds, datasets):
+    ds = ds.annotate_globals(meta=ds.globals.meta.annotate(datasets=ds.globals.meta.datasets.select(*datasets)))
+    return ds.annotate(variants=ds.variants.select(*datasets))
+
+
+def write_data_files(
+    table_path,
+    output_directory,
+    genes=None,
+    serialize_in_hail=False,
+    partition_parallel=False,
+    workers=None,
+    stream=False,
+    max_temp_disk_gb=None,
+    previous_release_directory=None,
+    output_format="files",
+    precompress=(),
+    variant_format="rows",
+    variant_window_size=None,
+    datasets=None,
+    gene_files=True,
+    skip_summary_files=False,
+    autocomplete_prefix_length=AUTOCOMPLETE_PREFIX_LENGTH,
+    variant_histogram_bins=None,
+    variant_core_fields=None,
+    variant_files_by_group=False,
+    variant_index=False,
+):
+    """
+    If datasets is given, update an existing output directory with the results and variants files for only those
+    datasets, and with gene files only if gene_files is true. Other files in the output directory are left as is.
+    Gene files include gene results for all datasets, and are always rewritten if variant_histogram_bins is given.
+
+    If skip_summary_files is true, update an existing output directory with the files for only the given genes,
+    leaving metadata, search terms, and results files as they are. Otherwise, genes can only be given for a new output
+    directory or with datasets.
+
+    If variant_histogram_bins is given, gene files include histograms of each dataset's variants with this many bins.
+
+    variant_core_fields maps datasets to the fields written to their variants files (see variant_field_split). Other
+    fields are written to variant detail files.
+
+    If variant_files_by_group is true, each dataset's variants files contain variant annotations, and the results for
+    each analysis group are written to separate files.
+
+    If variant_index is true, variant indices are written for all datasets. This groups every variant in the table
+    by position, so it is only done when requested.
+    """
     if output_directory.startswith("gs://"):
         raise ValueError("Google Storage paths are not supported for output_directory")
 
+    if previous_release_directory and os.path.realpath(previous_release_directory) == os.path.realpath(
+        output_directory
+    ):
+        raise ValueError("previous_release_directory must be different from output_directory")
+
+    if skip_summary_files:
+        if not genes:
+            raise ValueError("skip_summary_files requires genes")
+
+        if not os.path.exists(f"{output_directory}/metadata.json"):
+            raise ValueError("skip_summary_files requires an existing output directory")
+
+    # The manifest and availability file would only list the given genes' files
+    if genes and datasets is None and not skip_summary_files and os.path.exists(f"{output_directory}/metadata.json"):
+        raise ValueError("Writing genes to an existing output directory requires skip_summary_files or datasets")
+
     ds = hl.read_table(table_path)
+    # Annotate histograms before selecting datasets, since gene files include data for all datasets
+    if variant_histogram_bins:
+        ds = annotate_variant_histograms(ds, variant_histogram_bins)
 
-    write_gene_summary_file(output_directory, ds)
+    ds_all_datasets = ds
 
-    if genes:
-        ds = ds.filter(hl.set(genes).contains(ds.gene_id))
+    update_existing = datasets is not None or skip_summary_files
+    if datasets is not None:
+        available_datasets = list(ds.globals.meta.datasets.dtype.fields)
+        unknown_datasets = [dataset for dataset in datasets if dataset not in available_datasets]
+        if unknown_datasets:
+            raise ValueError(f"Unknown datasets {unknown_datasets}, choose from {available_datasets}")
 
-        temp_dir_name = "temp_parts"
-        n_rows = ds.count()
-        ds.select(data=hl.json(ds.row)).export(
-            f"{output_directory}/{temp_dir_name}",
-            header=False,
-            parallel="separate_header",
+        ds = select_datasets(ds, datasets)
+
+        if variant_histogram_bins and not gene_files:
+            print("Rewriting gene files, since they include histograms of each dataset's variants")
+            gene_files = True
+    else:
+        gene_files = True
+
+    variant_fields = hl.eval(ds.globals.meta.variant_fields)
+    datasets_meta = hl.eval(ds.globals.meta.datasets)
+    variant_field_splits = {}
+    if variant_core_fields:
+        all_datasets = list(ds_all_datasets.globals.meta.datasets.dtype.fields)
+        unknown_datasets = [dataset for dataset in variant_core_fields if dataset not in all_datasets]
+        if unknown_datasets:
+            raise ValueError(f"Unknown datasets {unknown_datasets} in variant_core_fields")
+
+        variant_field_splits = {
+            dataset: variant_field_split(variant_fields, datasets_meta[dataset], core_fields)
+            for dataset, core_fields in variant_core_fields.items()
+            if dataset in ds.variants.dtype.fields
+        }
+
+    if skip_summary_files:
+        # Metadata is not rewritten, so files must be written in the format it describes
+        with open(f"{output_directory}/metadata.json", encoding="utf-8") as metadata_file:
+            check_metadata_options(
+                json.load(metadata_file),
+                output_metadata(
+                    ds,
+                    variant_format=variant_format,
+                    variant_window_size=variant_window_size,
+                    variant_histogram_bins=variant_histogram_bins,
+                    variant_field_splits=variant_field_splits,
+                    variant_files_by_group=variant_files_by_group,
+                ),
+                datasets=list(ds.variants.dtype.fields),
+            )
+
+    results_future = None
+    if not skip_summary_files:
+        with METRICS.stage("export_gene_summary"):
+            write_gene_summary_file(
+                output_directory,
+                ds,
+                variant_format=variant_format,
+                variant_window_size=variant_window_size,
+                gene_files=gene_files,
+                update_existing=update_existing,
+                autocomplete_prefix_length=autocomplete_prefix_length,
+                variant_histogram_bins=variant_histogram_bins,
+                variant_field_splits=variant_field_splits,
+                variant_files_by_group=variant_files_by_group,
+            )
+
+        # Variant indices cover all datasets, including those not being updated
+        if variant_index:
+            with METRICS.stage("write_variant_index"):
+                export_variant_index(ds_all_datasets, f"{output_directory}/{VARIANT_INDEX_TEMP_DIR}")
+                write_variant_index_files(
+                    output_directory,
+                    ds_all_datasets.gene_id.collect(),
+                    list(ds_all_datasets.globals.meta.datasets.dtype.fields),
+                )
+        elif datasets is not None and any(
+            os.path.exists(f"{output_directory}/{variant_index_file(reference_genome)}")
+            for reference_genome in ("GRCh37", "GRCh38")
+        ):
+            print("Keeping existing variant indices, which do not reflect the updated datasets' variants")
+
+        # Write results files from the exported gene results while gene and variant files are exported and written
+        results_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        results_future = results_executor.submit(
+            write_gene_results_files,
+            output_directory,
+            list(ds.globals.meta.datasets.dtype.fields),
+            dict(hl.eval(ds.globals.meta.datasets)),
         )
+        results_executor.shutdown(wait=False)
 
-        write_json_files(output_directory, temp_dir_name, n_rows)
+    if genes:
+        genes = set(genes)
+        ds = select_genes(ds, genes)
 
-        return
+        variant_counts = collect_variant_counts(ds)
+        n_rows = len(variant_counts)
+        if n_rows < len(genes):
+            print(f"Found {n_rows:,} of {len(genes):,} genes")
 
     else:
         print("Writing out files in a single step...")
 
-        expected_datasets = [
-            "ASC",
-            "BipEx",
-            "BipEx2",
-            "Epi25",
-            "GP2",
-            "IBD",
-            "SCHEMA",
-            "SCHEMA2",
-            "ClinVarGRCh38",
-        ]
+        # Count variants in all datasets, so that updating some datasets removes the same large genes as writing
+        # all of them
+        ds = annotate_variant_counts(ds_all_datasets)
 
-        counts_expr = {}
-        for name in expected_datasets:
-            if name in ds.variants:
-                counts_expr[name] = hl.or_else(hl.len(ds.variants[name]), 0)
-            else:
-                counts_expr[name] = 0
-
-        ds = ds.annotate(variant_counts=hl.struct(**counts_expr))
-
-        ds = ds.annotate(
-            total_variants=(
-                ds.variant_counts.ASC
-                + ds.variant_counts.BipEx
-                + ds.variant_counts.BipEx2
-                + ds.variant_counts.Epi25
-                + ds.variant_counts.GP2
-                + ds.variant_counts.IBD
-                + ds.variant_counts.SCHEMA
-                + ds.variant_counts.SCHEMA2
-                + ds.variant_counts.ClinVarGRCh38
+        if variant_window_size:
+            print(f"Writing variants files with > {variant_window_size:,} variants in windows")
+            ds_filtered = ds
+        else:
+            ds_large_genes = ds.filter(ds.total_variants > VARIANT_THRESHOLD)
+            large_gene_symbols = ds_large_genes.symbol.collect()
+
+            print(f"Removing {len(large_gene_symbols)} genes with > {VARIANT_THRESHOLD:,} variants:")
+            for symbol in large_gene_symbols:
+                print(f" - {symbol}")
+
+            ds_filtered = ds.filter(ds.total_variants <= VARIANT_THRESHOLD)
+
+        with METRICS.stage("partition_genes"):
+            n_rows = ds_filtered.count()
+
+            intervals, partition_weights, variant_counts = weighted_partition_intervals(
+                ds_filtered, PARTITIONS_PER_CORE * (workers or os.cpu_count())
             )
-        )
 
-        VARIANT_THRESHOLD = 200_000
+        print_partition_weights(partition_weights)
 
-        ds_large_genes = ds.filter(ds.total_variants > VARIANT_THRESHOLD)
-        large_gene_symbols = ds_large_genes.symbol.collect()
+        # Partition by key ranges when reading the table instead of shuffling. This also allows batches of
+        # partitions to be exported separately in stream mode without recomputing a shuffle for each batch.
+        ds_filtered = hl.read_table(table_path, _intervals=intervals)
+        if variant_histogram_bins:
+            ds_filtered = annotate_variant_histograms(ds_filtered, variant_histogram_bins)
 
-        print(f"Removing {len(large_gene_symbols)} genes with > {VARIANT_THRESHOLD:,} variants:")
-        for symbol in large_gene_symbols:
-            print(f" - {symbol}")
+        if not variant_window_size:
+            ds_filtered = remove_large_genes(ds_filtered)
 
-        ds_filtered = ds.filter(ds.total_variants <= VARIANT_THRESHOLD)
-        ds_filtered = ds_filtered.drop("variant_counts", "total_variants")
+        if update_existing:
+            ds_filtered = select_datasets(ds_filtered, datasets)
 
-        temp_dir_name = "temp_parts"
-        n_rows = ds_filtered.count()
+        ds = ds_filtered
 
-        ds_filtered = ds_filtered.repartition(500)
+    options = {
+        "serialize_in_hail": serialize_in_hail,
+        "datasets": list(ds.variants.dtype.fields),
+        "previous_release_directory": previous_release_directory,
+        "output_format": output_format,
+        "precompress": sorted(precompress),
+        "variant_format": variant_format,
+        "variant_window_size": variant_window_size,
+        "variant_histogram_bins": variant_histogram_bins,
+        "variant_splits": {
+            dataset: variant_split_indices(variant_fields, datasets_meta[dataset], field_split)
+            for dataset, field_split in variant_field_splits.items()
+        },
+        "variant_files_by_group": variant_files_by_group,
+        "variant_group_counts": {
+            dataset: len(datasets_meta[dataset].variant_result_analysis_groups) for dataset in ds.variants.dtype.fields
+        }
+        if variant_files_by_group
+        else {},
+        "variant_group_results_index": variant_fields.index("group_results"),
+        "variant_position_index": variant_fields.index("pos"),
+        "gene_files": gene_files,
+        "update_existing": update_existing,
+        "genes": genes or None,
+    }
 
-        ds_filtered.select(data=hl.json(ds_filtered.row)).export(
-            f"{output_directory}/{temp_dir_name}",
-            header=False,
-            parallel="separate_header",
+    if stream:
+        stream_export_and_write_files(
+            ds,
+            output_directory,
+            options,
+            workers=workers,
+            max_temp_disk_gb=max_temp_disk_gb,
         )
+    else:
+        export_and_write_files(
+            ds,
+            output_directory,
+            n_rows,
+            options,
+            partition_parallel=partition_parallel,
+            workers=workers,
+        )
+
+    if results_future:
+        with METRICS.stage("wait_for_gene_results"):
+            results_future.result()
+
+    if precompress and not skip_summary_files:
+        with METRICS.stage("precompress_results"):
+            precompress_files(
+                output_directory,
+                [f"results/{dataset.lower()}.json" for dataset in ds.globals.meta.datasets.dtype.fields],
+                precompress,
+                workers=workers,
+            )
 
-        write_json_files(output_directory, temp_dir_name, n_rows)
+    with METRICS.stage("write_availability"):
+        write_availability_file(output_directory, variant_counts, update_existing=update_existing)
 
-        return
+    with METRICS.stage("write_manifest"):
+        finish_manifest(output_directory)
 
 
 def init_hail(env="local"):
@@ -281,17 +2452,248 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("combined_hail_table")
     parser.add_argument("output_directory")
-    parser.add_argument("--genes", nargs="+")
+    parser.add_argument("--genes", nargs="+", help="Write files for only these gene IDs")
+    parser.add_argument("--genes-file", help="Write files for only the gene IDs listed in this file, one per line")
+    parser.add_argument(
+        "--skip-summary-files",
+        action="store_true",
+        help=(
+            "Update files for the selected genes in an existing output directory without rewriting metadata, "
+            "gene search terms, or results files"
+        ),
+    )
     parser.add_argument(
         "--environment",
         choices=["local", "gce"],
         default="local",
         help="Execution environment - local or Google Compute Engine (GCP)",
     )
+    parser.add_argument(
+        "--serialize-in-hail",
+        action="store_true",
+        help="Serialize each output file's JSON in Hail so that writing files requires no decoding/encoding in Python",
+    )
+    parser.add_argument(
+        "--partition-parallel",
+        action="store_true",
+        help="Have each worker read, split, and write whole part files instead of sending rows through the main process",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes used to write files (defaults to the number of CPUs)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Export partitions in batches and write files from each batch while the next is exported",
+    )
+    parser.add_argument(
+        "--max-temp-disk-gb",
+        type=float,
+        help="With --stream, wait to export more partitions while exported data on disk exceeds this size",
+    )
+    parser.add_argument(
+        "--previous-release",
+        help=(
+            "Directory containing files written for the previous release. Files whose source data has not "
+            "changed are linked from this directory instead of being written again."
+        ),
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["files", "packed"],
+        default="files",
+        help=(
+            "Write each gene and variants file separately, or append all files in each gene directory to one "
+            "pack file with an index (defaults to %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--precompress",
+        nargs="+",
+        choices=list(PRECOMPRESSED_FILE_EXTENSIONS),
+        default=[],
+        help="Also write copies of gene, variants, and results files compressed at the maximum level with these encodings",
+    )
+    parser.add_argument(
+        "--variant-format",
+        choices=VARIANT_FORMATS,
+        default="rows",
+        help=(
+            "Write variants as an array of variant tuples, or as one array per field with repeated strings "
+            "replaced by dictionary indices (defaults to %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--variant-window-size",
+        type=int,
+        help=(
+            "Split variants files with more variants than this into position sorted windows of at most this many "
+            "variants, and write genes with more than 200,000 variants instead of skipping them"
+        ),
+    )
+    parser.add_argument(
+        "--variant-histogram-bins",
+        type=int,
+        help=(
+            "Include histograms of each dataset's variants in each analysis group by consequence category, with this "
+            "many bins over the canonical transcript's coding region, in gene files"
+        ),
+    )
+    parser.add_argument(
+        "--variant-core-fields",
+        help=(
+            "JSON file mapping datasets to the variant fields to write to variants files, as lists of top level "
+            '"variant_fields", "info" fields, and "group_results" fields. Other fields are written to variant detail '
+            "files."
+        ),
+    )
+    parser.add_argument(
+        "--variant-files-by-group",
+        action="store_true",
+        help=(
+            "Write variant annotations to variants files, and each analysis group's variant results to a separate "
+            "file per gene and dataset"
+        ),
+    )
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        help=(
+            "Update an existing output directory with the results and variants files for only these datasets, "
+            "leaving files for other datasets as they are"
+        ),
+    )
+    parser.add_argument(
+        "--gene-files",
+        action="store_true",
+        help=(
+            "With --datasets, also rewrite gene files and gene search terms. Gene files contain gene models and "
+            "gene results for all datasets."
+        ),
+    )
+    parser.add_argument(
+        "--variant-index",
+        action="store_true",
+        help="Also write indices of the genes and datasets containing each variant, for all datasets",
+    )
+    parser.add_argument(
+        "--report",
+        help="Write time spent in each stage and counters from writers to this JSON file (defaults to %(default)s)",
+        default="write_report.json",
+    )
+    parser.add_argument(
+        "--autocomplete-prefix-length",
+        type=int,
+        default=AUTOCOMPLETE_PREFIX_LENGTH,
+        help="Store gene search autocomplete results for prefixes up to this many characters (defaults to %(default)s)",
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=60,
+        help="Print the report as a line of JSON to stderr every this many seconds (defaults to %(default)s)",
+    )
     args = parser.parse_args()
 
+    selected_genes = args.genes
+    if args.genes_file:
+        selected_genes = (selected_genes or []) + read_gene_list(args.genes_file)
+
+    if args.skip_summary_files:
+        if not selected_genes:
+            parser.error("--skip-summary-files requires --genes or --genes-file")
+
+        if args.output_format == "packed":
+            parser.error("--skip-summary-files is not supported with --output-format packed")
+
+    if args.gene_files and not args.datasets:
+        parser.error("--gene-files requires --datasets")
+
+    if args.datasets and args.output_format == "packed":
+        parser.error("--datasets is not supported with --output-format packed")
+
+    if args.stream and args.partition_parallel:
+        parser.error("--stream is not supported with --partition-parallel")
+
+    if args.max_temp_disk_gb and not args.stream:
+        parser.error("--max-temp-disk-gb requires --stream")
+
+    if args.previous_release and not (args.partition_parallel or args.stream):
+        parser.error("--previous-release requires --partition-parallel or --stream")
+
+    if args.precompress:
+        if not (args.partition_parallel or args.stream):
+            parser.error("--precompress requires --partition-parallel or --stream")
+
+        if args.output_format == "packed":
+            parser.error("--precompress is not supported with --output-format packed")
+
+        if "brotli" in args.precompress and not importlib.util.find_spec("brotli"):
+            parser.error("--precompress brotli requires the brotli package")
+
+    if args.variant_format != "rows" and args.serialize_in_hail:
+        parser.error(f"--variant-format {args.variant_format} is not supported with --serialize-in-hail")
+
+    if args.autocomplete_prefix_length < 0:
+        parser.error("--autocomplete-prefix-length must not be negative")
+
+    if args.variant_window_size is not None:
+        if args.variant_window_size < 1:
+            parser.error("--variant-window-size must be positive")
+
+        if args.serialize_in_hail:
+            parser.error("--variant-window-size is not supported with --serialize-in-hail")
+
+    if args.variant_histogram_bins is not None and args.variant_histogram_bins < 1:
+        parser.error("--variant-histogram-bins must be positive")
+
+    core_fields_by_dataset = None
+    if args.variant_core_fields:
+        if args.serialize_in_hail:
+            parser.error("--variant-core-fields is not supported with --serialize-in-hail")
+
+        with open(args.variant_core_fields, encoding="utf-8") as variant_core_fields_file:
+            core_fields_by_dataset = json.load(variant_core_fields_file)
+
+    if args.variant_files_by_group:
+        if args.serialize_in_hail:
+            parser.error("--variant-files-by-group is not supported with --serialize-in-hail")
+
+        if args.variant_window_size is not None:
+            parser.error("--variant-files-by-group is not supported with --variant-window-size")
+
+        if args.variant_core_fields:
+            parser.error("--variant-files-by-group is not supported with --variant-core-fields")
+
     init_hail(args.environment)
 
-    write_data_files(args.combined_hail_table, args.output_directory, args.genes)
+    with METRICS.reporting_periodically(args.report_interval):
+        write_data_files(
+            args.combined_hail_table,
+            args.output_directory,
+            selected_genes,
+            serialize_in_hail=args.serialize_in_hail,
+            partition_parallel=args.partition_parallel,
+            workers=args.workers,
+            stream=args.stream,
+            max_temp_disk_gb=args.max_temp_disk_gb,
+            previous_release_directory=args.previous_release,
+            output_format=args.output_format,
+            precompress=args.precompress,
+            variant_format=args.variant_format,
+            variant_window_size=args.variant_window_size,
+            datasets=args.datasets,
+            gene_files=args.gene_files,
+            skip_summary_files=args.skip_summary_files,
+            autocomplete_prefix_length=args.autocomplete_prefix_length,
+            variant_histogram_bins=args.variant_histogram_bins,
+            variant_core_fields=core_fields_by_dataset,
+            variant_files_by_group=args.variant_files_by_group,
+            variant_index=args.variant_index,
+        )
+
+    METRICS.write_report(args.report)
 
     print("Finished")